@@ -11,6 +11,9 @@ Description:
 
 
 from .Base import Base
+from .tokens import get_token_counter
+from .transport import get_transport, traced_call, traced_call_stream
+from .clients import get_client
 import anthropic
 
 
@@ -33,19 +36,23 @@ import anthropic
 class Anthropic_LLM(Base):
     
     
-    def __init__(self, api_key, model='claude-1', token_limit=4096, max_tokens_to_sample=1000, name='LLM', **kwargs):
+    def __init__(self, api_key, model='claude-1', token_limit=4096, max_tokens_to_sample=1000, transport=None, client_settings=None, name='LLM', **kwargs):
         
         super().__init__(name=name, **kwargs)
         
-        self.client = anthropic.Client(api_key=api_key)
+        self.client = get_client('anthropic', api_key, settings=client_settings) # Shared
         
         self.model = model
         self.token_limit = token_limit
         self.word_limit = int(self.token_limit*0.75)
         self.char_limit = int(self.token_limit*4.00)
+        self.tokens = get_token_counter(self.model) # Exact token accounting
         
         self.max_tokens_to_sample = max_tokens_to_sample
         
+        # Requests go through the transport (live, record, replay, or stub)
+        self.transport = transport or get_transport()
+        
         #self.paragraph_limit = int(self.word_limit/250)
         #self.page_limit = self.char_limit/1800
         
@@ -55,6 +62,44 @@ class Anthropic_LLM(Base):
         if model is None:
             model = self.model
             
+        prompt = self.messages_to_prompt(messages)
+        request = {'prompt': prompt, 'model': model, 'max_tokens_to_sample': self.max_tokens_to_sample}
+        
+        return traced_call(self.transport, 'completion', request, self.live_completion)
+    
+    
+    def live_completion(self, request):
+ 
+        response = self.client.completion(**request)
+        
+        return response['completion']
+    
+    
+    def chat_completion_stream(self, messages, model=None):
+        '''Generator that yields the response text as it is produced.'''
+        
+        if model is None:
+            model = self.model
+            
+        prompt = self.messages_to_prompt(messages)
+        request = {'prompt': prompt, 'model': model, 'max_tokens_to_sample': self.max_tokens_to_sample}
+        
+        yield from traced_call_stream(self.transport, 'completion_stream', request, self.live_completion_stream)
+        
+        
+    def live_completion_stream(self, request):
+        
+        # Each streamed item holds the full completion so far
+        previous = ''
+        for data in self.client.completion_stream(**request):
+            completion = data['completion']
+            if len(completion)>len(previous):
+                yield completion[len(previous):]
+            previous = completion
+    
+    
+    def messages_to_prompt(self, messages):
+            
         # Messages to prompt
         #prompt = f"{anthropic.HUMAN_PROMPT} How many toes do Egyptian Maus have?{anthropic.AI_PROMPT}"
         prompt = ""
@@ -72,13 +117,7 @@ class Anthropic_LLM(Base):
                 self.msg_error('Role for message not handled: {}'.format(message['role']))
         
         prompt += f"{anthropic.AI_PROMPT}"
- 
-        response = self.client.completion(
-            prompt=prompt,
-            model=model,
-            max_tokens_to_sample=self.max_tokens_to_sample,
-        )        
         
-        return response['completion']
+        return prompt
     
     
@@ -11,6 +11,9 @@ Description:
 """
 
 from .Base import Base
+from .tokens import get_token_counter
+from .transport import get_transport, traced_call, traced_call_stream
+from .clients import get_client
 from openai import AzureOpenAI
 
 
@@ -34,27 +37,30 @@ class Azure_OpenAI_LLM(Base):
     def __init__(self, api_key, model='gpt-35-turbo-16k', 
                  token_limit:int = 4096, 
                  endpoint: str = 'https://*****.openai.azure.com/',
-                 deployment: str = 'gpt35', name='LLM', **kwargs):
+                 deployment: str = 'gpt35', transport=None, client_settings=None, name='LLM', **kwargs):
 
         super().__init__(name=name, **kwargs)
         self.model = model
         self.token_limit = token_limit
         self.word_limit = int(self.token_limit * 0.75)
         self.char_limit = int(self.token_limit * 4.00)
+        self.tokens = get_token_counter(self.model) # Exact token accounting
         self.endpoint = endpoint,
         self.api_key = api_key
-        self.client = AzureOpenAI(
-            api_key=self.api_key,
-            api_version="2023-05-15",
-            azure_endpoint=endpoint,    # For some reason, self.endpoint is a tuple. Default value?
-            azure_deployment=deployment # The configured service in our Azure portal
-        )
+        # Clients (and their connection pools) are shared
+        self.client = get_client('azure_openai', self.api_key, endpoint=endpoint, deployment=deployment, settings=client_settings)
+        # Requests go through the transport (live, record, replay, or stub)
+        self.transport = transport or get_transport()
 
     def chat_completion(self, messages, model=None):
         if model is None:
             model = self.model
 
-        completion = self.client.chat.completions.create(model=model, messages=messages)
+        request = {'model': model, 'messages': messages}
+        return traced_call(self.transport, 'chat', request, self.live_chat_completion)
+
+    def live_chat_completion(self, request):
+        completion = self.client.chat.completions.create(**request)
         response = completion.choices[0].message
         if response.role == "assistant":
             response = response.content
@@ -63,26 +69,40 @@ class Azure_OpenAI_LLM(Base):
 
         return response
 
+    def chat_completion_stream(self, messages, model=None):
+        '''Generator that yields the response text as it is produced.'''
+        if model is None:
+            model = self.model
+
+        request = {'model': model, 'messages': messages}
+        yield from traced_call_stream(self.transport, 'chat_stream', request, self.live_chat_completion_stream)
+
+    def live_chat_completion_stream(self, request):
+        stream = self.client.chat.completions.create(stream=True, **request)
+        for chunk in stream:
+            # Azure sends an initial chunk (content filter results) with no choices
+            if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
 class Azure_OpenAI_embedding(Base):
     
     def __init__(self, api_key, model='text-embedding-ada-002',
                  token_limit:int = 8192,
                  endpoint: str = 'https://*****.openai.azure.com/',
-                 deployment: str = 'ada002', name='embed', **kwargs):
+                 deployment: str = 'ada002', transport=None, client_settings=None, name='embed', **kwargs):
 
         super().__init__(name=name, **kwargs)
         self.model = model
         self.token_limit = token_limit
         self.word_limit = int(self.token_limit * 0.75)
         self.char_limit = int(self.token_limit * 4.00)
+        self.tokens = get_token_counter(self.model) # Exact token accounting
         self.endpoint = endpoint,
         self.api_key = api_key
-        self.client = AzureOpenAI(
-            api_key=self.api_key,
-            api_version="2023-05-15",
-            azure_endpoint=endpoint,    # For some reason, self.endpoint is a tuple. Default value?
-            azure_deployment=deployment # The configured service in our Azure portal
-        )
+        # Clients (and their connection pools) are shared
+        self.client = get_client('azure_openai', self.api_key, endpoint=endpoint, deployment=deployment, settings=client_settings)
+        # Requests go through the transport (live, record, replay, or stub)
+        self.transport = transport or get_transport()
     
     
     def embedding(self, text, model=None):
@@ -92,5 +112,9 @@ class Azure_OpenAI_embedding(Base):
         if model is None:
             model = self.model
 
-        result = self.client.embeddings.create(model=model, input=text)
+        request = {'model': model, 'input': text}
+        return traced_call(self.transport, 'embedding', request, self.live_embedding)
+
+    def live_embedding(self, request):
+        result = self.client.embeddings.create(**request)
         return result.data[0].embedding
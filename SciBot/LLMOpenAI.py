@@ -11,6 +11,9 @@ Description:
 
 
 from .Base import Base
+from .tokens import get_token_counter
+from .transport import get_transport, traced_call, traced_call_stream
+from .clients import get_client
 #import openai # pre-1.0 syntax
 from openai import OpenAI # 1.0 syntax
 
@@ -33,7 +36,7 @@ from openai import OpenAI # 1.0 syntax
 class OpenAI_LLM(Base):
     
     
-    def __init__(self, api_key, model='gpt-3.5-turbo', token_limit=4096, name='LLM', **kwargs):
+    def __init__(self, api_key, model='gpt-3.5-turbo', token_limit=4096, transport=None, base_url=None, client_settings=None, name='LLM', **kwargs):
         
         super().__init__(name=name, **kwargs)
         
@@ -42,6 +45,7 @@ class OpenAI_LLM(Base):
         self.token_limit = token_limit
         self.word_limit = int(self.token_limit*0.75)
         self.char_limit = int(self.token_limit*4.00)
+        self.tokens = get_token_counter(self.model) # Exact token accounting
         
         #self.paragraph_limit = int(self.word_limit/250)
         #self.page_limit = self.char_limit/1800
@@ -49,13 +53,25 @@ class OpenAI_LLM(Base):
         # pre-1.0 syntax:
         #openai.api_key = api_key 
         # 1.0 syntax:
-        self.client = OpenAI(api_key=api_key)        
+        #self.client = OpenAI(api_key=api_key, base_url=base_url)
+        # Clients (and their connection pools) are shared
+        self.client = get_client('openai', api_key, endpoint=base_url, settings=client_settings)
+        
+        # Requests go through the transport (live, record, replay, or stub)
+        self.transport = transport or get_transport()
         
         
     def chat_completion(self, messages, model=None):
         
         if model is None:
             model = self.model
+            
+        request = {'model': model, 'messages': messages}
+        
+        return traced_call(self.transport, 'chat', request, self.live_chat_completion)
+        
+        
+    def live_chat_completion(self, request):
         
         # pre-1.0 syntax:
         #completion = openai.ChatCompletion.create(
@@ -66,7 +82,7 @@ class OpenAI_LLM(Base):
         #response = completion['choices'][0]['message']
         
         # 1.0 syntax:
-        completion = self.client.chat.completions.create(model=model, messages=messages)
+        completion = self.client.chat.completions.create(**request)
         response = completion.choices[0].message
         
         if response.role=="assistant":
@@ -77,6 +93,26 @@ class OpenAI_LLM(Base):
         return response
 
 
+    def chat_completion_stream(self, messages, model=None):
+        '''Generator that yields the response text as it is produced
+        (each item is the newly-generated fragment).'''
+        
+        if model is None:
+            model = self.model
+            
+        request = {'model': model, 'messages': messages}
+        
+        yield from traced_call_stream(self.transport, 'chat_stream', request, self.live_chat_completion_stream)
+        
+        
+    def live_chat_completion_stream(self, request):
+        
+        stream = self.client.chat.completions.create(stream=True, **request)
+        for chunk in stream:
+            if len(chunk.choices)>0 and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
     def embedding(self, text, model=None):
         '''Lookup this text block in OpenAI, and determine the embedding for it.'''
         
@@ -84,6 +120,13 @@ class OpenAI_LLM(Base):
         
         if model is None:
             model = self.model
+            
+        request = {'model': model, 'input': text}
+        
+        return traced_call(self.transport, 'embedding', request, self.live_embedding)
+    
+    
+    def live_embedding(self, request):
 
         # pre-1.0 syntax:
         #result = openai.Embedding.create(
@@ -93,7 +136,7 @@ class OpenAI_LLM(Base):
         #return result['data'][0]['embedding']
     
         # 1.0 syntax:
-        result = self.client.embeddings.create(model=model, input=text)
+        result = self.client.embeddings.create(**request)
         return result.data[0].embedding
         
             
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Filename: answer_cache.py
+Author: Kevin G. Yager, Brookhaven National Laboratory
+Email: kyager@bnl.gov
+Date created: 2026-10-19
+Description:
+ Semantic cache of answers. A new question whose embedding is sufficiently
+close to a previously-answered question (for the same model and the same
+corpus) is answered from the cache, rather than with a new LLM completion.
+Entries are kept in the database, so the cache is shared across processes.
+"""
+
+from .Base import Base
+
+import numpy as np
+
+
+class AnswerCache(Base):
+    '''Serves cached answers for (near-)repeated questions.
+
+    settings (e.g. configuration['answer_cache']) may include:
+      threshold : minimum cosine similarity between questions
+      ttl : maximum age (seconds) of an entry
+      max_entries : the least recently used entries beyond this are evicted
+      verify_context : also require the retrieved context to be the same
+    '''
+
+    def __init__(self, db, model, corpus_generation, settings=None, name='cache', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+        settings = settings or {}
+        self.db = db
+        self.model = model
+        self.corpus_generation = corpus_generation
+
+        self.threshold = settings.get('threshold', 0.97)
+        self.ttl = settings.get('ttl', 7*24*3600)
+        self.max_entries = settings.get('max_entries', 5000)
+        self.verify_context = settings.get('verify_context', True)
+
+        self.entries = None # Loaded on first use
+        self.stats = {'lookups': 0, 'hits': 0, 'misses': 0, 'bypassed': 0}
+
+
+    def load(self):
+
+        rows = self.db.get_answer_cache(self.model, self.corpus_generation, ttl=self.ttl)
+
+        self.entries = rows
+        if len(rows)>0:
+            vectors = np.asarray([row['vector'] for row in rows])
+            self.vectors = vectors/np.linalg.norm(vectors, axis=1)[:,np.newaxis]
+        else:
+            self.vectors = np.zeros( (0, 0) )
+
+        self.msg(f"Loaded {len(rows):,d} cached answers (model {self.model}, corpus {self.corpus_generation})", 4, 1)
+
+
+    def find(self, vector):
+        '''The cached entry for the most similar question (if within the
+        threshold); or None.'''
+
+        if self.entries is None:
+            self.load()
+        if len(self.entries)==0:
+            return None
+
+        vector = np.asarray(vector)
+        similarities = np.dot(self.vectors, vector)/np.linalg.norm(vector)
+        idx = np.argmax(similarities)
+        if similarities[idx]<self.threshold:
+            return None
+
+        entry = self.entries[idx]
+        entry['similarity'] = float(similarities[idx])
+
+        return entry
+
+
+    # Outcomes (and hit-rate metrics)
+    ##################################################
+    def record(self, stat):
+        self.stats[stat] += 1
+        self.db.increment_answer_cache_stat(stat)
+
+
+    def hit(self, entry):
+        '''Serve the cached answer for this entry.'''
+
+        self.record('lookups')
+        self.record('hits')
+        self.db.touch_answer_cache(entry['cache_id'])
+
+        answer = self.db.get_answer_cache_entry(entry['cache_id'])['answer']
+        self.msg(f"Answer cache hit (similarity {entry['similarity']:.4f}, cache_id={entry['cache_id']})", 3, 1)
+
+        return answer
+
+
+    def miss(self):
+        self.record('lookups')
+        self.record('misses')
+
+
+    def bypass(self):
+        '''Questions that cannot be answered from the cache (e.g. follow-ups
+        within a conversation).'''
+        self.record('bypassed')
+
+
+    def add(self, question, vector, context_hash, answer):
+
+        cache_id = self.db.add_answer_cache(self.model, self.corpus_generation, question, vector, context_hash, answer)
+        self.db.evict_answer_cache(ttl=self.ttl, max_entries=self.max_entries)
+        self.entries = None # Reload on next use
+
+        return cache_id
+
+
+    def get_stats(self):
+        '''Hit-rate metrics, for this process and (persistent) overall.'''
+
+        overall = self.db.get_answer_cache_stats()
+        lookups = overall.get('lookups', 0)
+        overall['hit_rate'] = overall.get('hits', 0)/lookups if lookups>0 else 0.0
+
+        session = dict(self.stats)
+        session['hit_rate'] = session['hits']/session['lookups'] if session['lookups']>0 else 0.0
+
+        return {'session': session, 'overall': overall}
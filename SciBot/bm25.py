@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Filename: bm25.py
+Author: Kevin G. Yager, Brookhaven National Laboratory
+Email: kyager@bnl.gov
+Date created: 2026-10-19
+Description:
+ Local (lexical) retrieval: an inverted index over the chunks, with BM25
+scoring. This needs no embedding API call, and handles exact-term queries
+(chemical formulas, acronyms like "SS-LZA") that embedding vectors serve
+poorly. It can be used alone, or fused with the vector ranking.
+
+Posting lists are stored compressed: for each term, the (increasing) chunk
+numbers are delta-encoded, and the deltas and term frequencies are written
+as variable-length integers (7 bits per byte). Chunks are only ever
+appended (so the index can be updated incrementally as documents are
+ingested); removed chunks are masked, and purged by compact().
+"""
+
+from .Base import Base
+from .tracing import span
+
+import re
+import threading
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+
+# Compressed integer lists
+##################################################
+def encode_varint(values, out=None):
+    '''Append the values (non-negative ints) to a bytearray, as varints.'''
+
+    out = bytearray() if out is None else out
+    for value in values:
+        while value>=0x80:
+            out.append((value&0x7F)|0x80)
+            value >>= 7
+        out.append(value)
+
+    return out
+
+
+def encode_varints(values):
+    '''Vectorized varint encoding of an array of values (as uint8 array).'''
+
+    values = np.asarray(values, dtype=np.uint64)
+    if len(values)==0:
+        return np.zeros(0, dtype=np.uint8)
+
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += values>=(np.uint64(1)<<np.uint64(7*k))
+
+    starts = np.cumsum(nbytes) - nbytes
+    group = np.repeat(np.arange(len(values)), nbytes)
+    j = np.arange(nbytes.sum()) - starts[group]
+
+    data = (values[group]>>(7*j).astype(np.uint64)) & np.uint64(0x7F)
+    data |= np.where(j<nbytes[group]-1, np.uint64(0x80), np.uint64(0))
+
+    return data.astype(np.uint8)
+
+
+def decode_varints(data):
+    '''Vectorized varint decoding (of bytes, or a uint8 array).'''
+
+    data = np.frombuffer(data, dtype=np.uint8) if not isinstance(data, np.ndarray) else data
+    if len(data)==0:
+        return np.zeros(0, dtype=np.int64)
+
+    ends = np.flatnonzero(data<0x80)
+    starts = np.concatenate( ([0], ends[:-1]+1) )
+    group = np.repeat(np.arange(len(ends)), ends-starts+1)
+    shift = 7*(np.arange(len(data)) - starts[group])
+
+    payload = (data & 0x7F).astype(np.int64) << shift
+
+    return np.add.reduceat(payload, starts)
+
+
+
+class BM25Index(Base):
+    '''Inverted index over chunks, identified by (table_suffix, doc_id, chunk_num).'''
+
+    stopwords = frozenset(('a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'have', 'in', 'is', 'it', 'its', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'were', 'which', 'with'))
+
+    def __init__(self, path=None, k1=1.5, b=0.75, name='bm25', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+        self.path = None if path is None else Path(path)
+        self.k1 = k1
+        self.b = b
+
+        # Words, formulas and hyphenated terms (e.g. "TiO2", "PS-b-PMMA", "SS-LZA")
+        self.word_re = re.compile(r'[a-z0-9]+(?:[-_.+/][a-z0-9]+)*')
+
+        self._lock = threading.RLock()
+        self.dirty = False
+
+        if self.path is not None and self.path.exists():
+            self.load()
+        else:
+            self.clear()
+
+
+    def clear(self):
+
+        # Chunks (indexed by internal chunk number)
+        self.table_suffixes = []
+        self.doc_ids = []
+        self.chunk_nums = []
+        self.lengths = []
+        self.live = []
+        self.docs = {} # (table_suffix, doc_id) : [internal chunk numbers]
+
+        # Postings, as saved (term lookup into one array)
+        self.terms = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.blob = np.zeros(0, dtype=np.uint8)
+        self.last_saved = np.zeros(0, dtype=np.int64)
+
+        # Postings that have been added to since loading
+        self.postings = {}
+        self.last = {}
+
+        self.total_length = 0
+        self.num_live = 0
+
+
+    def __len__(self):
+        return self.num_live
+
+
+    def tokenize(self, text):
+        '''Terms in the text. Compound terms (e.g. "SS-LZA") are indexed both
+        whole and as their parts.'''
+
+        terms = []
+        for word in self.word_re.findall(text.lower()):
+            if word in self.stopwords:
+                continue
+            terms.append(word)
+            if not word.isalnum():
+                terms.extend( part for part in re.split(r'[-_.+/]', word) if part and part not in self.stopwords )
+
+        return terms
+
+
+    # Updates
+    ##################################################
+    def term_postings(self, term):
+        '''The (encoded) posting list for a term.'''
+
+        if term in self.postings:
+            return self.postings[term]
+        if term in self.terms:
+            i = self.terms[term]
+            return self.blob[self.offsets[i]:self.offsets[i+1]].tobytes()
+
+        return b''
+
+
+    def add_chunk(self, table_suffix, doc_id, chunk_num, text):
+
+        with self._lock:
+            idx = len(self.doc_ids)
+
+            terms = self.tokenize(text)
+            self.table_suffixes.append(table_suffix)
+            self.doc_ids.append(int(doc_id))
+            self.chunk_nums.append(int(chunk_num))
+            self.lengths.append(len(terms))
+            self.live.append(True)
+            self.docs.setdefault( (table_suffix, int(doc_id)), [] ).append(idx)
+
+            for term, tf in Counter(terms).items():
+                if term not in self.postings:
+                    self.postings[term] = bytearray(self.term_postings(term))
+                    self.last[term] = int(self.last_saved[self.terms[term]]) if term in self.terms else -1
+                encode_varint( (idx-self.last[term], tf), out=self.postings[term] )
+                self.last[term] = idx
+
+            self.total_length += len(terms)
+            self.num_live += 1
+            self.dirty = True
+
+
+    def add_doc(self, doc_id, chunks, table_suffix=''):
+        '''Index (or re-index) the chunks of a document (numbered from 1, as in the database).'''
+
+        with self._lock:
+            self.remove_doc(doc_id, table_suffix=table_suffix)
+            for chunk_num, text in enumerate(chunks, start=1):
+                self.add_chunk(table_suffix, doc_id, chunk_num, text)
+
+        self.msg(f"Indexed {len(chunks):,d} chunks (doc_id={doc_id})", 5, 2)
+
+
+    def remove_doc(self, doc_id, table_suffix=''):
+
+        with self._lock:
+            for idx in self.docs.pop( (table_suffix, int(doc_id)), [] ):
+                if self.live[idx]:
+                    self.live[idx] = False
+                    self.total_length -= self.lengths[idx]
+                    self.num_live -= 1
+                    self.dirty = True
+
+
+    # Search
+    ##################################################
+    def decode_postings(self, term):
+        '''Internal chunk numbers and term frequencies, for a term.'''
+
+        values = decode_varints(self.term_postings(term))
+
+        return np.cumsum(values[0::2]) - 1, values[1::2]
+
+
+    def scores(self, query):
+        '''BM25 score of every (internal) chunk for the query.'''
+
+        with self._lock, span('retrieval.bm25') as s:
+            n = len(self.doc_ids)
+            scores = np.zeros(n)
+            if self.num_live==0:
+                return scores
+
+            lengths = np.asarray(self.lengths, dtype=float)
+            live = np.asarray(self.live, dtype=bool)
+            norm = self.k1*( 1 - self.b + self.b*lengths/(self.total_length/self.num_live) )
+
+            for term, qtf in Counter(self.tokenize(query)).items():
+                ids, tf = self.decode_postings(term)
+                s.add('postings', len(ids))
+                keep = live[ids]
+                ids, tf = ids[keep], tf[keep]
+                if len(ids)==0:
+                    continue
+
+                df = len(ids)
+                idf = np.log( 1 + (self.num_live-df+0.5)/(df+0.5) )
+                scores[ids] += qtf*idf*tf*(self.k1+1)/(tf+norm[ids])
+
+        return scores
+
+
+    def search(self, query, top_k=20):
+        '''The best-matching chunks, as a list of (score, table_suffix, doc_id, chunk_num).'''
+
+        scores = self.scores(query)
+        order = np.argsort(-scores, kind='stable')[:top_k]
+
+        return [ (float(scores[i]), self.table_suffixes[i], self.doc_ids[i], self.chunk_nums[i]) for i in order if scores[i]>0 ]
+
+
+    def positions(self, table_suffixes, doc_ids, chunk_nums):
+        '''For each indexed chunk, its position in the given arrays (e.g. the
+        embedding lookup); or -1 if it is not present.'''
+
+        lookup = { (s, int(d), int(c)): i for i, (s, d, c) in enumerate(zip(table_suffixes, doc_ids, chunk_nums)) }
+
+        with self._lock:
+            return np.asarray([ lookup.get(key, -1) for key in zip(self.table_suffixes, self.doc_ids, self.chunk_nums) ], dtype=np.int64)
+
+
+    # Storage
+    ##################################################
+    def compact(self):
+        '''Purge removed chunks (renumbering the rest).'''
+
+        with self._lock:
+            live = np.asarray(self.live, dtype=bool)
+            if live.all():
+                return
+
+            renumber = np.cumsum(live) - 1
+            postings = {}
+            last = {}
+            for term in list(self.terms.keys()) + [ t for t in self.postings if t not in self.terms ]:
+                ids, tf = self.decode_postings(term)
+                keep = live[ids]
+                if not keep.any():
+                    continue
+                ids = renumber[ids[keep]]
+                deltas = np.diff(ids, prepend=-1)
+                postings[term] = bytearray( encode_varints(np.column_stack( (deltas, tf[keep]) ).ravel()).tobytes() )
+                last[term] = int(ids[-1])
+
+            keep = np.flatnonzero(live)
+            self.table_suffixes = [ self.table_suffixes[i] for i in keep ]
+            self.doc_ids = [ self.doc_ids[i] for i in keep ]
+            self.chunk_nums = [ self.chunk_nums[i] for i in keep ]
+            self.lengths = [ self.lengths[i] for i in keep ]
+            self.live = [True]*len(keep)
+            self.docs = {}
+            for idx, key in enumerate(zip(self.table_suffixes, self.doc_ids)):
+                self.docs.setdefault(key, []).append(idx)
+
+            self.terms = {}
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self.blob = np.zeros(0, dtype=np.uint8)
+            self.last_saved = np.zeros(0, dtype=np.int64)
+            self.postings = postings
+            self.last = last
+            self.dirty = True
+
+
+    def save(self, path=None, compact_fraction=0.2):
+        '''Save the index (compacting first, if many chunks have been removed).'''
+
+        path = self.path if path is None else Path(path)
+
+        with self._lock:
+            if len(self.live)-self.num_live > compact_fraction*len(self.live):
+                self.compact()
+
+            terms = sorted( set(self.terms.keys()) | set(self.postings.keys()) )
+            arrays = [ np.frombuffer(bytes(self.term_postings(term)), dtype=np.uint8) for term in terms ]
+            lengths = np.asarray([ len(a) for a in arrays ], dtype=np.int64)
+            last = [ self.last[term] if term in self.last else int(self.last_saved[self.terms[term]]) for term in terms ]
+
+            data = {
+                'k1': self.k1,
+                'b': self.b,
+                'terms': np.asarray(terms, dtype=object),
+                'offsets': np.concatenate( ([0], np.cumsum(lengths)) ),
+                'postings': np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.uint8),
+                'last': np.asarray(last, dtype=np.int64),
+                'table_suffix': np.asarray(self.table_suffixes, dtype=object),
+                'doc_ids': np.asarray(self.doc_ids, dtype=np.int64),
+                'chunk_nums': np.asarray(self.chunk_nums, dtype=np.int64),
+                'lengths': np.asarray(self.lengths, dtype=np.int32),
+                'live': np.asarray(self.live, dtype=bool),
+                }
+
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'wb') as fout:
+                np.save(fout, data, allow_pickle=True)
+
+            self.load_data(data)
+            self.path = path
+            self.dirty = False
+
+        self.msg(f"Saved BM25 index ({self.num_live:,d} chunks, {len(terms):,d} terms, {len(data['postings']):,d} bytes of postings) to: {path}", 4, 1)
+
+
+    def load(self, path=None):
+
+        path = self.path if path is None else Path(path)
+        data = np.load(path, allow_pickle=True).item()
+
+        with self._lock:
+            self.load_data(data)
+            self.dirty = False
+
+        self.msg(f"Loaded BM25 index ({self.num_live:,d} chunks, {len(self.terms):,d} terms) from: {path}", 4, 1)
+
+
+    def load_data(self, data):
+
+        self.k1 = data['k1']
+        self.b = data['b']
+
+        self.table_suffixes = list(data['table_suffix'])
+        self.doc_ids = data['doc_ids'].tolist()
+        self.chunk_nums = data['chunk_nums'].tolist()
+        self.lengths = data['lengths'].tolist()
+        self.live = data['live'].tolist()
+        self.docs = {}
+        for idx, key in enumerate(zip(self.table_suffixes, self.doc_ids)):
+            if self.live[idx]:
+                self.docs.setdefault(key, []).append(idx)
+
+        self.terms = { term: i for i, term in enumerate(data['terms']) }
+        self.offsets = data['offsets']
+        self.blob = data['postings']
+        self.last_saved = data['last']
+        self.postings = {}
+        self.last = {}
+
+        live = data['live']
+        self.total_length = int(data['lengths'][live].sum())
+        self.num_live = int(live.sum())
+
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_bm25_index(settings):
+    '''The BM25 index described by settings (e.g. configuration['bm25'], which
+    should include the path). Indexes are shared within the process.'''
+
+    settings = dict(settings)
+    path = Path(settings.pop('path', './bm25_index.npy'))
+
+    with _indexes_lock:
+        key = str(path.resolve())
+        if key not in _indexes:
+            _indexes[key] = BM25Index(path=path, **settings)
+
+        return _indexes[key]
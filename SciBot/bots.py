@@ -13,6 +13,8 @@ Description:
 
 from .Base import Base
 from .LLMs import *
+from .transport import get_transport
+from .tracing import configure_tracing
 
 class SummarizeBot(Base):
     '''Takes a paragraph of text and summarizes it.'''
@@ -25,12 +27,13 @@ class SummarizeBot(Base):
         api_key = self.configuration['openai']['api_key']
         self.model = self.configuration['openai']['model']
         self.token_limit = self.configuration['openai']['model_token_limit']
-        self.LLM = OpenAI_LLM(api_key=api_key, model=self.model, token_limit=self.token_limit, name='OpenAI')
+        self.LLM = OpenAI_LLM(api_key=api_key, model=self.model, token_limit=self.token_limit, transport=get_transport(self.configuration), base_url=self.configuration['openai'].get('base_url'), client_settings=self.configuration['openai'], name='OpenAI')
         
         
         instruction = "Your task is to take blocks of text from scientific journal articles, and summarize them in a concise way. Capture as much information as possible, whiel avoiding repetition. Omit details very specific to the particular paper. Emphasize insights that are generalizable. Do not make things up."
 
         self.request_template = "Summarize this (from the paper {}):\n\n{}"
+        self.reduce_template = "Combine these partial summaries (from the paper {}) into a single concise summary:\n\n{}"
         
         # Reserve this space in the message
         self.header_len = len(instruction) + len(self.request_template) + 100 
@@ -46,9 +49,10 @@ class SummarizeBot(Base):
         return int( (self.LLM.char_limit - self.header_len)*ratio )
         
         
-    def summarize(self, text, doc_name='<UNKNOWN>', msg_cutoff=35):
+    def summarize(self, text, doc_name='<UNKNOWN>', request_template=None, msg_cutoff=35):
         
-        request = self.request_template.format(doc_name, text)
+        request_template = request_template or self.request_template
+        request = request_template.format(doc_name, text)
         
         messages = self.background.copy()
         messages.append({"role": "user", "content": request})
@@ -77,12 +81,13 @@ class EmbedBot(Base):
         api_key = self.configuration['openai']['api_key']
         self.model = self.configuration['openai']['embedding_model']
         self.token_limit = self.configuration['openai']['embedding_model_token_limit']
-        self.LLM = OpenAI_LLM(api_key=api_key, model=self.model, token_limit=self.token_limit, name='OpenAI')
+        self.LLM = OpenAI_LLM(api_key=api_key, model=self.model, token_limit=self.token_limit, transport=get_transport(self.configuration), base_url=self.configuration['openai'].get('base_url'), client_settings=self.configuration['openai'], name='OpenAI')
         
         
     def compute_embedding(self, text):
-        if len(text)>self.LLM.char_limit:
-            self.msg_error(f"Supplied text size ({len(text):,d} chars) greater than limit ({self.LLM.char_limit:,d} chars)")
+        num_tokens = self.LLM.tokens.count_batch([text])[0]
+        if num_tokens>self.token_limit:
+            self.msg_error(f"Supplied text size ({num_tokens:,d} tokens) greater than limit ({self.token_limit:,d} tokens)")
         result = self.LLM.embedding(text)
         
         self.msg(f'''Received embedding (dimension {len(result):,d})''', 3, 2)
@@ -123,7 +128,9 @@ class ImageBot(Base):
     # User interaction with bot
     ##################################################
 
-    def query(self, image_file, mode='cosine'):
+    def query(self, image_file, mode='cosine', filter=None):
+        '''Images ordered by similarity to image_file; the filter expression
+        (c.f. DocumentDatabase.parse_filter) restricts the search.'''
         
         vector = self.ImgEmbed.image_to_embedding(image_file)
         #print(vector.shape)
@@ -131,20 +138,20 @@ class ImageBot(Base):
         #print('CLIP vector sum: {}'.format(np.sum(vector)))
         
         if mode=='cosine':
-            similarities = self.db.order_images_by_similarity(vector, normalize=True)
+            similarities = self.db.order_images_by_similarity(vector, normalize=True, filter=filter)
         elif mode=='dot':
-            similarities = self.db.order_images_by_similarity(vector, normalize=False)
+            similarities = self.db.order_images_by_similarity(vector, normalize=False, filter=filter)
         elif mode=='euclid':
-            similarities = self.db.order_images_by_distance(vector)
+            similarities = self.db.order_images_by_distance(vector, filter=filter)
         else:
             self.msg_error(f'mode not recognized: {mode}')
         
         return similarities
 
         
-    def query_txt(self, image_file, outfile='response.html', mode='cosine', exclude=None, num_cutoff=50):
+    def query_txt(self, image_file, outfile='response.html', mode='cosine', exclude=None, num_cutoff=50, filter=None):
 
-        similarities = self.query(image_file, mode=mode)
+        similarities = self.query(image_file, mode=mode, filter=filter)
         txt = self.generate_txt(similarities, image_file, num_cutoff=num_cutoff, exclude=exclude)
         
         if outfile is not None:
@@ -154,9 +161,9 @@ class ImageBot(Base):
         return txt
 
     
-    def query_html(self, image_file, outfile='response.html', mode='cosine', exclude=None, num_cutoff=50):
+    def query_html(self, image_file, outfile='response.html', mode='cosine', exclude=None, num_cutoff=50, filter=None):
         
-        similarities = self.query(image_file, mode=mode)
+        similarities = self.query(image_file, mode=mode, filter=filter)
         html = self.generate_html(similarities, image_file, num_cutoff=num_cutoff, exclude=exclude)
         
         if outfile is not None:
@@ -275,16 +282,19 @@ class FigureBot(ImageBot):
     # User interaction with bot
     ##################################################
 
-    def query(self, image_file, mode='cosine'):
+    def query(self, image_file, mode='cosine', filter=None):
+        '''Figures ordered by similarity to image_file; the filter expression
+        (c.f. DocumentDatabase.parse_filter) restricts the search, e.g. to
+        "year>=2020; class=self-assembly".'''
         
         vector = self.ImgEmbed.image_to_embedding(image_file)
         
         if mode=='cosine':
-            similarities = self.db.order_figures_by_similarity(vector, normalize=True)
+            similarities = self.db.order_figures_by_similarity(vector, normalize=True, filter=filter)
         elif mode=='dot':
-            similarities = self.db.order_images_by_similarity(vector, normalize=False)
+            similarities = self.db.order_figures_by_similarity(vector, normalize=False, filter=filter)
         elif mode=='euclid':
-            similarities = self.db.order_figures_by_distance(vector)
+            similarities = self.db.order_figures_by_distance(vector, filter=filter)
         else:
             self.msg_error(f'mode not recognized: {mode}')
         
@@ -368,12 +378,19 @@ class FigureBot(ImageBot):
 class AnswerBot(Base):
     '''Answers questions, using the provided messages for context.'''
     
-    def __init__(self, configuration, name='AnswerBot', max_response_len=3600, **kwargs):
+    answer_cache = None # Semantic answer cache (if enabled in the configuration)
+    bm25 = None # Lexical index (if the configured retrieval is 'bm25' or 'hybrid')
+    pipeline = None # Background work (prefetch, writes) for queries via the database
+    timer = None # Timing of the stages of the current query (see last_timings)
+    conversation_decay = 0.5 # Retrieval weight of each conversation message, relative to the one after it
+    
+    def __init__(self, configuration, name='AnswerBot', max_response_len=3600, max_response_tokens=None, **kwargs):
         super().__init__(name=name, **kwargs)
 
         self.db = None        
         
         self.configuration = configuration
+        configure_tracing(self.configuration)
         api_key = self.configuration['openai']['api_key']
 
         # For embedding lookup
@@ -383,7 +400,7 @@ class AnswerBot(Base):
         # For chat responses
         self.model = self.configuration['openai']['model']
         self.token_limit = self.configuration['openai']['model_token_limit']
-        self.LLM_chat = OpenAI_LLM(api_key=api_key, model=self.model, token_limit=self.token_limit, name='OpenAI')
+        self.LLM_chat = OpenAI_LLM(api_key=api_key, model=self.model, token_limit=self.token_limit, transport=get_transport(self.configuration), base_url=self.configuration['openai'].get('base_url'), client_settings=self.configuration['openai'], name='OpenAI')
         
         self.LLM_embed = self.LLM_chat
         
@@ -398,27 +415,45 @@ class AnswerBot(Base):
         
         
         self.max_response_len = max_response_len # chars
-        self.max_context_len = self.LLM_chat.char_limit - self.header_len - self.max_response_len
+        self.init_window(max_response_tokens or max_response_len//4)
         
         self.print_window()
         
         
+    def init_window(self, max_response_tokens):
+        '''Budget the context window, in tokens (counted using the tokenizer of the chat model).'''
+        
+        self.tokens = self.LLM_chat.tokens
+        self.header_tokens = self.tokens.count_messages(self.background)
+        self.max_response_tokens = max_response_tokens
+        # The retrieved context is sent as one additional message
+        self.max_context_tokens = self.token_limit - self.header_tokens - self.tokens.tokens_per_message - self.max_response_tokens
+        
+        self._doc_names = {} # doc_id:doc_name (for section token counts)
+        
         
     def print_window(self):
         
-        total = self.header_len + self.max_context_len + self.max_response_len
+        total = self.header_tokens + self.max_context_tokens + self.max_response_tokens
         
-        w, t, c = 0.187, 0.25, 1
+        # Token counts are exact; words and chars are estimates
+        w, t, c = 0.75, 1, 4
         self.msg('----------------------------------------------')
         self.msg('|              |  words  |  tokens |  chars  |')
         self.msg('| WINDOW       | {:7,d} | {:7,d} | {:7,d} |'.format(int(self.LLM_chat.word_limit), int(self.token_limit), int(self.LLM_chat.char_limit)))
-        self.msg('| Instructions | {:7,d} | {:7,d} | {:7,d} |'.format(int(self.header_len*w), int(self.header_len*t), int(self.header_len*c)))
-        self.msg('| Context      | {:7,d} | {:7,d} | {:7,d} |'.format(int(self.max_context_len*w), int(self.max_context_len*t), int(self.max_context_len*c)))
-        self.msg('| Response     | {:7,d} | {:7,d} | {:7,d} |'.format(int(self.max_response_len*w), int(self.max_response_len*t), int(self.max_response_len*c)))
+        self.msg('| Instructions | {:7,d} | {:7,d} | {:7,d} |'.format(int(self.header_tokens*w), int(self.header_tokens*t), int(self.header_tokens*c)))
+        self.msg('| Context      | {:7,d} | {:7,d} | {:7,d} |'.format(int(self.max_context_tokens*w), int(self.max_context_tokens*t), int(self.max_context_tokens*c)))
+        self.msg('| Response     | {:7,d} | {:7,d} | {:7,d} |'.format(int(self.max_response_tokens*w), int(self.max_response_tokens*t), int(self.max_response_tokens*c)))
         self.msg('| TOTAL        | {:7,d} | {:7,d} | {:7,d} |'.format(int(total*w), int(total*t), int(total*c)))
         self.msg('----------------------------------------------')
         
         
+    def conversation_tokens(self, messages):
+        '''Tokens consumed by (additional) messages in the request.'''
+        
+        return self.tokens.count_messages(messages) - self.tokens.tokens_reply_priming
+        
+        
         
         
         
@@ -431,11 +466,69 @@ class AnswerBot(Base):
             self.db = DocumentDatabase(config=self.configuration['doc_database'], verbosity=self.verbosity)
         
     def close_database(self):
+        if self.pipeline is not None:
+            self.pipeline.close()
+            self.pipeline = None
         self.db.close()
         
+    def start_pipeline(self):
+        '''Background threads (with their own database connection) that overlap
+        the independent waits of a query.'''
+        
+        if self.pipeline is None:
+            from .pipeline import QueryPipeline
+            self.pipeline = QueryPipeline(self.configuration, verbosity=self.verbosity)
+        self.pipeline.reset()
+        
+    def start_timings(self):
+        '''Start timing a new query; the per-stage times (seconds) are in last_timings.'''
+        
+        from .pipeline import StageTimer
+        self.timer = StageTimer()
+        self.last_timings = self.timer.timings
+        
+    def stage(self, name):
+        '''Context manager that times (and traces) a stage of the current query;
+        it yields the stage's span, so attributes can be attached.'''
+        
+        if self.timer is None:
+            self.start_timings()
+        return self.timer.stage(name)
+        
     def load_embedding_lookup_file(self, infile='./chunk_lookup.npy'):
         self.start_database()
         self.db.load_embedding_lookup_file(infile=infile)
+        self.start_answer_cache()
+        self.start_bm25()
+        
+        
+    def start_answer_cache(self):
+        '''Enable the semantic answer cache, if configured. Cached answers are
+        specific to the model and to the loaded corpus (lookup).'''
+        
+        settings = self.configuration.get('answer_cache')
+        if settings:
+            from .answer_cache import AnswerCache
+            self.db.create_table_answer_cache() # (if not already present)
+            self.answer_cache = AnswerCache(self.db, self.model, self.db.lookup_generation(), settings=settings, verbosity=self.verbosity)
+            self._cache_pending = None
+
+
+    def retrieval_mode(self):
+        '''How chunks are ranked: 'vector' (embedding similarity), 'bm25'
+        (lexical; no embedding API call), or 'hybrid' (both, fused).'''
+        return self.configuration.get('retrieval', 'vector')
+
+
+    def start_bm25(self):
+        '''Load the BM25 index (if used by the retrieval mode), aligned to the embedding lookup.'''
+        
+        if self.retrieval_mode() in ['bm25', 'hybrid']:
+            from .bm25 import get_bm25_index
+            self.bm25 = get_bm25_index(self.configuration['bm25'])
+            lookup = self.db.embeddings
+            self._bm25_positions = self.bm25.positions(lookup['table_suffix'], lookup['doc_ids'], lookup['chunk_nums'])
+            self._bm25_last = None # (question, result) of the most recent search
 
 
     # LLM
@@ -445,67 +538,465 @@ class AnswerBot(Base):
         vector = self.LLM_embed.embedding(text, model=self.embedding_model)
         
         return vector
+    
+    
+    def message_vectors(self, thread):
+        '''The embedding of each message in the thread. Embeddings stored with
+        the messages are reused; missing ones (e.g. for messages written by the
+        web frontend) are computed and stored, so each message is embedded once.'''
+        
+        import numpy as np
+        
+        store = self.db.has_message_embeddings()
+        vectors = []
+        for item in thread:
+            vector = item.get('embedding_vector')
+            if vector is None or item.get('embedding_model')!=self.embedding_model:
+                vector = np.asarray(self.get_embedding(item['message_content']))
+                if store and self.pipeline is not None:
+                    self.pipeline.db_call('set_message_embedding', dict(item), self.embedding_model, vector)
+                elif store:
+                    self.db.set_message_embedding(item, self.embedding_model, vector)
+                item['embedding_model'] = self.embedding_model
+                item['embedding_vector'] = vector
+            vectors.append(vector)
+            
+        return vectors
+    
+    
+    def conversation_vector(self, thread, decay=None):
+        '''The retrieval query vector for the latest message in the thread: a
+        recency-weighted combination of the message embeddings (weights of
+        1, decay, decay**2, ... going back in time).
+        If the messages table does not store embeddings (and so they would
+        all have to be computed anew, every turn), the concatenated messages
+        are instead embedded with a single call.'''
         
-
-    def construct_prompt(self, question, max_context_len=None, separator="\n*", doc_name=True):
-        '''Generate the text preample that we feed in for a question.'''
+        import numpy as np
+        
+        decay = self.conversation_decay if decay is None else decay
         
-        vector = self.get_embedding(question)
+        if len(thread)>1 and not self.db.has_message_embeddings():
+            question = "".join( f"{item['message_content']}\n" for item in thread )
+            vector = np.asarray(self.get_embedding(question))
+            return vector/np.linalg.norm(vector)
         
-        most_relevant_chunks = self.db.order_chunks_by_similarity(vector)
+        vectors = np.asarray(self.message_vectors(thread))
+        vectors = vectors/np.linalg.norm(vectors, axis=1)[:,np.newaxis]
+        weights = decay**np.arange(len(vectors))[::-1]
+        vector = np.dot(weights, vectors)
         
-        separator_len = len(separator)
+        return vector/np.linalg.norm(vector)
+    
+    
+    def save_reply(self, thread_id, response):
+        '''Add the reply to the thread (with its embedding, if the messages table stores them).
+        With the pipeline running, this happens in the background.'''
+
+        if self.pipeline is not None:
+            self.pipeline.db_call('add_thread_message', thread_id, 'assistant', response)
+            self.embed_reply(thread_id, response)
+        elif self.db.has_message_embeddings():
+            self.db.add_thread_message(thread_id, 'assistant', response, model=self.embedding_model, vector=self.get_embedding(response))
+        else:
+            self.db.add_thread_message(thread_id, 'assistant', response)
+
+
+    def embed_reply(self, thread_id, response):
+        '''Store the embedding of the (already saved) reply, in the background.'''
+
+        if not self.db.has_message_embeddings():
+            return
+
+        def embed():
+            vector = self.get_embedding(response)
+            self.pipeline.db_call('update_last_thread_message', thread_id, 'assistant', response, model=self.embedding_model, vector=vector).result()
+
+        self.pipeline.run(embed)
         
-        chosen_sections = []
-        chosen_sections_len = 0
-        chosen_sections_text = []
-        max_context_len = max_context_len or self.max_context_len
 
-        for similarity, table_suffix, doc_id, chunk_num in most_relevant_chunks:
-            
-            # Add contexts until we run out of space.        
-            chunk = self.db.get_chunk(doc_id, chunk_num, table_suffix=table_suffix)
-            content = chunk['content']
-            
-            if doc_name:
-                content = "From [{}]: {}".format(chunk['doc_name'], content)
-                #content = "From ts=_{}_ [{}]: {}".format(table_suffix, chunk['doc_name'], content)
-                
-            
-            chosen_sections_len += len(content) + separator_len
-            if chosen_sections_len > max_context_len:
-                break
+    def construct_prompt(self, question, max_context_tokens=None, separator="\n*", doc_name=True, pool_factor=2.0, max_candidates=1000, vector=None, filter=None):
+        '''Generate the text preample that we feed in for a question.
+        The most relevant chunks are packed (as a 0/1 knapsack, maximizing
+        total relevance) into exactly max_context_tokens tokens.
+        Chunks from the same document are grouped under one header, and
+        adjacent chunks are merged (without repeating their overlap); the
+        space this frees is filled with further chunks.
+        (The embedding vector of the question can be supplied, if known.)
+        A filter expression (c.f. DocumentDatabase.parse_filter) restricts the
+        context to matching chunks, e.g. "year>=2020; doc_id!=12".'''
+        
+        with self.stage('ranking'):
+            similarities, order = self.rank_chunks(question, vector=vector, filter=filter)
+
+        max_context_tokens = max_context_tokens or self.max_context_tokens
+        preamble = """Context:\n"""
+        budget = max_context_tokens - self.tokens.count(preamble)
 
-            chosen_sections.append(separator + content.replace("\n", " "))
-            chosen_sections_text.append(str(content))
+        with self.stage('packing'):
+            candidates = self.context_candidates(similarities, order, budget, separator=separator, doc_name=doc_name, pool_factor=pool_factor, max_candidates=max_candidates)
+            # The chunks are fetched (in the background, if possible) while we choose among them
+            self.prefetch_chunks(candidates)
+            chosen = self.pack_sections(candidates, budget)
 
+        with self.stage('assembly') as s:
+            prompt, num_tokens, chosen = self.assemble_context(preamble, candidates, chosen, max_context_tokens, separator=separator, doc_name=doc_name)
+            s.set(tokens=num_tokens, chunks=len(chosen), bytes=len(prompt))
 
-        prompt = """Context:\n""" + "".join(chosen_sections)
+
+        # Fingerprint of the retrieved context
+        import hashlib
+        chunk_keys = sorted( '{}:{}:{}'.format(c['table_suffix'], c['doc_id'], c['chunk_num']) for c in chosen )
+        self.last_context_hash = hashlib.sha256( ','.join(chunk_keys).encode('utf-8') ).hexdigest()
 
         # Useful diagnostic information
-        self.msg(f"Selected {len(chosen_sections):,d} document sections (prompt {len(prompt):,d} chars)", 3, 1)
-        #self.msg("\n".join(chosen_sections_text), 4, 2)
+        num_docs = len(set( (c['table_suffix'], c['doc_id']) for c in chosen ))
+        self.msg(f"Selected {len(chosen):,d} chunks from {num_docs:,d} documents (prompt {num_tokens:,d}/{max_context_tokens:,d} tokens, {len(prompt):,d} chars)", 3, 1)
 
         #print(prompt)
         
         return prompt
 
 
+    def assemble_context(self, preamble, candidates, chosen, max_context_tokens, separator="\n*", doc_name=True):
+        '''Assemble the context from the chosen chunks, then fill any leftover
+        space with further candidates. Returns (prompt, num_tokens, chosen).'''
+
+        spans = {} # Merged text of runs of adjacent chunks
+        def assemble(chunks):
+            sections = self.context_groups(chunks, separator=separator, doc_name=doc_name, spans=spans)
+            # Token counts of (unchanged) sections are cached, so this is cheap
+            return preamble + "".join(sections), self.tokens.count(preamble) + sum(self.tokens.count(section) for section in sections)
+        
+        prompt, num_tokens = assemble(chosen)
+        
+        chosen_ids = set(id(c) for c in chosen)
+        docs = set( (c['table_suffix'], c['doc_id']) for c in chosen )
+        for c in candidates:
+            # Use any leftover space
+            if id(c) in chosen_ids or num_tokens>=max_context_tokens:
+                continue
+            if (c['table_suffix'], c['doc_id']) not in docs and c['num_tokens']>max_context_tokens-num_tokens:
+                continue
+            trial = sorted(chosen + [c], key=lambda c: -c['similarity'])
+            trial_prompt, trial_tokens = assemble(trial)
+            if trial_tokens<=max_context_tokens:
+                chosen, prompt, num_tokens = trial, trial_prompt, trial_tokens
+                chosen_ids.add(id(c))
+                docs.add( (c['table_suffix'], c['doc_id']) )
+        
+        # Token counts of the sections are not exactly additive, so we verify the total and repair
+        num_tokens = self.tokens.count_uncached(prompt)
+        while num_tokens>max_context_tokens and chosen:
+            # Drop the least-relevant sections
+            excess = num_tokens - max_context_tokens
+            while excess>0 and chosen:
+                excess -= chosen.pop()['num_tokens']
+            prompt, _ = assemble(chosen)
+            num_tokens = self.tokens.count_uncached(prompt)
+
+        return prompt, num_tokens, chosen
+
+
+    def rank_chunks(self, question, vector=None, filter=None):
+        '''The relevance of every chunk in the lookup, and the lookup indices
+        sorted by relevance (according to the retrieval mode). Only the chunks
+        matching the filter expression are ranked.'''
+        
+        retrieval = self.retrieval_mode()
+        if retrieval=='bm25':
+            similarities, order = self.bm25_similarities(question)
+            return similarities, self.filter_order(order, filter)
+        
+        if vector is None:
+            with self.stage('embedding'):
+                vector = self.get_embedding(question)
+        similarities, order = self.db.chunk_similarities(vector, filter=filter)
+        
+        if retrieval=='hybrid':
+            _, bm25_order = self.bm25_similarities(question)
+            return self.fuse_rankings([order, self.filter_order(bm25_order, filter)])
+        
+        return similarities, order
+    
+    
+    def bm25_similarities(self, question):
+        '''BM25 scores for the chunks in the lookup; only matching chunks are ranked.'''
+        
+        import numpy as np
+
+        if self._bm25_last is not None and self._bm25_last[0]==question:
+            return self._bm25_last[1]
+
+        scores = self.bm25.scores(question)
+        positions = self._bm25_positions
+        present = positions>=0
+        
+        similarities = np.zeros(len(self.db.embeddings['doc_ids']))
+        similarities[positions[present]] = scores[present]
+        order = np.argsort(-similarities, kind='stable')
+        order = order[similarities[order]>0]
+        self._bm25_last = (question, (similarities, order))
+
+        return similarities, order
+    
+    
+    def filter_order(self, order, filter):
+        '''Restrict an ordering (of lookup indices) to the chunks matching the filter expression.'''
+        
+        mask = self.db.lookup_mask('embeddings', filter)
+        
+        return order if mask is None else order[mask[order]]
+    
+    
+    def fuse_rankings(self, orders, k=60):
+        '''Reciprocal rank fusion: each chunk scores sum(1/(k+rank)) over the rankings.'''
+        
+        import numpy as np
+        
+        scores = np.zeros(len(self.db.embeddings['doc_ids']))
+        for order in orders:
+            scores[order] += 1.0/( k + np.arange(1, len(order)+1) )
+            
+        order = np.argsort(-scores, kind='stable')
+        
+        return scores, order
+    
+    
+    def context_candidates(self, similarities, order, budget, separator="\n*", doc_name=True, pool_factor=2.0, max_candidates=1000):
+        '''The pool of chunks considered for the context: the most relevant
+        chunks, up to pool_factor times the token budget. Token counts come
+        from the lookup (stored at ingest), so chunks are only fetched from
+        the database if their count is unknown, or once they are chosen.'''
+        
+        lookup = self.db.embeddings
+        
+        candidates = []
+        pool_tokens = 0
+        for idx in order[:max_candidates]:
+            
+            c = {'similarity': similarities[idx], 'table_suffix': lookup['table_suffix'][idx], 'doc_id': lookup['doc_ids'][idx], 'chunk_num': lookup['chunk_nums'][idx]}
+            
+            num_tokens = lookup['num_tokens'][idx]
+            if num_tokens<0:
+                # Not stored; count the section directly
+                num_tokens = self.tokens.count(self.context_section(c, separator=separator, doc_name=doc_name))
+            else:
+                num_tokens += self.header_tokens_for(c['doc_id'], separator=separator, doc_name=doc_name)
+            c['num_tokens'] = int(num_tokens)
+            
+            if num_tokens<=budget:
+                candidates.append(c)
+                pool_tokens += num_tokens
+                if pool_tokens>=budget*pool_factor:
+                    break
+                
+        return candidates
+    
+    
+    def prefetch_chunks(self, candidates):
+        '''Start fetching the content of chunks, in the background (if the pipeline is running).'''
+
+        if self.pipeline is not None:
+            self.pipeline.prefetch_chunks([ (c['table_suffix'], int(c['doc_id']), int(c['chunk_num'])) for c in candidates if 'content' not in c ])
+
+
+    def chunk_content(self, candidate):
+        '''The text of a chunk (fetched from the database on first use).'''
+
+        if 'content' not in candidate:
+            chunk = None
+            if self.pipeline is not None:
+                chunk = self.pipeline.get_chunk( (candidate['table_suffix'], int(candidate['doc_id']), int(candidate['chunk_num'])) )
+            if chunk is None:
+                chunk = self.db.get_chunk(candidate['doc_id'], candidate['chunk_num'], table_suffix=candidate['table_suffix'])
+            candidate['content'] = chunk['content']
+            self._doc_names[candidate['doc_id']] = chunk['doc_name']
+            
+        return candidate['content']
+    
+    
+    def context_section(self, candidate, separator="\n*", doc_name=True):
+        '''The text that a chunk contributes to the context (on its own).'''
+        
+        if 'section' not in candidate:
+            content = self.chunk_content(candidate)
+            
+            if doc_name:
+                content = "From [{}]: {}".format(self._doc_names[candidate['doc_id']], content)
+                #content = "From ts=_{}_ [{}]: {}".format(table_suffix, chunk['doc_name'], content)
+                
+            candidate['section'] = separator + content.replace("\n", " ")
+            
+        return candidate['section']
+    
+    
+    def context_groups(self, chosen, separator="\n*", doc_name=True, spans=None, gap=" [...] "):
+        '''The sections of the context for the chosen chunks: one per document
+        (ordered by their most relevant chunk). Within a document, runs of
+        adjacent chunks are merged into one span with the overlap removed;
+        separate spans are joined by the gap marker.
+        spans (optional) caches the merged text of each run.'''
+        
+        spans = {} if spans is None else spans
+        
+        groups = {}
+        for c in chosen:
+            groups.setdefault( (c['table_suffix'], c['doc_id']), [] ).append(c)
+        
+        sections = []
+        for (table_suffix, doc_id), members in sorted(groups.items(), key=lambda item: -max(c['similarity'] for c in item[1])):
+            
+            members = sorted(members, key=lambda c: c['chunk_num'])
+            runs = [ [members[0]] ]
+            for c in members[1:]:
+                if c['chunk_num']==runs[-1][-1]['chunk_num']+1:
+                    runs[-1].append(c)
+                else:
+                    runs.append([c])
+            
+            texts = []
+            for run in runs:
+                key = (table_suffix, doc_id, tuple(c['chunk_num'] for c in run))
+                if key not in spans:
+                    if len(run)==1:
+                        spans[key] = self.chunk_content(run[0])
+                    else:
+                        spans[key], _ = self.db.chunks_to_offsets([ self.chunk_content(c) for c in run ])
+                texts.append(spans[key].replace("\n", " "))
+            
+            content = gap.join(texts)
+            if doc_name:
+                content = "From [{}]: {}".format(self._doc_names[doc_id], content)
+            sections.append(separator + content)
+        
+        return sections
+    
+    
+    def header_tokens_for(self, doc_id, separator="\n*", doc_name=True):
+        '''Tokens used by the separator and "From [doc_name]: " prefix of a section.'''
+        
+        if not doc_name:
+            return self.tokens.count(separator)
+        
+        if doc_id not in self._doc_names:
+            self._doc_names[doc_id] = self.db.get_doc(doc_id)['doc_name']
+            
+        return self.tokens.count("{}From [{}]: ".format(separator, self._doc_names[doc_id]))
+    
+    
+    def pack_sections(self, candidates, budget, max_capacity=4096):
+        '''Choose the subset of candidates with the highest total relevance
+        that fits in the token budget (0/1 knapsack, by dynamic programming).
+        Token counts are quantized so that the table has at most max_capacity
+        columns; they are rounded up, so the selection never exceeds the budget.
+        Returns the chosen candidates, ordered by relevance.'''
+        
+        if len(candidates)==0 or budget<=0:
+            return []
+        
+        import numpy as np
+        
+        granularity = max(1, -(-budget//max_capacity))
+        capacity = budget//granularity
+        
+        weights = np.asarray([ -(-c['num_tokens']//granularity) for c in candidates ], dtype=int)
+        # Relevance relative to the least-relevant candidate (which thus has ~zero value)
+        similarity = np.asarray([ c['similarity'] for c in candidates ], dtype=float)
+        values = similarity - similarity.min() + 1e-3
+        
+        if weights.sum()<=capacity:
+            return list(candidates)
+        
+        best = np.zeros(capacity+1)
+        keep = np.zeros( (len(candidates), capacity+1), dtype=bool )
+        for i, (w, v) in enumerate(zip(weights, values)):
+            if w>capacity:
+                continue
+            improved = best[:capacity+1-w] + v
+            take = improved>best[w:]
+            keep[i,w:] = take
+            best[w:] = np.where(take, improved, best[w:])
+            
+        chosen = []
+        remaining = capacity
+        for i in range(len(candidates)-1, -1, -1):
+            if keep[i,remaining]:
+                chosen.append(candidates[i])
+                remaining -= weights[i]
+                
+        return sorted(chosen, key=lambda c: -c['similarity'])
+        
         
     # User interaction with bot
     ##################################################
         
-    def query(self, question, use_context=True, doc_name=True, max_context_len=None, msg_cutoff=35):
-        '''Answer user question by retrieving chunks, and doing a call
-        to the LLM API.'''
+    def retrieve_context(self, question, doc_name=True, max_context_tokens=None, cacheable=True, vector=None, filter=None):
+        '''Construct the context for the question; or find a cached answer.
+        Returns (context_content, cached_answer); cached_answer is None unless
+        the answer cache is enabled and has a match.
+        (The retrieval query vector can be supplied, if known.)
+        Filtered questions bypass the answer cache.'''
+        
+        cache = self.answer_cache
+        if cache is None:
+            return self.construct_prompt(question, doc_name=doc_name, max_context_tokens=max_context_tokens, vector=vector, filter=filter), None
+        
+        if not cacheable or filter is not None:
+            cache.bypass()
+            return self.construct_prompt(question, doc_name=doc_name, max_context_tokens=max_context_tokens, vector=vector, filter=filter), None
+        
+        if vector is None:
+            with self.stage('embedding'):
+                vector = self.get_embedding(question)
+        entry = cache.find(vector)
+        if entry is not None and not cache.verify_context:
+            return None, cache.hit(entry)
+        
+        context_content = self.construct_prompt(question, doc_name=doc_name, max_context_tokens=max_context_tokens, vector=vector)
+        if entry is not None and entry['context_hash']==self.last_context_hash:
+            return context_content, cache.hit(entry)
+        
+        cache.miss()
+        self._cache_pending = (question, vector, self.last_context_hash)
+        
+        return context_content, None
+    
+    
+    def cache_answer(self, response):
+        '''Add the response to the answer cache (if the question was a cache miss).'''
+        
+        if self.answer_cache is not None and self._cache_pending is not None:
+            question, vector, context_hash = self._cache_pending
+            self.answer_cache.add(question, vector, context_hash, response)
+            self._cache_pending = None
+        
+        
+    def prepare_messages(self, question, use_context=True, doc_name=True, max_context_tokens=None, cacheable=True, filter=None):
+        '''Assemble the messages (instructions, retrieved context, question) for the LLM.
+        Returns (messages, cached_answer).'''
         
         messages = self.background.copy()
         
         if use_context:
-            context_content = self.construct_prompt(question, doc_name=doc_name, max_context_len=max_context_len)
+            max_context_tokens = (max_context_tokens or self.max_context_tokens) - self.conversation_tokens([{"role": "user", "content" : question}])
+            context_content, cached_answer = self.retrieve_context(question, doc_name=doc_name, max_context_tokens=max_context_tokens, cacheable=cacheable, filter=filter)
+            if cached_answer is not None:
+                return None, cached_answer
             messages.append({"role": "system", "content" : context_content})
         
         messages.append({"role": "user", "content" : question})
+        
+        return messages, None
+        
+        
+    def query(self, question, use_context=True, doc_name=True, max_context_tokens=None, msg_cutoff=35, filter=None):
+        '''Answer user question by retrieving chunks, and doing a call
+        to the LLM API.'''
+        
+        messages, cached_answer = self.prepare_messages(question, use_context=use_context, doc_name=doc_name, max_context_tokens=max_context_tokens, filter=filter)
+        if cached_answer is not None:
+            return cached_answer
 
 
         self.msg(f'''Asking question ({len(question):,d} chars): "{question[:msg_cutoff]}"...''', 3, 2)
@@ -514,20 +1005,37 @@ class AnswerBot(Base):
         
         self.msg(f'''Received response ({len(response):,d} chars): "{response[:msg_cutoff]}"...''', 3, 2)
         
+        self.cache_answer(response)
+        
         return response
 
 
-    def mock_query(self, question, use_context=True, doc_name=True, max_context_len=None, savefile='./mock_query.txt', msg_cutoff=35):
-        '''Prepare to query the LLM, but don't actually send the request.
-        Instead, just save the preparred query to disk.'''
+    def query_stream(self, question, use_context=True, doc_name=True, max_context_tokens=None, msg_cutoff=35, filter=None):
+        '''Answer user question (like query), but as a generator that yields
+        the response text as it is produced by the LLM.'''
         
-        messages = self.background.copy()
+        messages, cached_answer = self.prepare_messages(question, use_context=use_context, doc_name=doc_name, max_context_tokens=max_context_tokens, filter=filter)
+        if cached_answer is not None:
+            yield cached_answer
+            return
+
+        self.msg(f'''Asking question ({len(question):,d} chars): "{question[:msg_cutoff]}"...''', 3, 2)
         
-        if use_context:
-            context_content = self.construct_prompt(question, doc_name=doc_name, max_context_len=max_context_len)
-            messages.append({"role": "system", "content" : context_content})
+        response = ''
+        for fragment in self.LLM_chat.chat_completion_stream(messages):
+            response += fragment
+            yield fragment
         
-        messages.append({"role": "user", "content" : question})
+        self.msg(f'''Received response ({len(response):,d} chars): "{response[:msg_cutoff]}"...''', 3, 2)
+        
+        self.cache_answer(response)
+
+
+    def mock_query(self, question, use_context=True, doc_name=True, max_context_tokens=None, savefile='./mock_query.txt', msg_cutoff=35, filter=None):
+        '''Prepare to query the LLM, but don't actually send the request.
+        Instead, just save the preparred query to disk.'''
+        
+        messages, _ = self.prepare_messages(question, use_context=use_context, doc_name=doc_name, max_context_tokens=max_context_tokens, cacheable=False, filter=filter)
 
 
         self.msg(f'''Saving question ({len(question):,d} chars): "{question[:msg_cutoff]}"...''', 3, 2)
@@ -536,48 +1044,75 @@ class AnswerBot(Base):
                 fout.write(message['content']+'\n\n')
 
 
-    def query_via_db(self, thread_id, use_conversation=True, use_context=True, doc_name=True, max_context_len=None, conversation_cutoff=20, msg_cutoff=35):
-        '''Answer user question by retrieving chunks, and doing a call
-        to the LLM API.
-        This version operates through the database, both to identify the user query,
-        and provide a reply.'''
+    def prepare_messages_via_db(self, thread_id, use_conversation=True, use_context=True, doc_name=True, max_context_tokens=None, conversation_cutoff=20, prefetch=50, filter=None):
+        '''Assemble the messages for the LLM, using the conversation thread
+        stored in the database. Returns (messages, question, cached_answer); if
+        the thread is not awaiting a reply, messages is None and question is an
+        error string.
+        Independent steps are overlapped: the query embedding is computed in the
+        background while the conversation is measured and (with a BM25 index)
+        the top lexical matches are prefetched.'''
 
         self.start_database()
-        last_message = self.db.get_last_thread_message(thread_id)
-        if last_message['who']!='user':
-            self.msg_error("Last message is from {last_message['who']} (should be 'user').")
-            return "[[Error: Last message is from {last_message['who']} (should be 'user')."
-        
-        question = last_message['message_content']
-        
+        self.start_pipeline()
+
+        # The conversation history (including the latest message), in one query
+        with self.stage('history'):
+            thread = self.db.get_thread_messages(thread_id, cutoff=conversation_cutoff if use_conversation else 1)
+            self.db.has_message_embeddings() # (Checked here, rather than from a background thread)
+
+        if len(thread)==0 or thread[-1]['who']!='user':
+            who = thread[-1]['who'] if len(thread)>0 else None
+            self.msg_error(f"Last message is from {who} (should be 'user').")
+            return None, f"[[Error: Last message is from {who} (should be 'user').]]", None
+
+        question = thread[-1]['message_content']
+
+        # Start computing the retrieval query vector
+        vector = None
+        if use_context and (self.retrieval_mode()!='bm25' or self.answer_cache is not None):
+            # The context should be constructed not just using the user question (last typed message), but some of the chat history. However, if we use too much of the chat history to compute the embedding, then the older Q+A (which might now be irrelevant) will dominate the vector calculation.
+            if not use_conversation or len(question)>500:
+                # This is a detailed question. So probably it alone should determine the context lookup.
+                n = 1
+            elif len(question)<35:
+                # This is a very short question, so it might be a follow-up (requires more conversation history).
+                n = 5
+            else:
+                # By default, let's just have the last Q and A (plus current Q) in context.
+                n = 3
+            # Each message is embedded once (and stored); the query vector weights recent messages more
+            vector = self.pipeline.run(self.conversation_vector, thread[-n:])
+
+        if use_context and self.bm25 is not None:
+            # Lexical ranking needs no API call, so the likely chunks can be fetched in the meantime
+            with self.stage('prefetch'):
+                similarities, order = self.bm25_similarities(question)
+                order = self.filter_order(order, filter)
+                lookup = self.db.embeddings
+                self.prefetch_chunks([ {'table_suffix': lookup['table_suffix'][idx], 'doc_id': lookup['doc_ids'][idx], 'chunk_num': lookup['chunk_nums'][idx]} for idx in order[:prefetch] ])
+
         messages = self.background.copy()
-        
+
         # Account for how much of the context window is consumed by the conversation history
-        max_context_len = max_context_len or self.max_context_len
+        max_context_tokens = max_context_tokens or self.max_context_tokens
         if use_conversation:
-            thread = self.db.get_thread_messages(thread_id, cutoff=conversation_cutoff)
-            for item in thread:
-                max_context_len -= len(item['message_content'])
+            max_context_tokens -= self.conversation_tokens([{"role": item['who'], "content" : item['message_content']} for item in thread])
+        else:
+            max_context_tokens -= self.conversation_tokens([{"role": "user", "content" : question}])
+
 
-        
         # Add retrieved context document chunks
         if use_context:
-            if use_conversation:
-                # The context should be constructed not just using the user question (last typed message), but some of the chat history. However, if we use too much of the chat history to compute the embedding, then the older Q+A (which might now be irrelevant) will dominate the vector calculation.
-                if len(question)<35:
-                    # This is a very short question, so it might be a follow-up (requires more conversation history).
-                    n = 5
-                elif len(question)>500:
-                    # This is a detailed question. So probably it alone should determine the context lookup.
-                    n = 1
-                else:
-                    # By default, let's just have the last Q and A (plus current Q) in context.
-                    n = 3
-                question = ""
-                for item in thread[-n:]:
-                    question += f"{item['message_content']}\n"
-                
-            context_content = self.construct_prompt(question, doc_name=doc_name, max_context_len=max_context_len)
+            if vector is not None:
+                with self.stage('embedding'):
+                    vector = vector.result()
+
+            # An answer depends on the earlier conversation (if any), so follow-ups bypass the answer cache
+            cacheable = not use_conversation or len(thread)<=1
+            context_content, cached_answer = self.retrieve_context(question, doc_name=doc_name, max_context_tokens=max_context_tokens, cacheable=cacheable, vector=vector, filter=filter)
+            if cached_answer is not None:
+                return None, question, cached_answer
             messages.append({"role": "system", "content" : context_content})
 
 
@@ -585,21 +1120,96 @@ class AnswerBot(Base):
         if use_conversation:
             for item in thread:
                 messages.append({"role": item['who'], "content" : item['message_content']})
-                
-        else:       
+
+        else:
             messages.append({"role": "user", "content" : question})
 
+        return messages, question, None
+
+
+    def query_via_db(self, thread_id, use_conversation=True, use_context=True, doc_name=True, max_context_tokens=None, conversation_cutoff=20, msg_cutoff=35, filter=None):
+        '''Answer user question by retrieving chunks, and doing a call
+        to the LLM API.
+        This version operates through the database, both to identify the user query,
+        and provide a reply (which is written in the background).
+        The time spent in each stage is recorded in last_timings.'''
+
+        self.start_timings()
+        with self.stage('total'):
+
+            messages, question, cached_answer = self.prepare_messages_via_db(thread_id, use_conversation=use_conversation, use_context=use_context, doc_name=doc_name, max_context_tokens=max_context_tokens, conversation_cutoff=conversation_cutoff, filter=filter)
+            if cached_answer is not None:
+                self.save_reply(thread_id, cached_answer)
+                return cached_answer
+            if messages is None:
+                return question
+
+
+            self.msg(f'''Asking question ({len(question):,d} chars): "{question[:msg_cutoff]}"...''', 3, 2)
+
+            with self.stage('llm') as s:
+                response = self.LLM_chat.chat_completion(messages)
+                s.set(messages=len(messages), bytes_out=len(response))
+
+            self.msg(f'''Received response ({len(response):,d} chars): "{response[:msg_cutoff]}"...''', 3, 2)
+
+            with self.stage('reply'):
+                self.save_reply(thread_id, response)
+                self.cache_answer(response)
+
+        self.msg("Timings: " + ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in self.last_timings.items()), 4, 2)
+
+        return response
+
+
+    def query_via_db_stream(self, thread_id, use_conversation=True, use_context=True, doc_name=True, max_context_tokens=None, conversation_cutoff=20, save_interval=1.0, msg_cutoff=35, filter=None):
+        '''Answer user question (like query_via_db), but as a generator that
+        yields the response text as it is produced by the LLM.
+        The reply is saved to the database as it grows (at most every
+        save_interval seconds), so a partial reply is never lost, and other
+        readers of the thread see it.'''
+        
+        import time
+
+        self.start_timings()
+        messages, question, cached_answer = self.prepare_messages_via_db(thread_id, use_conversation=use_conversation, use_context=use_context, doc_name=doc_name, max_context_tokens=max_context_tokens, conversation_cutoff=conversation_cutoff, filter=filter)
+        if cached_answer is not None:
+            self.save_reply(thread_id, cached_answer)
+            yield cached_answer
+            return
+        if messages is None:
+            yield question
+            return
+
 
         self.msg(f'''Asking question ({len(question):,d} chars): "{question[:msg_cutoff]}"...''', 3, 2)
         
-        response = self.LLM_chat.chat_completion(messages)
+        self.db.add_thread_message(thread_id, 'assistant', '')
+        
+        response = ''
+        last_save = time.time()
+        try:
+            for fragment in self.LLM_chat.chat_completion_stream(messages):
+                response += fragment
+                yield fragment
+                
+                if time.time()-last_save>save_interval:
+                    self.db.update_last_thread_message(thread_id, 'assistant', response)
+                    last_save = time.time()
+                    
+        except Exception as e:
+            response += f"[[Error: {type(e).__name__} while generating reply.]]"
+            raise
+        
+        finally:
+            # Also runs if the consumer stops early (e.g. the client disconnected)
+            self.db.update_last_thread_message(thread_id, 'assistant', response)
         
         self.msg(f'''Received response ({len(response):,d} chars): "{response[:msg_cutoff]}"...''', 3, 2)
         
-        self.db.add_thread_message(thread_id, 'assistant', response)
+        self.embed_reply(thread_id, response)
+        self.cache_answer(response)
         
-        return response        
-     
         
 
 
@@ -617,14 +1227,14 @@ class AnswerBot_Claude(AnswerBot):
         api_key = self.configuration['openai']['api_key']
         self.embedding_model = self.configuration['openai']['embedding_model']
         self.embedding_token_limit = self.configuration['openai']['embedding_model_token_limit']
-        self.LLM_embed = OpenAI_LLM(api_key=api_key, model=self.embedding_model, token_limit=self.embedding_token_limit, name='OpenAI')        
+        self.LLM_embed = OpenAI_LLM(api_key=api_key, model=self.embedding_model, token_limit=self.embedding_token_limit, transport=get_transport(self.configuration), base_url=self.configuration['openai'].get('base_url'), client_settings=self.configuration['openai'], name='OpenAI')        
         
         # For chat responses
         api_key = self.configuration['anthropic']['api_key']
         self.model = self.configuration['anthropic']['model']
         self.token_limit = self.configuration['anthropic']['model_token_limit']
         self.max_tokens_to_sample = self.configuration['anthropic']['max_tokens_to_sample']
-        self.LLM_chat = Anthropic_LLM(api_key=api_key, model=self.model, token_limit=self.token_limit, max_tokens_to_sample=self.max_tokens_to_sample, name='Claude')
+        self.LLM_chat = Anthropic_LLM(api_key=api_key, model=self.model, token_limit=self.token_limit, max_tokens_to_sample=self.max_tokens_to_sample, transport=get_transport(self.configuration), client_settings=self.configuration['anthropic'], name='Claude')
         
         instruction = "You are a chatbot that answers questions, especially about scientific research. You are given snippets from relevant published journal articles. You should provide a meaningful response to the user question, based on your general knowledge and the information in the provided snippets. Do not make things up. Quote and refer to the sources where appropriate."
 
@@ -636,8 +1246,8 @@ class AnswerBot_Claude(AnswerBot):
             ] 
         
         
-        self.max_response_len = self.max_tokens_to_sample # chars
-        self.max_context_len = self.LLM_chat.char_limit - self.header_len - self.max_response_len
+        self.max_response_len = self.max_tokens_to_sample*4 # chars
+        self.init_window(self.max_tokens_to_sample)
         
         self.print_window()
         
@@ -647,7 +1257,7 @@ class AnswerBot_Claude(AnswerBot):
 class AnswerBot_Azure_OpenAI(AnswerBot):
     '''Answers questions, using the provided messages for context.'''
 
-    def __init__(self, configuration, name='AnswerBot', max_response_len=3600, **kwargs):
+    def __init__(self, configuration, name='AnswerBot', max_response_len=3600, max_response_tokens=None, **kwargs):
         
         Base.__init__(self, name=name, **kwargs)
 
@@ -671,6 +1281,8 @@ class AnswerBot_Azure_OpenAI(AnswerBot):
                                     model=self.model,
                                     token_limit=self.token_limit,
                                     endpoint=self.endpoint,
+                                    transport=get_transport(self.configuration),
+                                    client_settings=self.configuration['azure_openai'],
                                     name='LLM-AzureOpenAI',
                                     deployment=self.deployment,)
         
@@ -678,6 +1290,8 @@ class AnswerBot_Azure_OpenAI(AnswerBot):
                                     model=self.embedding_model,
                                     token_limit=self.embedding_model_token_limit,
                                     endpoint=self.endpoint,
+                                    transport=get_transport(self.configuration),
+                                    client_settings=self.configuration['azure_openai'],
                                     name='embed-AzureOpenAI',
                                     deployment=self.embedding_deployment,)
         
@@ -693,83 +1307,5 @@ class AnswerBot_Azure_OpenAI(AnswerBot):
             {"role": "system", "content": instruction}
         ]
         self.max_response_len = max_response_len  # chars
-        self.max_context_len = self.LLM_chat.char_limit - self.header_len - self.max_response_len
+        self.init_window(max_response_tokens or max_response_len//4)
         self.print_window()
-        
-        
-    def mock_query(self, question, use_context=True, doc_name=True, max_context_len=None, savefile='./mock_query.txt',
-                   msg_cutoff=35):
-        '''Prepare to query the LLM, but don't actually send the request.
-        Instead, just save the preparred query to disk.'''
-
-        messages = self.background.copy()
-        if use_context:
-            context_content = self.construct_prompt(question, doc_name=doc_name, max_context_len=max_context_len)
-            messages.append({"role": "system", "content": context_content})
-
-        messages.append({"role": "user", "content": question})
-        self.msg(f'''Saving question ({len(question):,d} chars): "{question[:msg_cutoff]}"...''', 3, 2)
-        with open(savefile, 'w') as fout:
-            for message in messages:
-                fout.write(message['content'] + '\n\n')
-
-
-    def query_via_db(self, thread_id, use_conversation=True, use_context=True, doc_name=True, max_context_len=None,
-                     conversation_cutoff=20, msg_cutoff=35):
-        '''Answer user question by retrieving chunks, and doing a call to the LLM API.
-        This version operates through the database, both to identify the user query, and provide a reply.
-        '''
-
-        self.start_database()
-        last_message = self.db.get_last_thread_message(thread_id)
-        if last_message['who'] != 'user':
-            self.msg_error("Last message is from {last_message['who']} (should be 'user').")
-            return "[[Error: Last message is from {last_message['who']} (should be 'user')."
-
-        question = last_message['message_content']
-        messages = self.background.copy()
-
-        # Account for how much of the context window is consumed by the conversation history
-        max_context_len = max_context_len or self.max_context_len
-        if use_conversation:
-            thread = self.db.get_thread_messages(thread_id, cutoff=conversation_cutoff)
-            for item in thread:
-                max_context_len -= len(item['message_content'])
-
-        # Add retrieved context document chunks
-        if use_context:
-            if use_conversation:
-                # The context should be constructed not just using the user question (last typed message),
-                # but some of the chat history. However, if we use too much of the chat history to compute
-                # the embedding, then the older Q+A (which might now be irrelevant) will dominate the vector
-                # calculation.
-                if len(question) < 35:
-                    # This is a very short question, so it might be a follow-up (requires more conversation history).
-                    n = 5
-                elif len(question) > 500:
-                    # This is a detailed question. So probably it alone should determine the context lookup.
-                    n = 1
-                else:
-                    # By default, let's just have the last Q and A (plus current Q) in context.
-                    n = 3
-                question = ""
-                for item in thread[-n:]:
-                    question += f"{item['message_content']}\n"
-
-            context_content = self.construct_prompt(question, doc_name=doc_name, max_context_len=max_context_len)
-            messages.append({"role": "system", "content": context_content})
-
-        # Add conversation history (we put it after context, so that the conversation flows directly into bot completion)
-        if use_conversation:
-            for item in thread:
-                messages.append({"role": item['who'], "content": item['message_content']})
-        else:
-            messages.append({"role": "user", "content": question})
-
-        self.msg(f'''Asking question ({len(question):,d} chars): "{question[:msg_cutoff]}"...''', 3, 2)
-        response = self.LLM_chat.chat_completion(messages)
-        self.msg(f'''Received response ({len(response):,d} chars): "{response[:msg_cutoff]}"...''', 3, 2)
-        self.db.add_thread_message(thread_id, 'assistant', response)
-
-        return response
-        
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Filename: clients.py
+Author: Kevin G. Yager, Brookhaven National Laboratory
+Email: kyager@bnl.gov
+Date created: 2026-10-19
+Description:
+ Process-wide registry of LLM API clients. Bots are created often (e.g. per
+document), so rather than each building its own client (and repeating the
+TLS handshake and connection setup), clients are shared per (provider,
+endpoint, api_key, deployment). OpenAI/Azure clients use a tuned httpx
+connection pool (keep-alive, and HTTP/2 if the h2 package is installed).
+
+The provider section of the configuration can set:
+  timeout, max_retries : applied per client
+  max_connections, max_keepalive_connections, keepalive_expiry, http2 :
+    used when the (shared) connection pool is created
+"""
+
+import threading
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def http2_available():
+    try:
+        import h2
+        return True
+    except ImportError:
+        return False
+
+
+def make_http_client(settings):
+    '''An httpx client (connection pool) tuned for many concurrent, long-running requests.'''
+
+    import httpx
+
+    limits = httpx.Limits(
+        max_connections=settings.get('max_connections', 32),
+        max_keepalive_connections=settings.get('max_keepalive_connections', 16),
+        keepalive_expiry=settings.get('keepalive_expiry', 120.0),
+        )
+    timeout = httpx.Timeout(settings.get('timeout', 600.0), connect=settings.get('connect_timeout', 10.0))
+    http2 = settings.get('http2', True) and http2_available()
+
+    return httpx.Client(limits=limits, timeout=timeout, http2=http2)
+
+
+def create_client(provider, api_key, endpoint=None, deployment=None, settings=None):
+
+    settings = settings or {}
+
+    if provider=='openai':
+        from openai import OpenAI
+        return OpenAI(api_key=api_key, base_url=endpoint, http_client=make_http_client(settings))
+
+    elif provider=='azure_openai':
+        from openai import AzureOpenAI
+        return AzureOpenAI(
+            api_key=api_key,
+            api_version=settings.get('api_version', "2023-05-15"),
+            azure_endpoint=endpoint,
+            azure_deployment=deployment, # The configured service in our Azure portal
+            http_client=make_http_client(settings),
+            )
+
+    elif provider=='anthropic':
+        import anthropic
+        return anthropic.Client(api_key=api_key)
+
+    raise ValueError(f"Unknown LLM provider: {provider}")
+
+
+def get_client(provider, api_key, endpoint=None, deployment=None, settings=None):
+    '''The shared client for (provider, endpoint, api_key, deployment).
+    settings is typically the provider section of the configuration; its
+    timeout and max_retries are applied to the returned client (which still
+    shares the underlying connection pool).'''
+
+    settings = settings or {}
+
+    key = (provider, endpoint, api_key, deployment)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = create_client(provider, api_key, endpoint=endpoint, deployment=deployment, settings=settings)
+        client = _clients[key]
+
+    options = { k: settings[k] for k in ['timeout', 'max_retries'] if k in settings }
+    if options and provider in ['openai', 'azure_openai']:
+        client = client.with_options(**options)
+
+    return client
+
+
+def close_clients():
+    '''Close all the shared clients (and their connection pools).'''
+
+    with _clients_lock:
+        for client in _clients.values():
+            if hasattr(client, 'close'):
+                client.close()
+        _clients.clear()
@@ -12,6 +12,10 @@ stored.
 """
 
 from .Base import Base
+from .tracing import span
+from pathlib import Path
+from collections import OrderedDict
+import struct, zlib
 import mysql.connector
 import numpy as np
 
@@ -20,12 +24,29 @@ class DocumentDatabase(Base):
     # Basic MySQL interaction
     ##################################################
     
-    def __init__(self, config, name='dbase', **kwargs):
+    def __init__(self, config, name='dbase', chunk_storage='text', **kwargs):
         
         super().__init__(name=name, **kwargs)
         
         self.config = config
         
+        # How newly-created chunk tables store chunks:
+        #  'text' : each chunk's content is stored in the chunks table
+        #  'offsets' : the document plaintext is stored once (compressed), and
+        #    chunks are (start, end) offsets into it; chunks is then a view
+        # (For existing tables, the storage mode is detected from the database.)
+        self.chunk_storage = chunk_storage
+        self._chunk_offsets_tables = {}
+        self._num_tokens_tables = {}
+        self._message_embeddings = None
+        self._doc_years = None
+        self._lookup_masks = {} # lookup name : { clause : boolean mask }
+        self._doc_text_cache = OrderedDict()
+        self.doc_text_cache_size = 64
+        self._doc_excerpts = None
+        self._excerpt_cache = OrderedDict() # doc_id : [ (budget, num_tokens, text), ... ]
+        self.excerpt_cache_size = 256
+        
         self.msg(f"Connecting to MySQL database: {self.config['database']}")
         
         # Establish the connection
@@ -39,22 +60,26 @@ class DocumentDatabase(Base):
     
     def query(self, sql):
         
-        # Execute a query
-        self.cursor.execute(sql)
+        with span('db.query', sql=sql[:80]) as s:
+            # Execute a query
+            self.cursor.execute(sql)
 
-        # Fetch the results
-        rows = self.cursor.fetchall()
+            # Fetch the results
+            rows = self.cursor.fetchall()
+            s.set(rows=len(rows))
             
         return rows
 
 
     def query_values(self, sql, values):
         
-        # Execute a query
-        self.cursor.execute(sql, values)
+        with span('db.query', sql=sql[:80]) as s:
+            # Execute a query
+            self.cursor.execute(sql, values)
 
-        # Fetch the results
-        rows = self.cursor.fetchall()
+            # Fetch the results
+            rows = self.cursor.fetchall()
+            s.set(rows=len(rows))
             
         return rows
 
@@ -85,10 +110,16 @@ CREATE TABLE `documents` (
   `title` text CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
   `authors` text CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
   `doc_name` text NOT NULL,
-  `datetime_added` datetime NOT NULL
+  `datetime_added` datetime NOT NULL,
+  `pdf_hash` char(64) DEFAULT NULL,
+  `text_hash` char(64) DEFAULT NULL,
+  `minhash` blob,
+  `year` smallint DEFAULT NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 ALTER TABLE `documents`
-  ADD PRIMARY KEY (`doc_id`);
+  ADD PRIMARY KEY (`doc_id`),
+  ADD KEY `pdf_hash` (`pdf_hash`),
+  ADD KEY `text_hash` (`text_hash`);
 ALTER TABLE `documents`
   MODIFY `doc_id` int NOT NULL AUTO_INCREMENT;
 COMMIT;
@@ -97,12 +128,57 @@ COMMIT;
         self.cursor.execute(sql)
 
     def create_table_chunks(self, table_suffix=''):
+        
+        if self.chunk_storage=='offsets':
+            self.create_table_chunk_offsets(table_suffix=table_suffix)
+            return
+        
         sql = f"""
 CREATE TABLE `chunks{table_suffix}` (
   `chunk_num` int NOT NULL,
   `doc_id` int NOT NULL,
-  `content` text NOT NULL
+  `content` text NOT NULL,
+  `num_tokens` int DEFAULT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;"""
+
+        self.cursor.execute(sql)
+
+    def create_table_chunk_offsets(self, table_suffix=''):
+        # The text is stored in the same format as MySQL COMPRESS(), so that
+        # the chunks view can slice it using UNCOMPRESS().
+        sql = f"""
+CREATE TABLE `doc_texts{table_suffix}` (
+  `doc_id` int NOT NULL,
+  `len_chars` int NOT NULL,
+  `text_compressed` longblob NOT NULL,
+  PRIMARY KEY (`doc_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;"""
+        self.cursor.execute(sql)
+
+        sql = f"""
+CREATE TABLE `chunk_offsets{table_suffix}` (
+  `doc_id` int NOT NULL,
+  `chunk_num` int NOT NULL,
+  `start` int NOT NULL,
+  `end` int NOT NULL,
+  `num_tokens` int DEFAULT NULL,
+  PRIMARY KEY (`doc_id`, `chunk_num`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;"""
+        self.cursor.execute(sql)
+
+        self.create_view_chunks(table_suffix=table_suffix)
+
+    def create_view_chunks(self, table_suffix=''):
+        '''Compatibility view, so that SQL written against the chunks table
+        (chunk_num, doc_id, content) keeps working in offsets mode.'''
+        sql = f"""
+CREATE OR REPLACE VIEW `chunks{table_suffix}` AS
+SELECT o.chunk_num, o.doc_id,
+  SUBSTRING(CONVERT(UNCOMPRESS(t.text_compressed) USING utf8mb4), o.start+1, o.end-o.start) AS content,
+  o.num_tokens
+FROM `chunk_offsets{table_suffix}` AS o
+INNER JOIN `doc_texts{table_suffix}` AS t
+ON o.doc_id = t.doc_id;"""
 
         self.cursor.execute(sql)
 
@@ -124,7 +200,9 @@ CREATE TABLE `images{table_suffix}` (
   `file_path` text NOT NULL,
   `file_name` text NOT NULL,
   `embedding_model` text NOT NULL,
-  `embedding_vector` blob
+  `embedding_vector` blob,
+  `content_hash` char(64) DEFAULT NULL,
+  KEY `content_hash` (`content_hash`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;"""
 
         self.cursor.execute(sql)
@@ -142,7 +220,161 @@ CREATE TABLE `figures{table_suffix}` (
   `embedding_vector` blob
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;"""
 
-        self.cursor.execute(sql)        
+        self.cursor.execute(sql)
+
+    def create_table_ingest_journal(self):
+        sql = """
+CREATE TABLE IF NOT EXISTS `ingest_journal` (
+  `doc_key` varchar(255) NOT NULL,
+  `stage` varchar(32) NOT NULL,
+  `status` varchar(16) NOT NULL,
+  `input_hash` char(64) DEFAULT NULL,
+  `message` text,
+  `datetime_updated` datetime NOT NULL,
+  PRIMARY KEY (`doc_key`, `stage`),
+  KEY `stage_status` (`stage`, `status`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;"""
+
+        self.cursor.execute(sql)
+
+
+    def create_table_scores_pairwise(self):
+        sql = """
+CREATE TABLE IF NOT EXISTS `scores_pairwise` (
+  `score_id` int NOT NULL AUTO_INCREMENT,
+  `doc_id_A` int NOT NULL,
+  `doc_id_B` int NOT NULL,
+  `winner` int NOT NULL,
+  `text_assessment` text CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
+  PRIMARY KEY (`score_id`),
+  KEY `pair` (`doc_id_A`, `doc_id_B`),
+  KEY `pair_reversed` (`doc_id_B`, `doc_id_A`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;"""
+
+        self.cursor.execute(sql)
+
+
+    def create_table_doc_excerpts(self):
+        sql = """
+CREATE TABLE IF NOT EXISTS `doc_excerpts` (
+  `doc_id` int NOT NULL,
+  `budget` int NOT NULL,
+  `num_tokens` int NOT NULL,
+  `len_chars` int NOT NULL,
+  `text_compressed` mediumblob NOT NULL,
+  PRIMARY KEY (`doc_id`, `budget`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;"""
+
+        self.cursor.execute(sql)
+        
+        self._doc_excerpts = True
+
+
+    def create_table_rankings(self):
+        sql = """
+CREATE TABLE IF NOT EXISTS `rankings` (
+  `run_id` varchar(64) NOT NULL,
+  `doc_id` int NOT NULL,
+  `rank` int NOT NULL,
+  `score` double DEFAULT NULL,
+  `uncertainty` double DEFAULT NULL,
+  `datetime_added` datetime NOT NULL,
+  PRIMARY KEY (`run_id`, `doc_id`),
+  KEY `run_rank` (`run_id`, `rank`),
+  KEY `datetime_added` (`datetime_added`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;"""
+
+        self.cursor.execute(sql)
+
+
+    def create_table_answer_cache(self):
+        sql = """
+CREATE TABLE IF NOT EXISTS `answer_cache` (
+  `cache_id` int NOT NULL AUTO_INCREMENT,
+  `model` varchar(128) NOT NULL,
+  `corpus_generation` char(16) NOT NULL,
+  `question` text NOT NULL,
+  `vector` blob NOT NULL,
+  `context_hash` char(64) DEFAULT NULL,
+  `answer` mediumtext NOT NULL,
+  `hits` int NOT NULL DEFAULT 0,
+  `datetime_added` datetime NOT NULL,
+  `datetime_used` datetime NOT NULL,
+  PRIMARY KEY (`cache_id`),
+  KEY `model_generation` (`model`, `corpus_generation`),
+  KEY `datetime_used` (`datetime_used`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;"""
+        self.cursor.execute(sql)
+
+        sql = """
+CREATE TABLE IF NOT EXISTS `answer_cache_stats` (
+  `stat` varchar(32) NOT NULL,
+  `value` bigint NOT NULL DEFAULT 0,
+  PRIMARY KEY (`stat`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;"""
+        self.cursor.execute(sql)
+
+
+    def add_content_hash_columns(self, table_suffix=''):
+        '''Upgrade tables created before content hashing was introduced.'''
+
+        sql = """
+ALTER TABLE `documents`
+  ADD COLUMN `pdf_hash` char(64) DEFAULT NULL,
+  ADD COLUMN `text_hash` char(64) DEFAULT NULL,
+  ADD COLUMN `minhash` blob,
+  ADD KEY `pdf_hash` (`pdf_hash`),
+  ADD KEY `text_hash` (`text_hash`);"""
+        self.cursor.execute(sql)
+
+        sql = f"""
+ALTER TABLE `images{table_suffix}`
+  ADD COLUMN `content_hash` char(64) DEFAULT NULL,
+  ADD KEY `content_hash` (`content_hash`);"""
+        self.cursor.execute(sql)
+
+
+    def add_num_tokens_column(self, table_suffix=''):
+        '''Upgrade chunk tables created before token counts were stored.'''
+
+        if self.uses_chunk_offsets(table_suffix):
+            self.cursor.execute(f"ALTER TABLE `chunk_offsets{table_suffix}` ADD COLUMN `num_tokens` int DEFAULT NULL;")
+            self.create_view_chunks(table_suffix=table_suffix)
+        else:
+            self.cursor.execute(f"ALTER TABLE `chunks{table_suffix}` ADD COLUMN `num_tokens` int DEFAULT NULL;")
+
+        self._num_tokens_tables[table_suffix] = True
+
+
+    def add_message_embedding_columns(self):
+        '''Upgrade the messages table, so that each message's embedding can be stored.'''
+
+        sql = """
+ALTER TABLE `messages`
+  ADD COLUMN `embedding_model` varchar(128) DEFAULT NULL,
+  ADD COLUMN `embedding_vector` blob;"""
+        self.cursor.execute(sql)
+        
+        self._message_embeddings = True
+
+
+    def add_year_column(self):
+        '''Upgrade the documents table, so that the publication year can be stored.'''
+
+        self.cursor.execute("ALTER TABLE `documents` ADD COLUMN `year` smallint DEFAULT NULL;")
+
+        self._doc_years = True
+
+
+    def add_scores_pairwise_indexes(self):
+        '''Upgrade the scores_pairwise table, so that a pair can be looked up
+        (in either order) without a full scan.'''
+
+        sql = """
+ALTER TABLE `scores_pairwise`
+  ADD KEY `pair` (`doc_id_A`, `doc_id_B`),
+  ADD KEY `pair_reversed` (`doc_id_B`, `doc_id_A`);"""
+        self.cursor.execute(sql)
 
 
     # Documents
@@ -191,9 +423,9 @@ CREATE TABLE `figures{table_suffix}` (
 
     def add_doc(self, infile, md):
         
-        sql = "INSERT INTO documents (file_path, file_name, len_chars, title, authors, doc_name, datetime_added) VALUES (%s, %s, %s, %s, %s, %s, now())"
+        sql = "INSERT INTO documents (file_path, file_name, len_chars, title, authors, doc_name, datetime_added, pdf_hash, text_hash) VALUES (%s, %s, %s, %s, %s, %s, now(), %s, %s)"
         doc_name = self.make_doc_name(md)
-        values = (infile, infile.name, md['len_xml_chars'], md['title'], md['authors'], doc_name)
+        values = (str(infile), Path(infile).name, md['len_xml_chars'], md['title'], md['authors'], doc_name, md.get('pdf_hash'), md.get('text_hash'))
         self.cursor.execute(sql, values)
         self.connection.commit()
         
@@ -217,6 +449,91 @@ CREATE TABLE `figures{table_suffix}` (
         return int(rows[0]['doc_id'])
         
         
+    def find_doc_id(self, name):
+        '''Like get_doc_id, but returns None (rather than warning) when the document is not yet in the database.'''
+        
+        sql = """SELECT doc_id FROM documents WHERE file_name=%s;"""
+        
+        rows = self.query_values(sql, (name, ))
+        
+        return int(rows[0]['doc_id']) if len(rows)>0 else None
+        
+        
+    def find_doc_by_hash(self, pdf_hash=None, text_hash=None, exclude_name=None):
+        '''Return the (first) document with identical content, or None.
+        A document can be excluded by file_name (i.e. we don't match a document
+        against itself when re-ingesting it).'''
+        
+        if pdf_hash is not None:
+            sql = """SELECT doc_id, file_name FROM documents WHERE pdf_hash=%s ORDER BY doc_id;"""
+            rows = self.query_values(sql, (pdf_hash, ))
+        elif text_hash is not None:
+            sql = """SELECT doc_id, file_name FROM documents WHERE text_hash=%s ORDER BY doc_id;"""
+            rows = self.query_values(sql, (text_hash, ))
+        else:
+            return None
+        
+        rows = [row for row in rows if row['file_name']!=exclude_name]
+        
+        return rows[0] if len(rows)>0 else None
+        
+        
+    def get_doc_hashes(self):
+        
+        sql = """SELECT doc_id, file_name, pdf_hash, text_hash FROM documents ORDER BY doc_id;"""
+        
+        return self.query(sql)
+        
+        
+    def set_doc_hashes(self, doc_id, pdf_hash=None, text_hash=None):
+        
+        if pdf_hash is not None:
+            sql = """UPDATE documents SET pdf_hash = %s WHERE doc_id = %s ;"""
+            self.cursor.execute(sql, (pdf_hash, doc_id))
+        if text_hash is not None:
+            sql = """UPDATE documents SET text_hash = %s WHERE doc_id = %s ;"""
+            self.cursor.execute(sql, (text_hash, doc_id))
+        
+        self.connection.commit()
+        
+        
+    def set_doc_minhash(self, doc_id, signature):
+        '''Store the MinHash signature of a document (None clears it).'''
+        
+        sql = """UPDATE documents SET minhash = %s WHERE doc_id = %s ;"""
+        values = (None if signature is None else np.asarray(signature, dtype=np.uint64).tobytes(), doc_id)
+        
+        self.cursor.execute(sql, values)
+        self.connection.commit()
+        
+        
+    def has_doc_years(self):
+        '''Whether the documents table stores publication years.'''
+
+        if self._doc_years is None:
+            rows = self.query_values("SHOW COLUMNS FROM `documents` LIKE %s", ('year', ))
+            self._doc_years = len(rows)>0
+
+        return self._doc_years
+
+
+    def set_doc_year(self, doc_id, year):
+
+        sql = """UPDATE documents SET year = %s WHERE doc_id = %s ;"""
+
+        self.cursor.execute(sql, (year, doc_id))
+        self.connection.commit()
+
+
+    def get_doc_minhashes(self):
+        
+        sql = """SELECT doc_id, minhash FROM documents WHERE minhash IS NOT NULL ORDER BY doc_id;"""
+        
+        rows = self.query(sql)
+        
+        return { row['doc_id']: np.frombuffer(row['minhash'], dtype=np.uint64) for row in rows }
+        
+        
     def get_pdf_path(self, doc_id):
         
         sql = f"""SELECT pdf_file FROM documents WHERE doc_id={doc_id};"""
@@ -235,9 +552,61 @@ CREATE TABLE `figures{table_suffix}` (
         
         self.cursor.execute(sql, values)
         self.connection.commit()
-    
-    
-        
+
+
+
+    # Ingestion journal
+    ##################################################
+    # The journal records, for each document (doc_key) and ingestion stage,
+    # whether that stage is done, and for which version of the input (input_hash).
+
+    def get_journal(self, stage):
+
+        sql = "SELECT * FROM ingest_journal WHERE stage=%s"
+        values = (stage, )
+
+        rows = self.query_values(sql, values)
+
+        return { row['doc_key']: row for row in rows }
+
+
+    def set_journal(self, doc_key, stage, status, input_hash=None, message=None):
+
+        sql = """INSERT INTO ingest_journal (doc_key, stage, status, input_hash, message, datetime_updated) VALUES (%s, %s, %s, %s, %s, NOW())
+ON DUPLICATE KEY UPDATE status=VALUES(status), input_hash=VALUES(input_hash), message=VALUES(message), datetime_updated=VALUES(datetime_updated)"""
+        values = (doc_key, stage, status, input_hash, message)
+
+        self.cursor.execute(sql, values)
+        self.connection.commit()
+
+
+    def get_journal_pending(self, stage, inputs):
+        '''Of the candidate documents (inputs is a dict of doc_key:input_hash),
+        return the doc_keys for which this stage is not yet done (or was done
+        for a different version of the input).'''
+
+        journal = self.get_journal(stage)
+
+        pending = []
+        for doc_key, input_hash in inputs.items():
+            row = journal.get(doc_key)
+            if row is None or row['status'] not in ['done', 'duplicate'] or row['input_hash']!=input_hash:
+                pending.append(doc_key)
+
+        return pending
+
+
+    def get_journal_done(self, stage):
+
+        sql = "SELECT doc_key, input_hash FROM ingest_journal WHERE stage=%s AND status='done'"
+        values = (stage, )
+
+        rows = self.query_values(sql, values)
+
+        return { row['doc_key']: row['input_hash'] for row in rows }
+
+
+
     # Chunks
     ##################################################
         
@@ -250,34 +619,338 @@ CREATE TABLE `figures{table_suffix}` (
         return len(rows)>0
     
         
-    def add_chunk(self, doc_id, chunk_num, chunk, table_suffix=''):
+    def add_chunk(self, doc_id, chunk_num, chunk, table_suffix='', num_tokens=None):
         
-        sql = "INSERT INTO chunks{} (chunk_num, doc_id, content) VALUES (%s, %s, %s)".format(table_suffix)
-        values = (chunk_num, doc_id, chunk)
+        if num_tokens is not None and self.has_num_tokens(table_suffix):
+            sql = "INSERT INTO chunks{} (chunk_num, doc_id, content, num_tokens) VALUES (%s, %s, %s, %s)".format(table_suffix)
+            values = (chunk_num, doc_id, chunk, num_tokens)
+        else:
+            sql = "INSERT INTO chunks{} (chunk_num, doc_id, content) VALUES (%s, %s, %s)".format(table_suffix)
+            values = (chunk_num, doc_id, chunk)
 
         self.cursor.execute(sql, values)
         
         
         
-    def add_chunks(self, doc_id, chunks, table_suffix='', md={}):
+    def add_chunks(self, doc_id, chunks, table_suffix='', md={}, num_tokens=None):
+        '''Add the chunks for a document. num_tokens (optional) is the list of
+        token counts for the chunks.'''
+        
+        if self.uses_chunk_offsets(table_suffix):
+            self.add_chunks_offsets(doc_id, chunks, table_suffix=table_suffix, num_tokens=num_tokens)
+            return
         
         for i, chunk in enumerate(chunks):
-            self.add_chunk(doc_id, i+1, chunk, table_suffix=table_suffix)
+            self.add_chunk(doc_id, i+1, chunk, table_suffix=table_suffix, num_tokens=None if num_tokens is None else num_tokens[i])
             
         self.connection.commit()
         
         self.msg(f"Added {len(chunks):,d} chunks (doc_id={doc_id})", 5, 2)
+        
+        
+    # Chunks (stored as offsets)
+    ##################################################
+    def uses_chunk_offsets(self, table_suffix=''):
+        '''Whether chunks for this table_suffix are stored as offsets. This is
+        detected from the database (so readers need not be configured).'''
+        
+        if table_suffix not in self._chunk_offsets_tables:
+            rows = self.query_values("SHOW TABLES LIKE %s", (f'chunk_offsets{table_suffix}', ))
+            self._chunk_offsets_tables[table_suffix] = len(rows)>0
+            
+        return self._chunk_offsets_tables[table_suffix]
+    
+    
+    def chunks_to_offsets(self, chunks):
+        '''Reconstruct the full text from a list of overlapping chunks, and
+        the (start, end) offsets of each chunk within it. Each chunk is placed
+        at the largest overlap with the preceding text, so that
+        text[start:end]==chunk always holds.'''
+        
+        text = ''
+        offsets = []
+        for chunk in chunks:
+            overlap = 0
+            for k in range(min(len(text), len(chunk)), 0, -1):
+                if text.endswith(chunk[:k]):
+                    overlap = k
+                    break
+            start = len(text) - overlap
+            text += chunk[overlap:]
+            offsets.append( (start, start+len(chunk)) )
             
+        return text, offsets
+    
+    
+    def compress_text(self, text):
+        '''Compress text using the same format as MySQL's COMPRESS():
+        the uncompressed length (4 bytes, little-endian), followed by zlib data.'''
         
-    def get_chunks_list(self, table_suffix=''):
+        if len(text)==0:
+            return b''
+        data = text.encode('utf-8')
         
-        sql = f"""SELECT doc_id, chunk_num FROM chunks{table_suffix} ;"""
+        return struct.pack('<I', len(data)) + zlib.compress(data)
+    
+    
+    def decompress_text(self, blob):
         
-        rows = self.query(sql)
+        if len(blob)==0:
+            return ''
+        
+        return zlib.decompress(blob[4:]).decode('utf-8')
+    
+    
+    def add_chunks_offsets(self, doc_id, chunks, table_suffix='', num_tokens=None):
+        
+        text, offsets = self.chunks_to_offsets(chunks)
+        
+        sql = f"INSERT INTO doc_texts{table_suffix} (doc_id, len_chars, text_compressed) VALUES (%s, %s, %s)"
+        values = (doc_id, len(text), self.compress_text(text))
+        self.cursor.execute(sql, values)
+        
+        if num_tokens is not None and self.has_num_tokens(table_suffix):
+            sql = f"INSERT INTO chunk_offsets{table_suffix} (doc_id, chunk_num, start, end, num_tokens) VALUES (%s, %s, %s, %s, %s)"
+            values = [ (doc_id, i+1, start, end, num_tokens[i]) for i, (start, end) in enumerate(offsets) ]
+        else:
+            sql = f"INSERT INTO chunk_offsets{table_suffix} (doc_id, chunk_num, start, end) VALUES (%s, %s, %s, %s)"
+            values = [ (doc_id, i+1, start, end) for i, (start, end) in enumerate(offsets) ]
+        self.cursor.executemany(sql, values)
+        
+        self.connection.commit()
+        
+        self._doc_text_cache.pop( (table_suffix, doc_id), None )
+        
+        num_chars = sum(len(chunk) for chunk in chunks)
+        self.msg(f"Added {len(chunks):,d} chunks as offsets (doc_id={doc_id}; {len(text):,d} chars instead of {num_chars:,d})", 5, 2)
+        
+        
+    def get_doc_text(self, doc_id, table_suffix=''):
+        '''Full plaintext of a document (offsets mode), with a small LRU cache,
+        since consecutive reads tend to hit the same documents.'''
+        
+        key = (table_suffix, doc_id)
+        if key in self._doc_text_cache:
+            self._doc_text_cache.move_to_end(key)
+            return self._doc_text_cache[key]
+        
+        sql = f"""SELECT text_compressed FROM doc_texts{table_suffix} WHERE doc_id=%s ;"""
+        rows = self.query_values(sql, (doc_id, ))
+        
+        text = self.decompress_text(rows[0]['text_compressed']) if len(rows)>0 else ''
+        
+        self._doc_text_cache[key] = text
+        if len(self._doc_text_cache)>self.doc_text_cache_size:
+            self._doc_text_cache.popitem(last=False)
+        
+        return text
+    
+    
+    def get_doc_texts(self, doc_ids, table_suffix=''):
+        '''Load the plaintext of several documents into the cache, in one query.'''
+        
+        missing = sorted(set( doc_id for doc_id in doc_ids if (table_suffix, doc_id) not in self._doc_text_cache ))
+        if len(missing)>0:
+            placeholders = ', '.join(['%s']*len(missing))
+            sql = f"""SELECT doc_id, text_compressed FROM doc_texts{table_suffix} WHERE doc_id IN ({placeholders}) ;"""
+            for row in self.query_values(sql, missing):
+                self._doc_text_cache[(table_suffix, row['doc_id'])] = self.decompress_text(row['text_compressed'])
+            while len(self._doc_text_cache)>max(self.doc_text_cache_size, len(missing)):
+                self._doc_text_cache.popitem(last=False)
+        
+        return { doc_id: self.get_doc_text(doc_id, table_suffix=table_suffix) for doc_id in doc_ids }
+    
+    
+    # Document excerpts
+    ##################################################
+    def has_doc_excerpts(self):
+        '''Whether the doc_excerpts table exists.'''
+        
+        if self._doc_excerpts is None:
+            self._doc_excerpts = len(self.query_values("SHOW TABLES LIKE %s", ('doc_excerpts', )))>0
+            
+        return self._doc_excerpts
+    
+    
+    def set_doc_excerpts(self, doc_id, excerpts):
+        '''Store the excerpts of a document (replacing any earlier ones); excerpts
+        are (budget, num_tokens, text).'''
+        
+        self.cursor.execute("DELETE FROM doc_excerpts WHERE doc_id=%s", (doc_id, ))
+        
+        sql = "INSERT INTO doc_excerpts (doc_id, budget, num_tokens, len_chars, text_compressed) VALUES (%s, %s, %s, %s, %s)"
+        values = [ (doc_id, budget, num_tokens, len(text), self.compress_text(text)) for budget, num_tokens, text in excerpts ]
+        self.cursor.executemany(sql, values)
+        
+        self.connection.commit()
+        
+        self._excerpt_cache.pop(doc_id, None)
+        
+        
+    def get_doc_excerpts(self, doc_id):
+        '''The stored excerpts of a document, as a list of (budget, num_tokens,
+        text), smallest first (empty if there are none). Uses an LRU cache.'''
+        
+        if doc_id in self._excerpt_cache:
+            self._excerpt_cache.move_to_end(doc_id)
+            return self._excerpt_cache[doc_id]
+        
+        self.load_doc_excerpts([doc_id])
+        
+        return self._excerpt_cache.get(doc_id, [])
+    
+    
+    def load_doc_excerpts(self, doc_ids):
+        '''Load the excerpts of several documents into the cache, in one query.'''
+        
+        missing = sorted(set( int(doc_id) for doc_id in doc_ids if doc_id not in self._excerpt_cache ))
+        if len(missing)==0 or not self.has_doc_excerpts():
+            return
+        
+        placeholders = ', '.join(['%s']*len(missing))
+        sql = f"""SELECT doc_id, budget, num_tokens, text_compressed FROM doc_excerpts WHERE doc_id IN ({placeholders}) ORDER BY doc_id, budget ;"""
+        excerpts = { doc_id: [] for doc_id in missing }
+        for row in self.query_values(sql, missing):
+            excerpts[row['doc_id']].append( (row['budget'], row['num_tokens'], self.decompress_text(row['text_compressed'])) )
+        
+        for doc_id, items in excerpts.items():
+            if len(items)>0:
+                self._excerpt_cache[doc_id] = items
+        while len(self._excerpt_cache)>max(self.excerpt_cache_size, len(missing)):
+            self._excerpt_cache.popitem(last=False)
+    
+    
+    def get_chunk_offsets(self, doc_id, chunk_num, table_suffix=''):
+        
+        sql = f"""
+SELECT o.*, d.doc_name FROM chunk_offsets{table_suffix} AS o
+INNER JOIN documents AS d
+ON o.doc_id = d.doc_id
+WHERE o.doc_id=%s AND o.chunk_num=%s ;"""
+        
+        rows = self.query_values(sql, (doc_id, chunk_num))
+        
+        if len(rows)!=1:
+            self.msg_warning(f"{len(rows)} chunk_offsets{table_suffix} matches for doc_id={doc_id} chunk #{chunk_num:,d}")
+        
+        row = rows[0]
+        row['content'] = self.get_doc_text(doc_id, table_suffix=table_suffix)[row['start']:row['end']]
+        
+        return row
+    
+    
+    def convert_chunks_to_offsets(self, table_suffix=''):
+        '''Migrate an existing chunks table to offset storage. The original
+        table is kept (renamed to chunks{table_suffix}_text).'''
+        
+        if self.uses_chunk_offsets(table_suffix):
+            self.msg(f"chunks{table_suffix} already stored as offsets", 3, 1)
+            return
+        
+        rows = self.query(f"""SELECT * FROM chunks{table_suffix} ORDER BY doc_id, chunk_num ASC;""")
+        
+        self.cursor.execute(f"RENAME TABLE `chunks{table_suffix}` TO `chunks{table_suffix}_text`")
+        self.create_table_chunk_offsets(table_suffix=table_suffix)
+        self._chunk_offsets_tables[table_suffix] = True
+        
+        doc_chunks = OrderedDict()
+        doc_num_tokens = {}
+        for row in rows:
+            doc_chunks.setdefault(row['doc_id'], []).append(row['content'])
+            doc_num_tokens.setdefault(row['doc_id'], []).append(row.get('num_tokens'))
+        for doc_id, chunks in doc_chunks.items():
+            num_tokens = doc_num_tokens[doc_id]
+            if None in num_tokens:
+                num_tokens = None
+            self.add_chunks_offsets(doc_id, chunks, table_suffix=table_suffix, num_tokens=num_tokens)
+        
+        self.msg(f"Converted {len(rows):,d} chunks ({len(doc_chunks):,d} documents) to offsets", 3, 1)
+            
+        
+    def get_chunks_list(self, table_suffix='', doc_id=None):
+        
+        if doc_id is None:
+            sql = f"""SELECT doc_id, chunk_num FROM chunks{table_suffix} ;"""
+            rows = self.query(sql)
+        else:
+            sql = f"""SELECT doc_id, chunk_num FROM chunks{table_suffix} WHERE doc_id=%s ;"""
+            rows = self.query_values(sql, (doc_id, ))
         
         return rows
         
         
+    def get_chunk_doc_ids(self, table_suffix=''):
+        '''The doc_ids that have chunks (in this table_suffix).'''
+        
+        sql = f"""SELECT DISTINCT doc_id FROM chunks{table_suffix} ORDER BY doc_id ;"""
+        
+        return [ row['doc_id'] for row in self.query(sql) ]
+        
+        
+    def get_doc_chunks(self, doc_id, table_suffix=''):
+        '''All the chunks of a document, in order.'''
+        
+        if self.uses_chunk_offsets(table_suffix):
+            text = self.get_doc_text(doc_id, table_suffix=table_suffix)
+            sql = f"""SELECT * FROM chunk_offsets{table_suffix} WHERE doc_id=%s ORDER BY chunk_num ASC;"""
+            rows = self.query_values(sql, (doc_id, ))
+            for row in rows:
+                row['content'] = text[row['start']:row['end']]
+            return rows
+        
+        sql = f"""SELECT * FROM chunks{table_suffix} WHERE doc_id=%s ORDER BY chunk_num ASC;"""
+        
+        return self.query_values(sql, (doc_id, ))
+        
+        
+    # Chunk token counts
+    ##################################################
+    def has_num_tokens(self, table_suffix=''):
+        '''Whether the chunks for this table_suffix store token counts.'''
+        
+        if table_suffix not in self._num_tokens_tables:
+            rows = self.query_values(f"SHOW COLUMNS FROM `chunks{table_suffix}` LIKE %s", ('num_tokens', ))
+            self._num_tokens_tables[table_suffix] = len(rows)>0
+            
+        return self._num_tokens_tables[table_suffix]
+    
+    
+    def get_docs_missing_num_tokens(self, table_suffix=''):
+        
+        sql = f"""SELECT DISTINCT doc_id FROM chunks{table_suffix} WHERE num_tokens IS NULL ;"""
+        
+        return [ row['doc_id'] for row in self.query(sql) ]
+    
+    
+    def set_chunk_num_tokens(self, doc_id, num_tokens, table_suffix=''):
+        '''Store token counts; num_tokens is a dict of chunk_num:count.'''
+        
+        table = f'chunk_offsets{table_suffix}' if self.uses_chunk_offsets(table_suffix) else f'chunks{table_suffix}'
+        sql = f"""UPDATE {table} SET num_tokens=%s WHERE doc_id=%s AND chunk_num=%s ;"""
+        values = [ (count, doc_id, chunk_num) for chunk_num, count in num_tokens.items() ]
+        self.cursor.executemany(sql, values)
+        
+        self.connection.commit()
+        
+        
+    def delete_chunks(self, doc_id, table_suffix=''):
+        '''Remove the chunks (and their embeddings) for a document, so that it can be re-ingested.'''
+        
+        if self.uses_chunk_offsets(table_suffix):
+            sql = f"""DELETE FROM chunk_offsets{table_suffix} WHERE doc_id=%s ;"""
+            self.cursor.execute(sql, (doc_id, ))
+            sql = f"""DELETE FROM doc_texts{table_suffix} WHERE doc_id=%s ;"""
+            self.cursor.execute(sql, (doc_id, ))
+            self._doc_text_cache.pop( (table_suffix, doc_id), None )
+        else:
+            sql = f"""DELETE FROM chunks{table_suffix} WHERE doc_id=%s ;"""
+            self.cursor.execute(sql, (doc_id, ))
+        sql = f"""DELETE FROM embeddings{table_suffix} WHERE doc_id=%s ;"""
+        self.cursor.execute(sql, (doc_id, ))
+        
+        self.connection.commit()
+        
+        
     def get_chunk_only(self, doc_id, chunk_num, table_suffix=''):
         sql = f"""SELECT * FROM chunks{table_suffix} WHERE doc_id='{doc_id}' AND chunk_num='{chunk_num}' ;"""
         
@@ -290,8 +963,14 @@ CREATE TABLE `figures{table_suffix}` (
         
         
     def get_chunk(self, doc_id, chunk_num, table_suffix=''):
+        
+        if self.uses_chunk_offsets(table_suffix):
+            # Slice the (cached) document text directly, rather than having
+            # the view decompress the document for every chunk
+            return self.get_chunk_offsets(doc_id, chunk_num, table_suffix=table_suffix)
+        
         sql = f"""
-SELECT c.doc_id, c.chunk_num, c.content, d.doc_name FROM chunks{table_suffix} AS c
+SELECT c.*, d.doc_name FROM chunks{table_suffix} AS c
 INNER JOIN documents AS d
 ON c.doc_id = d.doc_id
 WHERE c.doc_id='{doc_id}' AND c.chunk_num='{chunk_num}' 
@@ -303,6 +982,33 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
             self.msg_warning(f"{len(rows)} chunk{table_suffix} matches for doc_id={doc_id} chunk #{chunk_num:,d}")
             
         return rows[0]
+    
+    
+    def get_chunks(self, chunks, table_suffix=''):
+        '''Fetch many chunks in one query. chunks is a list of (doc_id, chunk_num);
+        returns a dict of (doc_id, chunk_num):row.'''
+        
+        if len(chunks)==0:
+            return {}
+        
+        offsets = self.uses_chunk_offsets(table_suffix)
+        table = f'chunk_offsets{table_suffix}' if offsets else f'chunks{table_suffix}'
+        placeholders = ', '.join(['(%s, %s)']*len(chunks))
+        sql = f"""
+SELECT c.*, d.doc_name FROM {table} AS c
+INNER JOIN documents AS d
+ON c.doc_id = d.doc_id
+WHERE (c.doc_id, c.chunk_num) IN ({placeholders}) ;"""
+        values = [ int(value) for chunk in chunks for value in chunk ]
+        
+        rows = self.query_values(sql, values)
+        
+        if offsets:
+            texts = self.get_doc_texts([ row['doc_id'] for row in rows ], table_suffix=table_suffix)
+            for row in rows:
+                row['content'] = texts[row['doc_id']][row['start']:row['end']]
+        
+        return { (row['doc_id'], row['chunk_num']): row for row in rows }
         
         
         
@@ -346,13 +1052,22 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
     
     def generate_embedding_lookup_table(self, model='text-embedding-ada-002', table_suffix=''):
         
-        sql = f"""SELECT * FROM embeddings{table_suffix} WHERE model='{model}' ORDER BY doc_id, chunk_num ASC"""
+        if self.has_num_tokens(table_suffix):
+            # Include the chunk token counts, so that prompts can be packed without fetching every candidate chunk
+            sql = f"""
+SELECT e.*, c.num_tokens FROM embeddings{table_suffix} AS e
+LEFT JOIN chunks{table_suffix} AS c
+ON e.doc_id = c.doc_id AND e.chunk_num = c.chunk_num
+WHERE e.model='{model}' ORDER BY e.doc_id, e.chunk_num ASC"""
+        else:
+            sql = f"""SELECT * FROM embeddings{table_suffix} WHERE model='{model}' ORDER BY doc_id, chunk_num ASC"""
         
         rows = self.query(sql)
 
         doc_ids = []
         chunk_nums = []
         vectors = []
+        num_tokens = []
         for row in rows:
             byte_array = row['vector']
             vector = np.frombuffer(byte_array)
@@ -360,15 +1075,19 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
             doc_ids.append(row['doc_id'])
             chunk_nums.append(row['chunk_num'])
             vectors.append(vector)
+            num_tokens.append( -1 if row.get('num_tokens') is None else row['num_tokens'] ) # -1 : unknown
             
         doc_ids = np.asarray(doc_ids)
         chunk_nums = np.asarray(chunk_nums)
         vectors = np.asarray(vectors)
+        num_tokens = np.asarray(num_tokens, dtype=int)
         
         table_suffix = np.repeat(table_suffix, len(doc_ids))
+        years, classes = self.doc_metadata(doc_ids)
         
-        results = { 'table_suffix':table_suffix, 'doc_ids': doc_ids, 'chunk_nums': chunk_nums, 'vectors': vectors }
+        results = { 'table_suffix':table_suffix, 'doc_ids': doc_ids, 'chunk_nums': chunk_nums, 'vectors': vectors, 'num_tokens': num_tokens, 'years': years, 'classes': classes }
         self.embeddings = results
+        self.clear_masks('embeddings')
         
         return results
 
@@ -402,9 +1121,26 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
         '''Load the quick lookup file.'''
         
         data = np.load(infile, allow_pickle=True).item()
+        if 'num_tokens' not in data:
+            # Lookup file generated before token counts were stored
+            data['num_tokens'] = np.full(len(data['doc_ids']), -1, dtype=int)
+        self.fill_metadata(data, len(data['doc_ids']))
         self.embeddings = data
+        self.clear_masks('embeddings')
         #self.embeddings = { 'table_suffix': data['table_suffix'], 'doc_ids': data['doc_ids'], 'chunk_nums': data['chunk_nums'], 'vectors': data['vectors'] }
         
+        
+    def lookup_generation(self):
+        '''Identifies the set of chunks in the loaded lookup (so that results
+        derived from an older corpus can be recognized).'''
+        
+        import hashlib
+        h = hashlib.sha256()
+        for key in ['table_suffix', 'doc_ids', 'chunk_nums']:
+            h.update(np.ascontiguousarray(self.embeddings[key]).astype(str).tobytes())
+            
+        return h.hexdigest()[:16]
+        
 
 
     # Find relevant chunks using embeddings
@@ -436,19 +1172,195 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
         return np.linalg.norm(x - y)
 
 
-    def order_chunks_by_similarity(self, vector):
+    def order_chunks_by_similarity(self, vector, filter=None):
         """
         Return the list of document chunks, sorted by relevance in descending order.
+        (Only the chunks matching the filter expression are considered.)
         """
         
-        #contexts: dict[(str, str), np.array]
-        contexts = zip( self.embeddings['table_suffix'], self.embeddings['doc_ids'], self.embeddings['chunk_nums'], self.embeddings['vectors'] )
+        similarities, order = self.chunk_similarities(vector, filter=filter)
+        lookup = self.embeddings
+        
+        return [ (similarities[idx], lookup['table_suffix'][idx], lookup['doc_ids'][idx], lookup['chunk_nums'][idx]) for idx in order ]
 
-        similarities = sorted([
-                (self.vector_similarity(vector, chunk_embedding), table_suffix, doc_id, chunk_num) for table_suffix, doc_id, chunk_num, chunk_embedding in contexts
-            ], reverse=True)
+
+    def chunk_similarities(self, vector, filter=None):
+        """
+        Return the similarity of every chunk in the lookup, and the indices
+        (into the lookup arrays) sorted by relevance in descending order.
+        With a filter expression, only the matching chunks are scored (the
+        others have similarity -inf, and are omitted from the order).
+        """
+        
+        vectors = self.embeddings['vectors']
+        vector = np.asarray(vector)
+        
+        mask = self.lookup_mask('embeddings', filter)
+        if mask is None:
+            with span('retrieval.vector', rows=len(vectors)):
+                similarities = np.dot(vectors, vector)/( np.linalg.norm(vectors, axis=1)*np.linalg.norm(vector) )
+                order = np.argsort(-similarities, kind='stable')
+            return similarities, order
         
-        return similarities
+        rows = np.flatnonzero(mask)
+        with span('retrieval.vector', rows=len(rows), filtered=True):
+            selected = vectors[rows]
+            similarities = np.full(len(vectors), -np.inf)
+            similarities[rows] = np.dot(selected, vector)/( np.linalg.norm(selected, axis=1)*np.linalg.norm(vector) )
+            order = rows[np.argsort(-similarities[rows], kind='stable')]
+        
+        return similarities, order
+
+
+
+    # Metadata filters
+    ##################################################
+    # Filter expressions restrict a search to some rows of a lookup. They can
+    # be given as a dict, e.g.:
+    #   {'year': '>=2020', 'class': 'self-assembly', 'doc_id': '!=12,15'}
+    # or as a string with the same clauses, separated by semicolons:
+    #   "year>=2020; class=self-assembly; doc_id!=12,15"
+    # A comma-separated (or list) value matches any of the values. The fields
+    # are doc_id, year, class, table_suffix (and fig_id/image_id for the
+    # figure/image lookups). Unknown years (-1) never satisfy a comparison.
+    # The boolean mask for each clause is computed once per loaded lookup.
+    filter_fields = {
+        'doc_id': 'doc_ids',
+        'year': 'years',
+        'class': 'classes',
+        'table_suffix': 'table_suffix',
+        'fig_id': 'fig_ids',
+        'image_id': 'image_ids',
+        }
+    filter_operators = ['>=', '<=', '!=', '==', '>', '<', '=']
+
+
+    def doc_metadata(self, doc_ids):
+        '''The publication year (-1 if unknown) and tool_classify result ('' if
+        none) for each of the doc_ids.'''
+
+        years, classes = {}, {}
+        unique = sorted(set(int(doc_id) for doc_id in doc_ids))
+        if len(unique)>0:
+            placeholders = ", ".join(["%s"]*len(unique))
+            if self.has_doc_years():
+                rows = self.query_values(f"SELECT doc_id, year FROM documents WHERE doc_id IN ({placeholders}) ;", tuple(unique))
+                years = { row['doc_id']: row['year'] for row in rows if row['year'] is not None }
+            if len(self.query_values("SHOW TABLES LIKE %s", ('tool_classify', )))>0:
+                rows = self.query_values(f"SELECT doc_id, result FROM tool_classify WHERE doc_id IN ({placeholders}) ;", tuple(unique))
+                classes = { row['doc_id']: str(row['result']) for row in rows }
+
+        years = np.asarray([ years.get(int(doc_id), -1) for doc_id in doc_ids ], dtype=int)
+        classes = np.asarray([ classes.get(int(doc_id), '') for doc_id in doc_ids ], dtype=object)
+
+        return years, classes
+
+
+    def fill_metadata(self, data, num_rows):
+        '''Lookup files generated before metadata was stored have unknown metadata.'''
+
+        if 'years' not in data:
+            data['years'] = np.full(num_rows, -1, dtype=int)
+        if 'classes' not in data:
+            data['classes'] = np.full(num_rows, '', dtype=object)
+
+
+    def clear_masks(self, name):
+        self._lookup_masks[name] = {}
+
+
+    def parse_filter(self, expression):
+        '''Convert a filter expression into a list of (field, operator, values) clauses.'''
+
+        if expression is None:
+            return []
+
+        if isinstance(expression, str):
+            items = []
+            for clause in expression.split(';'):
+                clause = clause.strip()
+                if clause=='':
+                    continue
+                for op in self.filter_operators:
+                    if op in clause:
+                        field, value = clause.split(op, 1)
+                        items.append( (field.strip(), op+value.strip()) )
+                        break
+                else:
+                    raise ValueError(f"Filter clause not understood: {clause}")
+        else:
+            items = list(expression.items())
+
+        clauses = []
+        for field, value in items:
+            if field not in self.filter_fields:
+                raise ValueError(f"Unknown filter field: {field}")
+
+            op = '='
+            if isinstance(value, str):
+                for candidate in self.filter_operators:
+                    if value.startswith(candidate):
+                        op, value = candidate, value[len(candidate):]
+                        break
+                values = [ v.strip() for v in value.split(',') ]
+            elif isinstance(value, (list, tuple, set, np.ndarray)):
+                values = list(value)
+            else:
+                values = [value]
+            op = '=' if op=='==' else op
+
+            if op not in ['=', '!='] and len(values)!=1:
+                raise ValueError(f"Filter {field}{op} needs a single value")
+            if field!='class' and field!='table_suffix':
+                values = [ int(v) for v in values ]
+
+            clauses.append( (field, op, tuple(values)) )
+
+        return clauses
+
+
+    def lookup_mask(self, name, expression):
+        '''The boolean mask of the rows of a lookup (self.embeddings,
+        self.figure_embeddings, or self.image_embeddings) that match the filter
+        expression; None if there is no filter.'''
+
+        clauses = self.parse_filter(expression)
+        if len(clauses)==0:
+            return None
+
+        lookup = getattr(self, name)
+        masks = self._lookup_masks.setdefault(name, {})
+
+        def value_mask(column, op, value):
+            key = (column, op, value)
+            if key not in masks:
+                if column not in lookup:
+                    raise ValueError(f"The {name} lookup has no '{column}' metadata")
+                array = lookup[column]
+                if op=='=':
+                    masks[key] = array==value
+                elif column=='years':
+                    # Comparisons never match unknown years
+                    masks[key] = (array>=0) & { '>': array>value, '>=': array>=value, '<': array<value, '<=': array<=value }[op]
+                else:
+                    masks[key] = { '>': array>value, '>=': array>=value, '<': array<value, '<=': array<=value }[op]
+            return masks[key]
+
+        mask = None
+        for field, op, values in clauses:
+            column = self.filter_fields[field]
+            if op in ['=', '!=']:
+                clause_mask = np.zeros(len(lookup['vectors']), dtype=bool)
+                for value in values:
+                    clause_mask |= value_mask(column, '=', value)
+                if op=='!=':
+                    clause_mask = ~clause_mask
+            else:
+                clause_mask = value_mask(column, op, values[0])
+
+            mask = clause_mask if mask is None else (mask & clause_mask)
+
+        return mask
 
 
 
@@ -479,6 +1391,14 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
         self.connection.commit()
 
 
+    def delete_figures(self, doc_id, table_suffix=''):
+        
+        sql = f"""DELETE FROM figures{table_suffix} WHERE doc_id=%s ;"""
+        
+        self.cursor.execute(sql, (doc_id, ))
+        self.connection.commit()
+
+
     def add_figure_w_embedding(self, doc_id, fig_num, fig_caption, file_path, file_name, model, vector, table_suffix=''):
         
         byte_array = np.asarray(vector).tobytes()
@@ -530,9 +1450,11 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
         vectors = np.asarray(vectors)
         
         table_suffix = np.repeat(table_suffix, len(fig_ids))
+        years, classes = self.doc_metadata(doc_ids)
         
-        results = { 'table_suffix':table_suffix, 'doc_ids': doc_ids, 'fig_ids': fig_ids, 'file_names': file_names, 'vectors': vectors }
+        results = { 'table_suffix':table_suffix, 'doc_ids': doc_ids, 'fig_ids': fig_ids, 'file_names': file_names, 'vectors': vectors, 'years': years, 'classes': classes }
         self.figure_embeddings = results
+        self.clear_masks('figure_embeddings')
         
         return results    
     
@@ -566,35 +1488,84 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
         '''Load the quick lookup file.'''
         
         data = np.load(infile, allow_pickle=True).item()
+        self.fill_metadata(data, len(data['fig_ids']))
         self.figure_embeddings = data
+        self.clear_masks('figure_embeddings')
     
     
-    def order_figures_by_similarity(self, vector):
+    def lookup_scores(self, name, vector, mode='cosine', filter=None):
+        '''Score the rows of a lookup that match the filter against the vector.
+        Returns the row indices (sorted, best first) and their scores.'''
+
+        vectors = self.lookup_vectors(name)
+        vector = np.asarray(vector)
+
+        mask = self.lookup_mask(name, filter)
+        rows = np.arange(len(vectors)) if mask is None else np.flatnonzero(mask)
+        
+        with span('retrieval.'+name, rows=len(rows), mode=mode):
+            selected = vectors[rows]
+
+            if mode=='euclid':
+                scores = np.linalg.norm(selected - vector, axis=1)
+                order = np.argsort(scores, kind='stable')
+            else:
+                scores = np.dot(selected, vector)
+                if mode=='cosine':
+                    scores = scores/( np.linalg.norm(selected, axis=1)*np.linalg.norm(vector) )
+                order = np.argsort(-scores, kind='stable')
+
+        return rows[order], scores[order]
+
+
+    def lookup_vectors(self, name):
+        '''The vectors of a lookup, as a 2D array (converted once).'''
+
+        lookup = getattr(self, name)
+        if not isinstance(lookup['vectors'], np.ndarray) or lookup['vectors'].ndim!=2:
+            lookup['vectors'] = np.asarray(list(lookup['vectors']))
+
+        return lookup['vectors']
+
+
+    def doc_vectors(self, name='embeddings', normalize=True):
+        '''One vector per document: the mean of its rows in a lookup (by
+        default, the chunk embeddings). Returns (doc_ids, vectors), with
+        doc_ids sorted.'''
+
+        vectors = self.lookup_vectors(name)
+        doc_ids = np.asarray(getattr(self, name)['doc_ids'], dtype=int)
+
+        order = np.argsort(doc_ids, kind='stable')
+        unique, starts, counts = np.unique(doc_ids[order], return_index=True, return_counts=True)
+        means = np.add.reduceat(vectors[order], starts, axis=0)/counts[:,np.newaxis]
+
+        if normalize:
+            means /= np.maximum(np.linalg.norm(means, axis=1, keepdims=True), 1e-12)
+
+        return unique, means
+
+
+    def order_figures_by_similarity(self, vector, normalize=True, filter=None):
         """
         Return the list of figures/images, sorted by relevance in descending order.
         """
         
-        contexts = zip( self.figure_embeddings['table_suffix'], self.figure_embeddings['doc_ids'], self.figure_embeddings['fig_ids'], self.figure_embeddings['file_names'], self.figure_embeddings['vectors'] )
-
-        similarities = sorted([
-                (self.vector_similarity(vector, image_embedding), table_suffix, doc_id, fig_id, file_name) for table_suffix, doc_id, fig_id, file_name, image_embedding in contexts
-            ], reverse=True)
+        lookup = self.figure_embeddings
+        rows, scores = self.lookup_scores('figure_embeddings', vector, mode='cosine' if normalize else 'dot', filter=filter)
         
-        return similarities
+        return [ (score, lookup['table_suffix'][idx], lookup['doc_ids'][idx], lookup['fig_ids'][idx], lookup['file_names'][idx]) for idx, score in zip(rows, scores) ]
     
     
-    def order_figures_by_distance(self, vector):
+    def order_figures_by_distance(self, vector, filter=None):
         """
         Return the list of figures/images, sorted by relevance in descending order.
         """
         
-        contexts = zip( self.figure_embeddings['table_suffix'], self.figure_embeddings['doc_ids'], self.figure_embeddings['fig_ids'], self.figure_embeddings['file_names'], self.figure_embeddings['vectors'] )
-
-        similarities = sorted([
-                (self.vector_distance(vector, image_embedding), table_suffix, doc_id, fig_id, file_name) for table_suffix, doc_id, fig_id, file_name, image_embedding in contexts
-            ], reverse=False)
+        lookup = self.figure_embeddings
+        rows, scores = self.lookup_scores('figure_embeddings', vector, mode='euclid', filter=filter)
         
-        return similarities
+        return [ (score, lookup['table_suffix'][idx], lookup['doc_ids'][idx], lookup['fig_ids'][idx], lookup['file_names'][idx]) for idx, score in zip(rows, scores) ]
     
     
     
@@ -609,6 +1580,15 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
         
         return len(rows)>0
     
+    def image_hash_exists(self, content_hash, table_suffix=''):
+        
+        sql = f"""SELECT image_id, file_path FROM images{table_suffix} WHERE content_hash=%s LIMIT 1;"""
+        values = (content_hash, )
+        
+        rows = self.query_values(sql, values)
+        
+        return rows[0] if len(rows)>0 else None
+    
     def get_image(self, image_id, table_suffix=''):
         
         sql = f"""SELECT * FROM images{table_suffix} WHERE image_id='{image_id}' ;"""
@@ -624,12 +1604,12 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
             
         return row    
     
-    def add_image_w_embedding(self, file_path, file_name, model, vector, table_suffix=''):
+    def add_image_w_embedding(self, file_path, file_name, model, vector, table_suffix='', content_hash=None):
         
         byte_array = np.asarray(vector).tobytes()
         
-        sql = "INSERT INTO images{} (file_path, file_name, embedding_model, embedding_vector) VALUES (%s, %s, %s, %s)".format(table_suffix)
-        values = (file_path, file_name, model, byte_array)
+        sql = "INSERT INTO images{} (file_path, file_name, embedding_model, embedding_vector, content_hash) VALUES (%s, %s, %s, %s, %s)".format(table_suffix)
+        values = (file_path, file_name, model, byte_array, content_hash)
         
         self.cursor.execute(sql, values)
         self.connection.commit()
@@ -677,6 +1657,7 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
         
         results = { 'table_suffix':table_suffix, 'image_ids': image_ids, 'file_names': file_names, 'vectors': vectors }
         self.image_embeddings = results
+        self.clear_masks('image_embeddings')
         
         return results    
     
@@ -711,43 +1692,58 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
         
         data = np.load(infile, allow_pickle=True).item()
         self.image_embeddings = data
+        self.clear_masks('image_embeddings')
     
     
-    def order_images_by_similarity(self, vector, normalize=True):
+    def order_images_by_similarity(self, vector, normalize=True, filter=None):
         """
         Return the list of figures/images, sorted by relevance in descending order.
         """
         
-        contexts = zip( self.image_embeddings['table_suffix'], self.image_embeddings['image_ids'], self.image_embeddings['file_names'], self.image_embeddings['vectors'] )
-
-        similarities = sorted([
-                (self.vector_similarity(vector, image_embedding, normalize=normalize), table_suffix, image_id, file_name) for table_suffix, image_id, file_name, image_embedding in contexts
-            ], reverse=True)
+        lookup = self.image_embeddings
+        rows, scores = self.lookup_scores('image_embeddings', vector, mode='cosine' if normalize else 'dot', filter=filter)
         
-        return similarities
+        return [ (score, lookup['table_suffix'][idx], lookup['image_ids'][idx], lookup['file_names'][idx]) for idx, score in zip(rows, scores) ]
     
     
-    def order_images_by_distance(self, vector):
+    def order_images_by_distance(self, vector, filter=None):
         """
         Return the list of figures/images, sorted by Euclidian distance, in descending order.
         """
         
-        contexts = zip( self.image_embeddings['table_suffix'], self.image_embeddings['image_ids'], self.image_embeddings['file_names'], self.image_embeddings['vectors'] )
-
-        similarities = sorted([
-                (self.vector_distance(vector, image_embedding), table_suffix, image_id, file_name) for table_suffix, image_id, file_name, image_embedding in contexts
-            ], reverse=False)
+        lookup = self.image_embeddings
+        rows, scores = self.lookup_scores('image_embeddings', vector, mode='euclid', filter=filter)
         
-        return similarities    
+        return [ (score, lookup['table_suffix'][idx], lookup['image_ids'][idx], lookup['file_names'][idx]) for idx, score in zip(rows, scores) ]
 
 
 
     # Messages (a.k.a. conversation threads)
     ##################################################
-    def add_thread_message(self, thread_id, who, message_content):
+    def add_thread_message(self, thread_id, who, message_content, model=None, vector=None):
+        '''Add a message to the thread (optionally with its embedding).'''
+
+        if vector is not None and self.has_message_embeddings():
+            sql = "INSERT INTO messages (thread_id, date_time, who, message_content, embedding_model, embedding_vector) VALUES (%s, NOW(), %s, %s, %s, %s)"
+            values = (thread_id, who, message_content, model, np.asarray(vector).tobytes())
+        else:
+            sql = "INSERT INTO messages (thread_id, date_time, who, message_content) VALUES (%s, NOW(), %s, %s)"
+            values = (thread_id, who, message_content)
+        
+        self.cursor.execute(sql, values)
+        self.connection.commit()
+        
+        
+    def update_last_thread_message(self, thread_id, who, message_content, model=None, vector=None):
+        '''Replace the content of the most recent message from who (e.g. to
+        save a partial reply that is still being streamed).'''
 
-        sql = "INSERT INTO messages (thread_id, date_time, who, message_content) VALUES (%s, NOW(), %s, %s)"
-        values = (thread_id, who, message_content)
+        if vector is not None and self.has_message_embeddings():
+            sql = "UPDATE messages SET message_content=%s, embedding_model=%s, embedding_vector=%s WHERE thread_id=%s AND who=%s ORDER BY date_time DESC LIMIT 1"
+            values = (message_content, model, np.asarray(vector).tobytes(), thread_id, who)
+        else:
+            sql = "UPDATE messages SET message_content=%s WHERE thread_id=%s AND who=%s ORDER BY date_time DESC LIMIT 1"
+            values = (message_content, thread_id, who)
         
         self.cursor.execute(sql, values)
         self.connection.commit()
@@ -775,10 +1771,114 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
 
         if len(rows)==0:
             self.msg_warning(f"{len(rows)} messages returned for thread_id={thread_id}")
+            
+        for row in rows:
+            if row.get('embedding_vector') is not None:
+                row['embedding_vector'] = np.frombuffer(row['embedding_vector'])
         
         return rows       
         
         
+    def has_message_embeddings(self):
+        '''Whether the messages table stores embeddings.'''
+        
+        if self._message_embeddings is None:
+            rows = self.query_values("SHOW COLUMNS FROM `messages` LIKE %s", ('embedding_vector', ))
+            self._message_embeddings = len(rows)>0
+            
+        return self._message_embeddings
+        
+        
+    def set_message_embedding(self, message, model, vector):
+        '''Store the embedding for an existing message (a row from get_thread_messages).'''
+        
+        sql = "UPDATE messages SET embedding_model=%s, embedding_vector=%s WHERE thread_id=%s AND who=%s AND date_time=%s AND message_content=%s"
+        values = (model, np.asarray(vector).tobytes(), message['thread_id'], message['who'], message['date_time'], message['message_content'])
+        
+        self.cursor.execute(sql, values)
+        self.connection.commit()
+        
+        
+        
+    # Answer cache
+    ##################################################
+    def get_answer_cache(self, model, corpus_generation, ttl=None):
+        '''Cached answers (without the answer text) for this model and corpus.'''
+        
+        sql = """SELECT cache_id, vector, context_hash FROM answer_cache WHERE model=%s AND corpus_generation=%s"""
+        values = (model, corpus_generation)
+        if ttl is not None:
+            sql += """ AND datetime_added > NOW() - INTERVAL %s SECOND"""
+            values += (ttl, )
+        
+        rows = self.query_values(sql + ' ;', values)
+        for row in rows:
+            row['vector'] = np.frombuffer(row['vector'], dtype=np.float32)
+            
+        return rows
+    
+    
+    def get_answer_cache_entry(self, cache_id):
+        
+        rows = self.query_values("""SELECT * FROM answer_cache WHERE cache_id=%s ;""", (cache_id, ))
+        
+        return rows[0] if len(rows)>0 else None
+    
+    
+    def add_answer_cache(self, model, corpus_generation, question, vector, context_hash, answer):
+        
+        byte_array = np.asarray(vector, dtype=np.float32).tobytes()
+        
+        sql = """INSERT INTO answer_cache (model, corpus_generation, question, vector, context_hash, answer, datetime_added, datetime_used) VALUES (%s, %s, %s, %s, %s, %s, NOW(), NOW())"""
+        values = (model, corpus_generation, question, byte_array, context_hash, answer)
+        self.cursor.execute(sql, values)
+        self.connection.commit()
+        
+        return self.cursor.lastrowid
+    
+    
+    def touch_answer_cache(self, cache_id):
+        
+        sql = """UPDATE answer_cache SET hits=hits+1, datetime_used=NOW() WHERE cache_id=%s ;"""
+        self.cursor.execute(sql, (cache_id, ))
+        self.connection.commit()
+        
+        
+    def evict_answer_cache(self, ttl=None, max_entries=None):
+        '''Remove expired entries (older than ttl seconds), and then the least
+        recently used entries beyond max_entries.'''
+        
+        num_deleted = 0
+        if ttl is not None:
+            self.cursor.execute("""DELETE FROM answer_cache WHERE datetime_added < NOW() - INTERVAL %s SECOND ;""", (ttl, ))
+            num_deleted += self.cursor.rowcount
+        if max_entries is not None:
+            sql = """
+DELETE FROM answer_cache WHERE cache_id NOT IN (
+  SELECT cache_id FROM ( SELECT cache_id FROM answer_cache ORDER BY datetime_used DESC LIMIT %s ) AS recent
+) ;"""
+            self.cursor.execute(sql, (max_entries, ))
+            num_deleted += self.cursor.rowcount
+        self.connection.commit()
+        
+        return num_deleted
+    
+    
+    def increment_answer_cache_stat(self, stat, amount=1):
+        
+        sql = """INSERT INTO answer_cache_stats (stat, value) VALUES (%s, %s) ON DUPLICATE KEY UPDATE value=value+VALUES(value)"""
+        self.cursor.execute(sql, (stat, amount))
+        self.connection.commit()
+        
+        
+    def get_answer_cache_stats(self):
+        
+        stats = { row['stat']: row['value'] for row in self.query("""SELECT * FROM answer_cache_stats ;""") }
+        stats['entries'] = self.query("""SELECT COUNT(*) AS num FROM answer_cache ;""")[0]['num']
+        
+        return stats
+        
+        
         
     # scores_pairwise
     ##################################################
@@ -798,9 +1898,13 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
         return len(rows)>0
     
     
-    def get_scores_pairwise(self):
+    def get_scores_pairwise(self, text=True):
+        '''All the pairwise scores (without the text_assessment, if text=False).'''
         
-        sql = "SELECT * FROM scores_pairwise"
+        if text:
+            sql = "SELECT * FROM scores_pairwise"
+        else:
+            sql = "SELECT doc_id_A, doc_id_B, winner FROM scores_pairwise"
         
         rows = self.query(sql)
         
@@ -816,6 +1920,41 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
         self.connection.commit()
         
         
+    # rankings
+    ##################################################
+    def add_ranking(self, run_id, rows):
+        '''Store a ranking run; rows are (doc_id, rank, score, uncertainty).'''
+        
+        sql = "INSERT INTO rankings (run_id, doc_id, `rank`, score, uncertainty, datetime_added) VALUES (%s, %s, %s, %s, %s, NOW())"
+        values = [ (run_id, doc_id, rank, score, uncertainty) for doc_id, rank, score, uncertainty in rows ]
+        
+        self.cursor.executemany(sql, values)
+        self.connection.commit()
+        
+        
+    def get_ranking_runs(self):
+        '''The stored ranking runs (most recent first).'''
+        
+        sql = "SELECT run_id, COUNT(*) AS num_docs, MAX(datetime_added) AS datetime_added FROM rankings GROUP BY run_id ORDER BY datetime_added DESC, run_id DESC"
+        
+        return self.query(sql)
+        
+        
+    def get_ranking(self, run_id=None):
+        '''The rows of a ranking run (by default, the most recent), in rank order.'''
+        
+        if run_id is None:
+            runs = self.get_ranking_runs()
+            if len(runs)==0:
+                return []
+            run_id = runs[0]['run_id']
+        
+        sql = "SELECT * FROM rankings WHERE run_id=%s ORDER BY `rank`"
+        values = (run_id, )
+        
+        return self.query_values(sql, values)
+        
+        
     # tool_classify
     ##################################################
     def tool_classify_exists(self, doc_id, retrows=False):
@@ -834,6 +1973,21 @@ ORDER BY c.doc_id, c.chunk_num ASC;"""
         return len(rows)>0        
         
         
+    def get_tool_classify(self, source=None):
+        '''All the classification results (doc_id, result, source); source is
+        the prefix of text_assessment before ':' for results assigned without
+        an LLM (e.g. 'kNN'), and '' otherwise. With source given, only those
+        results are returned.'''
+        
+        sql = "SELECT doc_id, result, IF(text_assessment LIKE 'kNN:%', 'kNN', '') AS source FROM tool_classify"
+        
+        rows = self.query(sql)
+        if source is not None:
+            rows = [ row for row in rows if row['source']==source ]
+        
+        return rows
+        
+        
     def add_tool_classify(self, doc_id, result, text, title='N/A'):
         
         sql = "INSERT INTO tool_classify (doc_id, result, text_assessment, title) VALUES (%s, %s, %s, %s)"
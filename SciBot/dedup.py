@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Filename: dedup.py
+Author: Kevin G. Yager, Brookhaven National Laboratory
+Email: kyager@bnl.gov
+Date created: 2026-10-19
+Description:
+ Detection of near-duplicate documents, using MinHash signatures computed
+over word shingles of the document chunks. (Exact duplicates are caught
+earlier, using content hashes.)
+"""
+
+from .Base import Base
+
+import re
+import hashlib
+import numpy as np
+
+
+class MinHasher(Base):
+    '''Computes MinHash signatures, whose agreement estimates the Jaccard
+    similarity between the shingle sets of two documents.'''
+
+    # A prime larger than any 32-bit shingle hash; (a*x % p) then fits in uint64
+    prime = np.uint64(4294967311)
+
+    def __init__(self, num_perm=128, shingle_size=5, seed=1, name='minhash', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, 2**32-1, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 2**32-1, size=num_perm, dtype=np.uint64)
+
+        self.word_re = re.compile(r'\w+')
+
+
+    def shingles(self, chunks):
+        '''Hashes (32-bit) of the word n-grams appearing in the chunks.'''
+
+        hashes = set()
+        k = self.shingle_size
+        for chunk in chunks:
+            words = self.word_re.findall(chunk.lower())
+            if len(words)==0:
+                continue
+            for i in range(max(1, len(words)-k+1)):
+                shingle = ' '.join(words[i:i+k])
+                hashes.add( int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=4).digest(), 'little') )
+
+        return np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+
+
+    def signature(self, chunks):
+        '''The MinHash signature of a document; or None if the document has no
+        words (an empty signature would match every other empty document).'''
+
+        x = self.shingles(chunks)
+        if len(x)==0:
+            return None
+
+        # (num_perm, num_shingles) universal hashes; take the minimum for each permutation
+        h = (np.outer(self.a, x) % self.prime + self.b[:,np.newaxis]) % self.prime
+
+        return h.min(axis=1)
+
+
+    def similarity(self, signature_A, signature_B):
+        '''Estimated Jaccard similarity between two documents.'''
+
+        return np.mean(signature_A==signature_B)
+
+
+    def is_empty(self, signature):
+        '''Whether a (stored) signature is that of a document without words.'''
+
+        return signature is None or np.all(signature==np.iinfo(np.uint64).max)
+
+
+    def candidate_pairs(self, signatures, bands=32):
+        '''Locality-sensitive hashing: documents whose signatures agree exactly
+        in at least one band become candidates. signatures is a dict of
+        doc_id:signature.'''
+
+        from collections import defaultdict
+
+        rows = self.num_perm//bands
+        candidates = set()
+        for band in range(bands):
+            buckets = defaultdict(list)
+            for doc_id, signature in signatures.items():
+                if self.is_empty(signature):
+                    continue
+                buckets[ signature[band*rows:(band+1)*rows].tobytes() ].append(doc_id)
+            for bucket in buckets.values():
+                for i in range(len(bucket)):
+                    for j in range(i+1, len(bucket)):
+                        candidates.add( (min(bucket[i], bucket[j]), max(bucket[i], bucket[j])) )
+
+        return candidates
+
+
+    def near_duplicates(self, signatures, threshold=0.8, bands=32):
+        '''Return (similarity, doc_id_A, doc_id_B) for all the pairs of
+        documents that are estimated to be at least threshold similar.'''
+
+        pairs = []
+        for doc_id_A, doc_id_B in self.candidate_pairs(signatures, bands=bands):
+            similarity = self.similarity(signatures[doc_id_A], signatures[doc_id_B])
+            if similarity>=threshold:
+                pairs.append( (similarity, doc_id_A, doc_id_B) )
+
+        return sorted(pairs, reverse=True)
+
+
+
+class MinHashIndex():
+    '''In-memory locality-sensitive hashing index of signatures (banded, as in
+    MinHasher.candidate_pairs), so that the near-duplicates of a new
+    document can be found without comparing it to every stored signature.'''
+
+    def __init__(self, minhasher, bands=32):
+
+        self.minhasher = minhasher
+        self.bands = bands
+        self.rows = minhasher.num_perm//bands
+
+        self.buckets = [ {} for band in range(bands) ] # band : { band bytes : set of doc_ids }
+        self.signatures = {} # doc_id : signature
+
+
+    def band_keys(self, signature):
+        return [ signature[band*self.rows:(band+1)*self.rows].tobytes() for band in range(self.bands) ]
+
+
+    def add(self, doc_id, signature):
+        '''Add (or replace) the signature of a document.'''
+
+        self.remove(doc_id)
+        if self.minhasher.is_empty(signature):
+            return
+
+        self.signatures[doc_id] = signature
+        for buckets, key in zip(self.buckets, self.band_keys(signature)):
+            buckets.setdefault(key, set()).add(doc_id)
+
+
+    def remove(self, doc_id):
+
+        signature = self.signatures.pop(doc_id, None)
+        if signature is None:
+            return
+
+        for buckets, key in zip(self.buckets, self.band_keys(signature)):
+            bucket = buckets[key]
+            bucket.discard(doc_id)
+            if len(bucket)==0:
+                del buckets[key]
+
+
+    def candidates(self, signature):
+        '''The documents whose signatures agree with this one in at least one band.'''
+
+        candidates = set()
+        for buckets, key in zip(self.buckets, self.band_keys(signature)):
+            candidates.update(buckets.get(key, ()))
+
+        return candidates
+
+
+    def query(self, signature, threshold=0.8, exclude=None):
+        '''The most similar indexed document (among the candidates), if it is
+        at least threshold similar; returns (similarity, doc_id), or None.'''
+
+        best = None
+        for doc_id in self.candidates(signature):
+            if doc_id==exclude:
+                continue
+            similarity = self.minhasher.similarity(signature, self.signatures[doc_id])
+            if similarity>=threshold and (best is None or (similarity, -doc_id)>(best[0], -best[1])):
+                best = (similarity, doc_id)
+
+        return best
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Filename: excerpts.py
+Author: Kevin G. Yager, Brookhaven National Laboratory
+Email: kyager@bnl.gov
+Date created: 2026-10-19
+Description:
+ Prepared document excerpts. At ingest, the plaintext of each document is
+normalized and cut to a few token budgets (e.g. 2k, 8k and 32k tokens), and
+these excerpts are stored in the database (doc_excerpts table) with their
+token counts. The LLM tools (CompareBot, ClassifyBot) can then fetch an
+excerpt of the size they need by doc_id, rather than locating and reading
+the full text file of the document.
+"""
+
+from .Base import Base
+from .tokens import get_token_counter
+
+import re
+
+
+class ExcerptStore(Base):
+    '''Builds and retrieves the excerpts of documents (stored by DocumentDatabase).'''
+
+    default_budgets = (2000, 8000, 32000) # tokens
+
+    def __init__(self, configuration, db, budgets=None, name='excerpts', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+        self.configuration = configuration
+        self.db = db
+        self.budgets = sorted(budgets or configuration.get('excerpt_budgets', self.default_budgets))
+        self.tokens = get_token_counter(configuration['openai']['model'])
+
+        # Location of the text file of a document ingested before excerpts were stored
+        self.path_re = re.compile(r'(^/.+)(/xml/)(.+)(\.tei\.xml)$')
+
+
+    # Building
+    ##################################################
+    def normalize(self, text):
+        '''Collapse runs of spaces, and of blank lines.'''
+
+        text = re.sub(r'[ \t\r\f\v]+', ' ', text)
+        text = re.sub(r' ?\n ?', '\n', text)
+        text = re.sub(r'\n{3,}', '\n\n', text)
+
+        return text.strip()
+
+
+    def make_excerpts(self, text):
+        '''The excerpts of a text, as (budget, num_tokens, text). Larger budgets
+        are omitted once an excerpt holds the whole text.'''
+
+        text = self.normalize(text)
+
+        excerpts = []
+        for budget in self.budgets:
+            excerpt = self.tokens.truncate(text, budget)
+            excerpts.append( (budget, self.tokens.count_uncached(excerpt), excerpt) )
+            if len(excerpt)==len(text):
+                break
+
+        return excerpts
+
+
+    def build(self, doc_id, text):
+        '''Prepare and store the excerpts of a document.'''
+
+        if not self.db.has_doc_excerpts():
+            self.db.create_table_doc_excerpts()
+
+        excerpts = self.make_excerpts(text)
+        self.db.set_doc_excerpts(doc_id, excerpts)
+        self.msg(f"Stored {len(excerpts)} excerpts (doc_id={doc_id}; {excerpts[-1][1]:,d} tokens)", 5, 2)
+
+        return excerpts
+
+
+    def backfill(self, docs):
+        '''Build the excerpts of docs that have none (from their text files).'''
+
+        self.prefetch(docs)
+        count = 0
+        for doc in docs:
+            if len(self.db.get_doc_excerpts(doc['doc_id']))==0:
+                text = self.legacy_text(doc)
+                if text is not None:
+                    self.build(doc['doc_id'], text)
+                    count += 1
+
+        self.msg(f"Built excerpts for {count:,d} docs", 3, 1)
+
+
+    def legacy_text(self, doc):
+        '''The full text of a doc, from the text file written at ingest (or
+        None, if there is no such file).'''
+
+        m = self.path_re.match(doc['file_path'])
+        if not m:
+            return None
+
+        try:
+            with open(m.groups()[0] + '/txt/' + m.groups()[2] + '.tei.txt') as fin:
+                return fin.read()
+        except OSError:
+            return None
+
+
+    # Retrieval
+    ##################################################
+    def prefetch(self, docs):
+        '''Load the excerpts of many docs (in one query).'''
+        self.db.load_doc_excerpts([ doc['doc_id'] for doc in docs ])
+
+
+    def get(self, doc, budget):
+        '''An excerpt of the doc, of at most budget tokens (or of the largest
+        stored size, if that is smaller). Docs ingested before excerpts were
+        stored get them built (once) from their text file. Returns None if
+        the doc has no text.'''
+
+        excerpts = self.db.get_doc_excerpts(doc['doc_id'])
+        if len(excerpts)==0:
+            text = self.legacy_text(doc)
+            if text is None:
+                self.msg_warning(f"No text available for doc_id={doc['doc_id']}")
+                return None
+            excerpts = self.build(doc['doc_id'], text)
+
+        # The smallest excerpt that covers the budget (the last one holds as
+        # much of the text as is stored), trimmed to fit
+        size, num_tokens, text = next( (excerpt for excerpt in excerpts if excerpt[0]>=budget), excerpts[-1] )
+
+        return text if num_tokens<=budget else self.tokens.truncate(text, budget)
@@ -11,6 +11,7 @@ Description:
 """
 
 from .Base import Base
+from .tracing import traced, span
 
 import torch
 import torchvision.transforms as transforms
@@ -40,6 +41,7 @@ class Image_Embedding(Base):
         return self.image_data_to_embedding(image)
 
 
+    @traced('clip.image_embedding')
     def image_data_to_embedding(self, image):
         
         # Load and preprocess an image
@@ -66,7 +68,7 @@ class Image_Embedding(Base):
         
         text = clip.tokenize(categories).to(self.device)
         
-        with torch.no_grad():
+        with torch.no_grad(), span('clip.class_probabilities', categories=len(categories)):
             image_features = self.model.encode_image(image_input)
             text_features = self.model.encode_text(text)
             
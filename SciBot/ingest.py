@@ -14,8 +14,11 @@ database.
 
 # Limitations:
 # - Ingestion code assumes that each PDF has a distinct filename
+#   (copies of the same content under different names are detected using
+#   content hashes, and skipped)
 
 from .Base import Base
+from .tracing import traced, span, configure_tracing
 from pathlib import Path
 
 
@@ -25,7 +28,9 @@ class Ingester(Base):
         super().__init__(name=name, **kwargs)
         
         self.configuration = configuration
+        configure_tracing(self.configuration)
         self.db = None
+        self.excerpts = None
 
     # Database interaction
     ##################################################
@@ -33,12 +38,59 @@ class Ingester(Base):
         
         if force or self.db is None:
             from .dbase import DocumentDatabase
-            self.db = DocumentDatabase(config=self.configuration['doc_database'], verbosity=self.verbosity)
+            chunk_storage = self.configuration.get('chunk_storage', 'text')
+            self.db = DocumentDatabase(config=self.configuration['doc_database'], chunk_storage=chunk_storage, verbosity=self.verbosity)
         
     def close_database(self):
+        self.save_bm25_index()
         self.db.close()
 
 
+    # Lexical (BM25) index
+    ##################################################
+    def bm25_index(self):
+        '''The BM25 index to update during ingestion (if configured).'''
+
+        settings = self.configuration.get('bm25')
+        if not settings:
+            return None
+
+        from .bm25 import get_bm25_index
+        return get_bm25_index(settings)
+
+
+    def index_chunks(self, doc_id, chunks, table_suffix=''):
+        '''Add the chunks of a document to the BM25 index (replacing any earlier version).'''
+
+        index = self.bm25_index()
+        if index is not None:
+            index.add_doc(doc_id, chunks, table_suffix=table_suffix)
+
+
+    def save_bm25_index(self):
+
+        index = self.bm25_index()
+        if index is not None and index.dirty:
+            index.save()
+
+
+    # Document excerpts
+    ##################################################
+    def excerpt_store(self):
+
+        if self.excerpts is None or self.excerpts.db is not self.db:
+            from .excerpts import ExcerptStore
+            self.excerpts = ExcerptStore(self.configuration, self.db, verbosity=self.verbosity)
+
+        return self.excerpts
+
+
+    def store_excerpts(self, doc_id, text):
+        '''Prepare the excerpts of a document (for the LLM tools), from its plaintext.'''
+
+        self.excerpt_store().build(doc_id, text)
+
+
     # Protocols/workflows
     ##################################################
     def do_step(self, this_step, step_initial, step_final=None):
@@ -53,24 +105,66 @@ class Ingester(Base):
         return this_step>=step_initial and (step_final is None or this_step<=step_final)
 
 
+    def hash_file(self, infile, block_size=1<<20):
+        '''Content hash (sha256 hex digest) of a file on disk.'''
+
+        import hashlib
+        h = hashlib.sha256()
+        with open(infile, 'rb') as fin:
+            for block in iter(lambda: fin.read(block_size), b''):
+                h.update(block)
+
+        return h.hexdigest()
+
+
+    def hash_text(self, text):
+        '''Content hash (sha256 hex digest) of a string.'''
+
+        import hashlib
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+    def count_chunk_tokens(self, chunks):
+        '''Token counts for chunks (using the tokenizer of the chat model).
+        These are stored with the chunks, so that prompts can be packed
+        without re-tokenizing.'''
+
+        from .tokens import get_token_counter
+        tokens = get_token_counter(self.configuration['openai']['model'])
+
+        return tokens.count_batch(chunks)
+
+
 
 class DocumentIngester(Ingester):
 
     def __init__(self, configuration, name='docs', **kwargs):
         super().__init__(configuration, name=name, **kwargs)
+        
+        self.minhasher = None
+        self.near_duplicate_index = None # MinHashIndex of the stored signatures (loaded on first use)
     
 
     # Conversions
     ##################################################
         
-    def pdfs_to_xmls(self, source_dir, output_dir=None, force=False):
+    @traced('ingest.pdfs_to_xmls')
+    def pdfs_to_xmls(self, source_dir, output_dir=None, force=False, skip_duplicates=True):
         '''Convert a folder of PDF files into corresponding XML files.
         We use Grobid for this, and thus assume that a valid Grobid
         server is running and available using the parameters specified
-        in the grobid config.json file.'''
+        in the grobid config.json file.
+        If skip_duplicates, PDFs whose content is identical to another PDF
+        (in this folder, or already in the database) are not converted.'''
         
         self.msg(f"Converting PDFs to XML from directory: {source_dir}")
         
+        if skip_duplicates:
+            pdf_files, duplicates = self.unique_pdfs(sorted(Path(source_dir).glob('*.pdf')))
+            if len(duplicates)>0:
+                self.pdf_files_to_xmls(pdf_files, output_dir=output_dir, force=force)
+                return
+        
         from grobid_client.grobid_client import GrobidClient
         
         config_file = self.configuration['grobid']['config_file']
@@ -79,6 +173,49 @@ class DocumentIngester(Ingester):
         client.process("processFulltextDocument", source_dir, output=output_dir, consolidate_citations=False, force=force, verbose=True)
 
 
+    def pdf_files_to_xmls(self, pdf_files, output_dir, force=False):
+        '''Convert a list of PDF files into XML files. Grobid works on a directory,
+        so we point it at a temporary directory holding links to just these PDFs.'''
+        
+        import tempfile
+        with tempfile.TemporaryDirectory() as staging_dir:
+            for infile in pdf_files:
+                Path(staging_dir, infile.name).symlink_to(Path(infile).resolve())
+            self.pdfs_to_xmls(staging_dir, output_dir, force=force, skip_duplicates=False)
+
+
+    def unique_pdfs(self, pdf_files, hashes=None):
+        '''Separate a list of PDFs into those with unique content, and those
+        that duplicate another PDF (earlier in the list, or already ingested).
+        Returns (unique_files, duplicates), where duplicates is a dict
+        mapping each skipped file to the name of the original.'''
+        
+        self.start_database()
+        
+        unique = []
+        duplicates = {}
+        seen = {}
+        for infile in pdf_files:
+            pdf_hash = hashes[infile] if hashes is not None else self.hash_file(infile)
+            
+            if pdf_hash in seen:
+                duplicates[infile] = seen[pdf_hash].name
+                
+            else:
+                original = self.db.find_doc_by_hash(pdf_hash=pdf_hash, exclude_name=infile.with_suffix('.tei.xml').name)
+                if original is not None:
+                    duplicates[infile] = original['file_name']
+                else:
+                    seen[pdf_hash] = infile
+                    unique.append(infile)
+                    
+        for infile, original in duplicates.items():
+            self.msg(f"Skipping {infile.name} (duplicate of {original})", 3, 1)
+        
+        return unique, duplicates
+
+
+    @traced('ingest.pdfs_to_db')
     def pdfs_to_db(self, source_dir, force=False):
         for infile in source_dir.glob('*.pdf'):
             self.msg(f"Adding PDF path to database: {infile}")
@@ -88,12 +225,14 @@ class DocumentIngester(Ingester):
             self.msg(f"Found doc_id: {doc_id}; pdf_file = {pdf_file}", 6, 3)
             if force or pdf_file is None:
                 self.db.set_pdf_path(doc_id, str(infile))
+                self.db.set_doc_hashes(doc_id, pdf_hash=self.hash_file(infile))
                 self.msg(f"Updated doc_id={doc_id} with pdf_file: {infile}", 4, 3)
             else:
                 self.msg(f"No update for doc_id: {doc_id}", 6, 3)
             
 
-    def xml_to_chunks(self, xml_file, chunk_length=None, overlap_length=None):
+    @traced('ingest.xml_to_chunks')
+    def xml_to_chunks(self, xml_file, chunk_length=None, overlap_length=None, return_text=False):
         
         self.msg(f"Converting XML to chunks: {xml_file}")
         
@@ -102,6 +241,7 @@ class DocumentIngester(Ingester):
         text, md = self.xml_to_plaintext(xml_document)
         compression = 100.*len(text)/len(xml_document)
         self.msg(f"Generated plaintext {len(text):,d} chars ({compression:.0f}%)", 3, 2)
+        md['text_hash'] = self.hash_text(text)
         
         if chunk_length is None:
             chunk_length = self.configuration['chunk_length']
@@ -110,6 +250,9 @@ class DocumentIngester(Ingester):
         
         chunks = self.split_overlapping_chunks(text, chunk_length, overlap_length)
         
+        if return_text:
+            return chunks, md, text
+        
         return chunks, md
 
 
@@ -192,7 +335,8 @@ class DocumentIngester(Ingester):
         '''Parse xml into a BeautifulSoup object.'''
 
         from bs4 import BeautifulSoup
-        soup = BeautifulSoup(xml_document, 'lxml')
+        with span('ingest.xml_parse', bytes=len(xml_document)):
+            soup = BeautifulSoup(xml_document, 'lxml')
 
         if clean:
             # Remove the appInfo tag that labels this as a GROBID result
@@ -238,6 +382,14 @@ class DocumentIngester(Ingester):
         md['authors_list'] = authors_list
         md['authors'] = '; '.join(authors_list)
         
+        # Publication year (e.g. <date type="published" when="2020-05-01">)
+        md['year'] = None
+        for date_tag in header.find_all('date'):
+            when = date_tag.get('when', '')[:4]
+            if when.isdigit():
+                md['year'] = int(when)
+                break
+        
         
         return md
 
@@ -266,29 +418,36 @@ class DocumentIngester(Ingester):
 
 
 
-    def xml_to_summaries(self, xml_file, chunk_length=None, overlap_amount=0.2):
-        
-        self.msg(f"Summarizing XML: {xml_file}")
-        
+    def xml_to_summary_chunks(self, xml_file, summary_bot, chunk_length=None, overlap_amount=0.2):
+        '''Prepare the blocks of text (sized for the summarization LLM) for a document.'''
+
         xml_document = self.load_xml_file(xml_file)
-        
+
         text, md = self.xml_to_plaintext(xml_document)
         compression = 100.*len(text)/len(xml_document)
         self.msg(f"Generated plaintext {len(text):,d} chars ({compression:.0f}%)", 3, 2)
-        
 
-        from .bots import SummarizeBot
-        summary_bot = SummarizeBot(configuration=self.configuration, name='sum_bot', verbosity=self.verbosity)
-        
         doc_name = '''{} et al. "{}"'''.format(md['first_author'], md['title'])
-        
+
         if chunk_length is None:
             # Estimate reasonable length based on LLM
             chunk_length = summary_bot.get_request_window()
-        overlap_length = int(chunk_length*overlap_amount)        
-        
+        overlap_length = int(chunk_length*overlap_amount)
+
         chunks = self.split_overlapping_chunks(text, chunk_length, overlap_length)
-        
+
+        return chunks, md, doc_name
+
+
+    def xml_to_summaries(self, xml_file, chunk_length=None, overlap_amount=0.2):
+
+        self.msg(f"Summarizing XML: {xml_file}")
+
+        from .bots import SummarizeBot
+        summary_bot = SummarizeBot(configuration=self.configuration, name='sum_bot', verbosity=self.verbosity)
+
+        chunks, md, doc_name = self.xml_to_summary_chunks(xml_file, summary_bot, chunk_length=chunk_length, overlap_amount=overlap_amount)
+
         summaries = []
         for i, chunk in enumerate(chunks):
             response = self.summarize_chunk(chunk, doc_name, summary_bot)
@@ -406,6 +565,7 @@ class DocumentIngester(Ingester):
 
     # Iterations through documents
     ##################################################
+    @traced('ingest.xmls_to_txt')
     def xmls_to_txt(self, xml_dir, txt_dir, force=False):
         '''Converts all the xml files into plaintext equivalents.'''
         
@@ -414,36 +574,58 @@ class DocumentIngester(Ingester):
         for infile in infiles:
             outfile = txt_dir / infile.with_suffix('.txt').name
             if force or not outfile.is_file():
-                self.msg(f'Converting {infile.name}', 3, 0)
-                
-                xml_document = self.load_xml_file(infile)
-                text, md = self.xml_to_plaintext(xml_document)
-                
-                with open(outfile, 'w') as fout:
-                    fout.write(text)
-                
-                self.msg(f'Saved {outfile}', 3, 1)
+                self.xml_to_txt(infile, outfile)
+
+
+    def xml_to_txt(self, infile, outfile):
+        
+        self.msg(f'Converting {infile.name}', 3, 0)
+        
+        xml_document = self.load_xml_file(infile)
+        text, md = self.xml_to_plaintext(xml_document)
+        
+        with open(outfile, 'w') as fout:
+            fout.write(text)
+        
+        self.msg(f'Saved {outfile}', 3, 1)
 
         
-    def xmls_to_summaries(self, xml_dir, summary_dir, force=False):
+    def xmls_to_summaries(self, xml_dir, summary_dir, force=False, max_in_flight=8, reduce=False, chunk_length=None, overlap_amount=0.2, infiles=None):
         '''Takes xmls of scientific documents, and generates a shortened
-        version of the document, by summarize it block-by-block.'''
+        version of the document, by summarize it block-by-block.
+        Blocks (across all the documents) are summarized concurrently, with at
+        most max_in_flight requests outstanding. Completed summaries are cached
+        in summary_dir, so an interrupted run only pays for the missing pieces.'''
 
-        infiles = xml_dir.glob('./*.xml')
+        from .summarize import SummaryEngine
+        cache_file = summary_dir / 'summary_cache.jsonl'
+        engine = SummaryEngine(configuration=self.configuration, max_in_flight=max_in_flight, cache_file=cache_file, verbosity=self.verbosity)
 
-        for infile in infiles:
+        if infiles is None:
+            infiles = xml_dir.glob('./*.xml')
+
+        def documents():
+            for infile in infiles:
+                outfile = summary_dir / infile.with_suffix('.txt').name
+                if force or not outfile.is_file():
+                    self.msg(f"Summarizing XML: {infile}", 3, 0)
+                    chunks, md, doc_name = self.xml_to_summary_chunks(infile, engine.bot, chunk_length=chunk_length, overlap_amount=overlap_amount)
+                    yield infile, doc_name, chunks
+
+        def save(infile, summaries):
             outfile = summary_dir / infile.with_suffix('.txt').name
-            if force or not outfile.is_file():
-            
-                summaries, md = self.xml_to_summaries(infile, chunk_length=None, overlap_amount=0.2)
-                
-                self.msg(f'Got {len(summaries):,d} summaries', 3, 1)
-                
-                text = '\n\n'.join(summaries)
-                with open(outfile, 'w') as fout:
-                    fout.write(text)
+            self.msg(f'Got {len(summaries):,d} summaries for {infile.name}', 3, 1)
+
+            text = '\n\n'.join(summaries)
+            with open(outfile, 'w') as fout:
+                fout.write(text)
+
+        results = engine.run(documents(), on_complete=save, reduce=reduce)
+
+        return results
 
             
+    @traced('ingest.documents_to_figures')
     def documents_to_figures(self, pdf_dir, xml_dir, fig_dir, force=False):
         
         infiles = xml_dir.glob('./*.xml')
@@ -456,6 +638,7 @@ class DocumentIngester(Ingester):
 
         
         
+    @traced('ingest.xmls_to_database')
     def xmls_to_database(self, xml_dir, force=False, randomize=False):
         
         infiles = xml_dir.glob('./*.xml')
@@ -468,15 +651,103 @@ class DocumentIngester(Ingester):
         
         for infile in infiles:
             if force or not self.db.doc_exists(infile):
-                self.msg(f'Ingesting {infile.name}', 3, 0)
-                
-                chunks, md = self.xml_to_chunks(infile)
-                
-                # Add document to database
-                doc_id = self.db.add_doc(str(infile), md)
-                
-                # Add chunks
-                self.db.add_chunks(doc_id, chunks, table_suffix='', md=md)
+                self.xml_to_database(infile)
+
+
+    def xml_to_database(self, infile, replace=False, skip_duplicates=True):
+        '''Chunk a single XML document and put it in the database.
+        If replace=True, an existing copy of the document is re-chunked
+        (keeping its doc_id).
+        If skip_duplicates, a document whose text is identical to one already
+        in the database is not added (so it won't be embedded/summarized);
+        we return None in that case.'''
+        
+        self.msg(f'Ingesting {infile.name}', 3, 0)
+        
+        chunks, md, text = self.xml_to_chunks(infile, return_text=True)
+        
+        if skip_duplicates:
+            original = self.db.find_doc_by_hash(text_hash=md['text_hash'], exclude_name=infile.name)
+            if original is None:
+                original = self.find_near_duplicate(chunks, md, exclude_name=infile.name)
+            if original is not None:
+                self.msg(f"Skipping {infile.name} (duplicate of {original['file_name']}, doc_id={original['doc_id']})", 3, 1)
+                return None
+        
+        doc_id = self.db.find_doc_id(infile.name) if replace else None
+        if doc_id is None:
+            # Add document to database
+            doc_id = self.db.add_doc(str(infile), md)
+        else:
+            self.db.delete_chunks(doc_id, table_suffix='')
+            self.db.set_doc_hashes(doc_id, text_hash=md['text_hash'])
+        
+        if 'minhash' in md:
+            self.db.set_doc_minhash(doc_id, md['minhash'])
+            if self.near_duplicate_index is not None:
+                self.near_duplicate_index.add(doc_id, md['minhash'])
+        if md.get('year') is not None and self.db.has_doc_years():
+            self.db.set_doc_year(doc_id, md['year'])
+        
+        # Add chunks
+        self.db.add_chunks(doc_id, chunks, table_suffix='', md=md, num_tokens=self.count_chunk_tokens(chunks))
+        self.index_chunks(doc_id, chunks, table_suffix='')
+        self.store_excerpts(doc_id, text)
+        
+        return doc_id
+
+
+    def find_near_duplicate(self, chunks, md, exclude_name=None):
+        '''Near-duplicate detection (optional): if the configuration specifies
+        a near_duplicate_threshold, compare the MinHash signature of this
+        document to those already in the database. The document named
+        exclude_name is skipped (so a re-ingested document doesn't match itself).
+        The stored signatures are loaded once (per ingester) into an LSH
+        index, and documents are added to it as they are ingested; only the
+        documents that collide with this one in some band are compared.'''
+        
+        threshold = self.configuration.get('near_duplicate_threshold')
+        if threshold is None:
+            return None
+        
+        if self.near_duplicate_index is None:
+            from .dedup import MinHasher, MinHashIndex
+            self.minhasher = MinHasher(verbosity=self.verbosity)
+            self.near_duplicate_index = MinHashIndex(self.minhasher)
+            for doc_id, signature in self.db.get_doc_minhashes().items():
+                self.near_duplicate_index.add(doc_id, signature)
+            self.msg(f"Loaded {len(self.near_duplicate_index.signatures):,d} MinHash signatures", 4, 1)
+        
+        md['minhash'] = self.minhasher.signature(chunks)
+        if md['minhash'] is None:
+            self.msg("No words in document; skipping near-duplicate check", 3, 1)
+            return None
+        
+        exclude_id = None if exclude_name is None else self.db.find_doc_id(exclude_name)
+        
+        match = self.near_duplicate_index.query(md['minhash'], threshold=threshold, exclude=exclude_id)
+        if match is None:
+            return None
+        
+        similarity, doc_id = match
+        self.msg(f"Near-duplicate of doc_id={doc_id} (estimated similarity {100*similarity:.0f}%)", 3, 1)
+        
+        return self.db.get_doc(doc_id)
+
+
+    def find_near_duplicates(self, threshold=0.8):
+        '''Report all pairs of (already ingested) documents that are near-duplicates.'''
+        
+        from .dedup import MinHasher
+        minhasher = MinHasher(verbosity=self.verbosity)
+        
+        signatures = self.db.get_doc_minhashes()
+        pairs = minhasher.near_duplicates(signatures, threshold=threshold)
+        
+        for similarity, doc_id_A, doc_id_B in pairs:
+            self.msg(f"doc_id={doc_id_A} and doc_id={doc_id_B} are near-duplicates (estimated similarity {100*similarity:.0f}%)", 3, 1)
+        
+        return pairs
 
 
     def summaries_to_database(self, summary_dir, table_suffix='_summary', chunk_length=None, overlap_length=None):
@@ -489,27 +760,43 @@ class DocumentIngester(Ingester):
         
         infiles = summary_dir.glob('./*.txt')
         for infile in infiles:
-            self.msg(f'Ingesting summary {infile.name}', 3, 0)
-            
-            with open(infile) as fin:
-                text = fin.read()
-            
-            doc_id = self.db.get_doc_id(infile.with_suffix('.xml').name)
-            
-            chunks = self.split_overlapping_chunks(text, chunk_length, overlap_length)
+            self.summary_to_database(infile, table_suffix=table_suffix, chunk_length=chunk_length, overlap_length=overlap_length)
+        
+        
+    def summary_to_database(self, infile, table_suffix='_summary', chunk_length=None, overlap_length=None, replace=False):
+        
+        if chunk_length is None:
+            chunk_length = self.configuration['chunk_length']
+        if overlap_length is None:
+            overlap_length = self.configuration['chunk_overlap_length']
+        
+        self.msg(f'Ingesting summary {infile.name}', 3, 0)
+        
+        with open(infile) as fin:
+            text = fin.read()
+        
+        doc_id = self.db.get_doc_id(infile.with_suffix('.xml').name)
+        if replace:
+            self.db.delete_chunks(doc_id, table_suffix=table_suffix)
+        
+        chunks = self.split_overlapping_chunks(text, chunk_length, overlap_length)
 
-            self.db.add_chunks(doc_id, chunks, table_suffix=table_suffix)
+        self.db.add_chunks(doc_id, chunks, table_suffix=table_suffix, num_tokens=self.count_chunk_tokens(chunks))
+        self.index_chunks(doc_id, chunks, table_suffix=table_suffix)
         
+        return doc_id
+
 
 
-    def calc_chunk_embeddings(self, force=False, doc_name=True, table_suffix=''):
+    @traced('ingest.calc_chunk_embeddings')
+    def calc_chunk_embeddings(self, force=False, doc_name=True, table_suffix='', doc_id=None):
         
         from .bots import EmbedBot
         embed_bot = EmbedBot(configuration=self.configuration, name='embed')
         model = embed_bot.model
         
         
-        chunk_list = self.db.get_chunks_list(table_suffix=table_suffix)
+        chunk_list = self.db.get_chunks_list(table_suffix=table_suffix, doc_id=doc_id)
         
         for chunk_item in chunk_list:
             if force or not self.db.embedding_exists(chunk_item['doc_id'], chunk_item['chunk_num'], table_suffix=table_suffix):
@@ -526,6 +813,42 @@ class DocumentIngester(Ingester):
                 self.db.add_embedding(chunk_item['doc_id'], chunk_item['chunk_num'], model, vector, table_suffix=table_suffix)
                 
                 
+    def build_bm25_index(self, table_suffixes=['']):
+        '''(Re)build the BM25 index from the chunks in the database.'''
+
+        index = self.bm25_index()
+        if index is None:
+            self.msg_error("No BM25 index configured (configuration['bm25']).")
+            return
+
+        self.start_database()
+        index.clear()
+        for table_suffix in table_suffixes:
+            for doc_id in self.db.get_chunk_doc_ids(table_suffix=table_suffix):
+                rows = self.db.get_doc_chunks(doc_id, table_suffix=table_suffix)
+                for row in rows:
+                    index.add_chunk(table_suffix, doc_id, row['chunk_num'], row['content'])
+
+        index.save()
+
+
+    def calc_chunk_token_counts(self, table_suffix=''):
+        '''Store token counts for chunks that were ingested without them.
+        (The lookup file should then be regenerated.)'''
+        
+        if not self.db.has_num_tokens(table_suffix):
+            self.db.add_num_tokens_column(table_suffix=table_suffix)
+        
+        doc_ids = self.db.get_docs_missing_num_tokens(table_suffix=table_suffix)
+        for doc_id in doc_ids:
+            rows = self.db.get_doc_chunks(doc_id, table_suffix=table_suffix)
+            counts = self.count_chunk_tokens([row['content'] for row in rows])
+            self.db.set_chunk_num_tokens(doc_id, { row['chunk_num']: count for row, count in zip(rows, counts) }, table_suffix=table_suffix)
+            
+        self.msg(f"Counted tokens for chunks{table_suffix} of {len(doc_ids):,d} documents", 3, 1)
+                
+                
+    @traced('ingest.save_embedding_lookup_file')
     def save_embedding_lookup_file(self, table_suffixes=[''], outfile='./chunk_lookup.npy'):
         
         self.msg(f'Generating chunk lookup file: {outfile}', 3, 0)
@@ -542,10 +865,12 @@ class DocumentIngester(Ingester):
 
     # Database interaction
     ##################################################
-    def create_tables(self, documents=False, chunks=False, embeddings=False, table_suffix='', close=True):
+    def create_tables(self, documents=False, chunks=False, embeddings=False, journal=False, table_suffix='', close=True):
         self.start_database()
         if documents:
             self.db.create_table_documents()
+        if journal:
+            self.db.create_table_ingest_journal()
         if chunks:
             self.db.create_table_chunks(table_suffix=table_suffix)
         if embeddings:
@@ -557,6 +882,7 @@ class DocumentIngester(Ingester):
 
     # Protocols/workflows
     ##################################################
+    @traced('ingest.pdfs')
     def ingest_pdfs(self, source_dir, step_initial=1, step_final=None, make_txt=True, make_summaries=False, force=False):
         
         # The procedure is broken into steps, allowing the user to only perform certain steps,
@@ -684,7 +1010,9 @@ class DocumentIngester(Ingester):
             chunks = self.split_overlapping_chunks(text, chunk_length, overlap_length)
 
             # Add chunks
-            self.db.add_chunks(doc_id, chunks, table_suffix='', md=md)
+            self.db.add_chunks(doc_id, chunks, table_suffix='', md=md, num_tokens=self.count_chunk_tokens(chunks))
+            self.index_chunks(doc_id, chunks, table_suffix='')
+            self.store_excerpts(doc_id, text)
 
             
         if self.do_step(5, si, sf):
@@ -705,12 +1033,253 @@ class DocumentIngester(Ingester):
             if make_summaries:
                 table_suffixes.append('_summary')
                 
-            self.save_embedding_lookup_file(table_suffixes=table_suffixes, outfile=outfile)            
-            
-            
-        self.close_database()            
-            
-        
+            self.save_embedding_lookup_file(table_suffixes=table_suffixes, outfile=outfile)
+
+
+        self.close_database()
+
+
+
+    # Journaled pipeline
+    ##################################################
+    # Rather than re-running numbered steps (and re-checking every file/chunk),
+    # the ingest_journal table records which stages are done for each document
+    # (doc_key, the stem of the source PDF), and for which version of the input.
+    # Each stage only works on the documents that are pending for it, and
+    # stages whose dependencies are complete run concurrently.
+
+    # stage : stages that it depends on
+    pipeline_stages = {
+        'grobid': [],
+        'txt': ['grobid'],
+        'chunks': ['grobid'],
+        'embeddings': ['chunks'],
+        'summaries': ['chunks'],
+        'figures': ['chunks'],
+        'lookup': ['embeddings', 'summaries', 'figures'],
+        }
+
+    # The lookup files are built for the corpus as a whole
+    corpus_key = '*'
+
+
+    @traced('ingest.pdfs_journaled')
+    def ingest_pdfs_journaled(self, source_dir, stages=None, make_txt=True, make_summaries=False, make_figures=True, max_workers=4, force=False):
+        '''Ingest a directory of PDFs, doing only the work that the journal
+        says is still pending. An interrupted run can simply be re-run.'''
+
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        if stages is None:
+            stages = ['grobid', 'chunks', 'embeddings', 'lookup']
+            if make_txt:
+                stages.append('txt')
+            if make_summaries:
+                stages.append('summaries')
+            if make_figures:
+                stages.append('figures')
+
+        paths = {
+            'source_dir': Path(source_dir),
+            'xml_dir': self.configuration['document_dir'] / 'xml/',
+            'txt_dir': self.configuration['document_dir'] / 'txt/',
+            'summary_dir': self.configuration['document_dir'] / 'summary/',
+            'fig_dir': self.configuration['document_dir'] / 'figures/',
+            }
+        for key in ['xml_dir', 'txt_dir', 'summary_dir', 'fig_dir']:
+            Path(paths[key]).mkdir(parents=True, exist_ok=True)
+
+        self.start_database()
+        self.db.create_table_ingest_journal()
+
+        pdfs = { infile.stem: infile for infile in sorted(paths['source_dir'].glob('*.pdf')) }
+        self.msg(f"Journaled ingestion of {len(pdfs):,d} PDFs (stages: {', '.join(stages)})", 3, 0)
+
+        self.timing_start()
+
+        remaining = [stage for stage in self.pipeline_stages if stage in stages]
+        finished = []
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            running = {}
+            while remaining or running:
+
+                # Launch all the stages whose dependencies are complete
+                for stage in list(remaining):
+                    depends = [d for d in self.pipeline_stages[stage] if d in stages]
+                    if all(d in finished for d in depends):
+                        remaining.remove(stage)
+                        running[pool.submit(self.run_pipeline_stage, stage, pdfs, paths, stages, force)] = stage
+
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.msg_error(f'Stage {stage} raised Python exception: ' + type(e).__name__)
+                    finished.append(stage)
+
+        self.close_database()
+        self.timing_end_msg('Journaled ingestion', threshold=3)
+
+
+    def pipeline_inputs(self, stage, pdfs, paths, stages, db):
+        '''Determine the candidate documents for a stage (those whose dependencies
+        are done), and the hash of the input that the stage would consume.'''
+
+        if stage=='grobid':
+            return { doc_key: self.hash_file(infile) for doc_key, infile in pdfs.items() }
+
+        done = {}
+        for depend in self.pipeline_stages[stage]:
+            if depend in stages:
+                done[depend] = db.get_journal_done(depend)
+
+        if stage=='lookup':
+            # Rebuild whenever the set of embedded documents changes
+            items = sorted( '{}:{}:{}'.format(depend, doc_key, input_hash) for depend, rows in done.items() for doc_key, input_hash in rows.items() )
+            return { self.corpus_key: self.hash_text('\n'.join(items)) }
+
+        if stage=='embeddings':
+            # Re-embed if the chunks (or the embedding model) change
+            model = self.configuration['openai']['embedding_model']
+            return { doc_key: self.hash_text('{}:{}'.format(model, input_hash)) for doc_key, input_hash in done['chunks'].items() if doc_key in pdfs }
+
+        # Stages that consume the Grobid output
+        inputs = {}
+        for doc_key in pdfs:
+            if all(doc_key in rows for rows in done.values()):
+                xml_file = paths['xml_dir'] / f'{doc_key}.tei.xml'
+                if xml_file.is_file():
+                    inputs[doc_key] = self.hash_file(xml_file)
+
+        return inputs
+
+
+    def run_pipeline_stage(self, stage, pdfs, paths, stages, force=False):
+        '''Run one stage, for all the documents that are pending for it.
+        Each stage uses its own ingester (and thus database connection), so
+        that stages can run concurrently.'''
+
+        worker = DocumentIngester(self.configuration, name=f'{self.name}:{stage}', verbosity=self.verbosity)
+        worker.start_database()
+        db = worker.db
+
+        inputs = worker.pipeline_inputs(stage, pdfs, paths, stages, db)
+        if force:
+            pending = list(inputs.keys())
+        else:
+            pending = db.get_journal_pending(stage, inputs)
+
+        worker.msg(f"Stage {stage}: {len(pending):,d} pending (of {len(inputs):,d} candidates)", 3, 0)
+
+        if len(pending)==0:
+            worker.close_database()
+            return
+
+        for doc_key in pending:
+            db.set_journal(doc_key, stage, 'running', inputs[doc_key])
+
+        def record(doc_key, status, message=None):
+            db.set_journal(doc_key, stage, status, inputs[doc_key], message)
+
+        xml_dir = paths['xml_dir']
+
+        if stage=='grobid':
+            # Duplicate PDFs are skipped before any Grobid work is done on them
+            pdf_files = [pdfs[doc_key] for doc_key in pending]
+            hashes = { pdfs[doc_key]: inputs[doc_key] for doc_key in pending }
+            pdf_files, duplicates = worker.unique_pdfs(pdf_files, hashes=hashes)
+            for infile, original in duplicates.items():
+                record(infile.stem, 'duplicate', f'Duplicate of {original}')
+
+            worker.pdf_files_to_xmls(pdf_files, xml_dir, force=True)
+            for infile in pdf_files:
+                xml_file = xml_dir / f'{infile.stem}.tei.xml'
+                if xml_file.is_file():
+                    record(infile.stem, 'done')
+                else:
+                    record(infile.stem, 'failed', 'Grobid produced no XML')
+
+        elif stage=='summaries':
+            infiles = [xml_dir / f'{doc_key}.tei.xml' for doc_key in pending]
+            results = worker.xmls_to_summaries(xml_dir, paths['summary_dir'], force=True, infiles=infiles)
+            for doc_key, infile in zip(pending, infiles):
+                if infile not in results:
+                    record(doc_key, 'failed', 'Summarization failed')
+                    continue
+                worker.run_pipeline_document(record, doc_key, worker.summary_stage_document, infile, paths)
+
+        elif stage=='lookup':
+            table_suffixes = ['']
+            if 'summaries' in stages:
+                table_suffixes.append('_summary')
+            worker.run_pipeline_document(record, self.corpus_key, worker.save_embedding_lookup_file, table_suffixes=table_suffixes)
+            if 'figures' in stages:
+                worker.save_figure_embedding_lookup_file()
+
+        else:
+            for doc_key in pending:
+                xml_file = xml_dir / f'{doc_key}.tei.xml'
+
+                if stage=='txt':
+                    outfile = paths['txt_dir'] / xml_file.with_suffix('.txt').name
+                    worker.run_pipeline_document(record, doc_key, worker.xml_to_txt, xml_file, outfile)
+
+                elif stage=='chunks':
+                    worker.run_pipeline_document(record, doc_key, worker.chunks_stage_document, xml_file, pdfs[doc_key])
+
+                elif stage=='embeddings':
+                    doc_id = db.find_doc_id(xml_file.name)
+                    if doc_id is None:
+                        record(doc_key, 'failed', 'Document not in database')
+                    else:
+                        worker.run_pipeline_document(record, doc_key, worker.calc_chunk_embeddings, doc_id=doc_id)
+
+                elif stage=='figures':
+                    worker.run_pipeline_document(record, doc_key, worker.figures_stage_document, xml_file, paths)
+
+        worker.close_database()
+
+
+    def run_pipeline_document(self, record, doc_key, function, *args, **kwargs):
+        '''Run the work for a document, recording success/failure in the journal.
+        A function can return 'duplicate' to indicate that the document was skipped.'''
+
+        try:
+            result = function(*args, **kwargs)
+            if isinstance(result, str) and result=='duplicate':
+                record(doc_key, 'duplicate', 'Content duplicates an existing document')
+            else:
+                record(doc_key, 'done')
+        except Exception as e:
+            self.msg_error(f'{doc_key}: Python exception: ' + type(e).__name__)
+            record(doc_key, 'failed', '{}: {}'.format(type(e).__name__, e))
+
+
+    def chunks_stage_document(self, xml_file, pdf_file):
+
+        doc_id = self.xml_to_database(xml_file, replace=True)
+        if doc_id is None:
+            return 'duplicate'
+        self.db.set_pdf_path(doc_id, str(pdf_file))
+        self.db.set_doc_hashes(doc_id, pdf_hash=self.hash_file(pdf_file))
+
+
+    def figures_stage_document(self, xml_file, paths):
+
+        doc_id = self.db.get_doc_id(xml_file.name)
+        self.db.delete_figures(doc_id)
+        self.document_to_figures(xml_file, pdf_dir=paths['source_dir'], fig_dir=paths['fig_dir'], force=True)
+
+
+    def summary_stage_document(self, xml_file, paths):
+
+        summary_file = paths['summary_dir'] / xml_file.with_suffix('.txt').name
+        doc_id = self.summary_to_database(summary_file, table_suffix='_summary', replace=True)
+        self.calc_chunk_embeddings(table_suffix='_summary', doc_id=doc_id)
+
+
             
         
             
@@ -745,6 +1314,12 @@ class ImageIngester(Ingester):
                 
                 if self.db.image_exists(str(infile)) and not force:
                     self.msg(f'Skipping (already in db): {infile}')
+                    continue
+                
+                content_hash = self.hash_file(infile)
+                original = None if force else self.db.image_hash_exists(content_hash)
+                if original is not None:
+                    self.msg(f"Skipping (duplicate of {original['file_path']}): {infile}")
                 
                 else:
                     self.msg(f'Ingesting: {infile}')
@@ -752,7 +1327,7 @@ class ImageIngester(Ingester):
                     vector = ImgEmbed.image_to_embedding(infile)
                     self.msg(f'Obtained image embedding vector ({len(vector)} dims)', 4, 2)
                     
-                    self.db.add_image_w_embedding(str(infile), infile.name, model, vector.tolist(), table_suffix='')
+                    self.db.add_image_w_embedding(str(infile), infile.name, model, vector.tolist(), table_suffix='', content_hash=content_hash)
                     
             
 
@@ -776,6 +1351,7 @@ class ImageIngester(Ingester):
 
     # Protocols/workflows
     ##################################################
+    @traced('ingest.images')
     def ingest_images(self, img_dir, step_initial=1, step_final=None, force=False):
 
         # The procedure is broken into steps, allowing the user to only perform certain steps,
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Filename: pipeline.py
+Author: Kevin G. Yager, Brookhaven National Laboratory
+Email: kyager@bnl.gov
+Date created: 2026-10-19
+Description:
+ Concurrency for the question-answering path. Independent waits (embedding
+API calls, chunk fetches, writing the reply) are overlapped, using
+background threads. Database work is done on a second connection, owned by
+a single worker thread (MySQL connections cannot be shared across threads).
+"""
+
+from .Base import Base
+from .tracing import span, propagate
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class QueryPipeline(Base):
+    '''Background execution for AnswerBot queries.'''
+
+    def __init__(self, configuration, max_workers=2, name='pipeline', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+        self.configuration = configuration
+
+        self.tasks = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='SciBot-task')
+        self.db_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='SciBot-db')
+        self.db = None # Created in the worker thread, on first use
+
+        self.chunks = {} # (table_suffix, doc_id, chunk_num) : future
+        self.pending = []
+        self._lock = threading.Lock()
+
+
+    # Execution
+    ##################################################
+    def run(self, function, *args, **kwargs):
+        '''Run a function in the background; returns a future.'''
+
+        return self.track(self.tasks.submit(propagate(function), *args, **kwargs))
+
+
+    def track(self, future):
+        '''Keep track of outstanding work (reporting failures of completed work).'''
+
+        with self._lock:
+            done = [ f for f in self.pending if f.done() ]
+            self.pending = [ f for f in self.pending if not f.done() ] + [future]
+        for f in done:
+            self.report(f)
+
+        return future
+
+
+    def report(self, future):
+        try:
+            future.result()
+        except Exception as e:
+            self.msg_error(f"Background operation failed ({type(e).__name__}: {e})")
+
+
+    def worker_db(self):
+
+        if self.db is None:
+            from .dbase import DocumentDatabase
+            self.db = DocumentDatabase(config=self.configuration['doc_database'], verbosity=self.verbosity)
+
+        return self.db
+
+
+    def db_call(self, method, *args, **kwargs):
+        '''Call a DocumentDatabase method on the worker's connection; returns a future.'''
+
+        return self.track(self.db_thread.submit(propagate(lambda: getattr(self.worker_db(), method)(*args, **kwargs))))
+
+
+    # Chunk prefetch
+    ##################################################
+    def prefetch_chunks(self, keys):
+        '''Start fetching chunks (batched, one query per table_suffix); keys
+        are (table_suffix, doc_id, chunk_num).'''
+
+        by_suffix = {}
+        for key in keys:
+            if key not in self.chunks:
+                by_suffix.setdefault(key[0], []).append(key)
+
+        for table_suffix, suffix_keys in by_suffix.items():
+            future = self.db_call('get_chunks', [ (doc_id, chunk_num) for _, doc_id, chunk_num in suffix_keys ], table_suffix=table_suffix)
+            for key in suffix_keys:
+                self.chunks[key] = future
+
+
+    def get_chunk(self, key):
+        '''The prefetched chunk (waiting for it, if necessary); or None if it
+        was not prefetched.'''
+
+        future = self.chunks.get(key)
+        if future is None:
+            return None
+
+        try:
+            return future.result().get( (key[1], key[2]) )
+        except Exception as e:
+            self.msg_warning(f"Chunk prefetch failed ({type(e).__name__}: {e})")
+            return None
+
+
+    def reset(self):
+        '''Forget prefetched chunks (at the start of each query).'''
+        self.chunks = {}
+
+
+    # Completion
+    ##################################################
+    def flush(self):
+        '''Wait for outstanding background work (reporting any failures).'''
+
+        while True:
+            with self._lock:
+                if len(self.pending)==0:
+                    break
+                future = self.pending.pop(0)
+            self.report(future)
+
+
+    def close(self):
+
+        self.flush()
+        self.tasks.shutdown(wait=True)
+        if self.db is not None:
+            self.db_thread.submit(self.db.close).result()
+        self.db_thread.shutdown(wait=True)
+
+
+
+class StageTimer():
+    '''Accumulates the wall-clock time spent in named stages. Each stage is
+    also traced, as a span named prefix+name (which the stage yields).'''
+
+    def __init__(self, prefix='query.'):
+        self.timings = {}
+        self.prefix = prefix
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            with span(self.prefix+name) as s:
+                yield s
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
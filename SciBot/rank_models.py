@@ -0,0 +1,709 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Filename: rank_models.py
+Author: Kevin G. Yager, Brookhaven National Laboratory
+Email: kyager@bnl.gov
+Date created: 2026-10-19
+Description:
+ Statistical models of pairwise comparisons, used to rank documents from a
+limited number of (expensive) LLM comparisons. BradleyTerry fits a strength
+to each item, estimates the uncertainty of each strength (and of each
+item's rank), and proposes the comparisons that are most informative (close
+and uncertain pairs). Comparing only those, a stable ordering needs roughly
+O(n log n) comparisons, rather than the O(n^2) of a comparison sort.
+ScoreGraph holds the recorded comparisons as arrays (with per-document
+tallies and CSR adjacency), shared by the ranking heuristics.
+PairwiseSurrogate predicts comparisons from document embeddings, so that
+ranking can start from a sensible order (and skip near-certain comparisons).
+"""
+
+from .Base import Base
+
+import numpy as np
+
+
+class BradleyTerry(Base):
+    '''Bradley-Terry model: item i beats item j with probability
+        P(i>j) = 1/(1+exp(-(theta_i-theta_j)))
+    Strengths (theta) are fit by maximum a posteriori, using minorization-
+    maximization; the prior is equivalent to each item having played
+    'prior' wins and 'prior' losses against a reference item (theta=0).'''
+
+    def __init__(self, num_items=0, prior=1.0, name='BradleyTerry', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+        self.prior = prior
+        self.resize(num_items)
+
+        self.winners = np.zeros(0, dtype=int)
+        self.losers = np.zeros(0, dtype=int)
+
+
+    def resize(self, num_items):
+        '''Set the number of items (new items start at theta=0).'''
+
+        theta = np.zeros(num_items)
+        if hasattr(self, 'theta'):
+            n = min(num_items, len(self.theta))
+            theta[:n] = self.theta[:n]
+
+        self.num_items = num_items
+        self.theta = theta
+        self.std = np.full(num_items, 1/np.sqrt(self.prior*0.5)) # (Prior uncertainty)
+
+
+    # Data
+    ##################################################
+    def set_outcomes(self, winners, losers):
+        '''The comparison outcomes (item indices), as two arrays.'''
+
+        self.winners = np.asarray(winners, dtype=int)
+        self.losers = np.asarray(losers, dtype=int)
+
+
+    def add_outcome(self, winner, loser):
+
+        self.winners = np.append(self.winners, winner)
+        self.losers = np.append(self.losers, loser)
+
+
+    # Fitting
+    ##################################################
+    def fit(self, max_iterations=500, tolerance=1e-6):
+        '''Fit the strengths (starting from the current ones), then estimate
+        their uncertainties.'''
+
+        n = self.num_items
+        winners, losers = self.winners, self.losers
+        wins = np.bincount(winners, minlength=n) + self.prior
+
+        pi = np.exp(self.theta)
+        for iteration in range(max_iterations):
+            # MM update (Hunter, 2004): pi_i = W_i / sum_j n_ij/(pi_i+pi_j)
+            inverse = 1/(pi[winners] + pi[losers])
+            denominator = 2*self.prior/(pi + 1) # Games against the reference item
+            denominator += np.bincount(winners, weights=inverse, minlength=n) + np.bincount(losers, weights=inverse, minlength=n)
+
+            updated = wins/denominator
+            change = np.max(np.abs(np.log(updated) - np.log(pi))) if n>0 else 0
+            pi = updated
+            if change<tolerance:
+                break
+
+        self.theta = np.log(pi)
+        self.iterations = iteration+1 if n>0 else 0
+        self.update_uncertainty()
+
+        return self.theta
+
+
+    def update_uncertainty(self):
+        '''Standard deviation of each strength, from the (diagonal) Fisher information.'''
+
+        n = self.num_items
+        p = self.probability(self.winners, self.losers)
+        information = p*(1-p)
+        p_reference = 1/(1 + np.exp(-self.theta))
+        information = 2*self.prior*p_reference*(1-p_reference) + np.bincount(self.winners, weights=information, minlength=n) + np.bincount(self.losers, weights=information, minlength=n)
+
+        self.std = 1/np.sqrt(information)
+
+        return self.std
+
+
+    # Predictions
+    ##################################################
+    def probability(self, i, j):
+        '''Probability that item i beats item j.'''
+
+        return 1/(1 + np.exp(-(self.theta[i] - self.theta[j])))
+
+
+    def order(self):
+        '''Item indices, strongest first.'''
+
+        return np.argsort(-self.theta, kind='stable')
+
+
+    def ranks(self):
+        '''The rank (0 = strongest) of each item.'''
+
+        ranks = np.empty(self.num_items, dtype=int)
+        ranks[self.order()] = np.arange(self.num_items)
+
+        return ranks
+
+
+    def rank_intervals(self, coverage=0.95, samples=200, seed=0):
+        '''Confidence interval of each item's rank, by sampling strengths from
+        their (approximate) posterior. Returns (low, high) arrays.'''
+
+        rng = np.random.default_rng(seed)
+        n = self.num_items
+
+        ranks = np.empty((samples, n), dtype=int)
+        for k in range(samples):
+            theta = self.theta + self.std*rng.standard_normal(n)
+            ranks[k, np.argsort(-theta)] = np.arange(n)
+
+        tail = 100*(1-coverage)/2
+        low, high = np.percentile(ranks, [tail, 100-tail], axis=0)
+
+        return low.astype(int), high.astype(int)
+
+
+    # Active learning
+    ##################################################
+    def information_gain(self, i, j):
+        '''Expected reduction in uncertainty from comparing items i and j:
+        outcomes of close pairs are least predictable, and comparisons of
+        uncertain items are most informative.'''
+
+        p = self.probability(i, j)
+
+        return p*(1-p)*( self.std[i]**2 + self.std[j]**2 )
+
+
+    def select_pairs(self, num_pairs=1, window=5, exclude=None):
+        '''The most informative comparisons. Candidates are the items within
+        window positions of each other in the current ordering; pairs in
+        exclude (a set of (min, max) index tuples) are skipped, and no item
+        appears twice (so the comparisons are independent).'''
+
+        order = self.order()
+        n = len(order)
+        exclude = exclude or set()
+
+        while True:
+            i_list, j_list = [], []
+            for offset in range(1, min(window, n-1)+1):
+                i_list.append(order[:-offset])
+                j_list.append(order[offset:])
+            if len(i_list)==0:
+                return []
+            i, j = np.concatenate(i_list), np.concatenate(j_list)
+
+            gain = self.information_gain(i, j)
+
+            pairs = []
+            used = set()
+            for k in np.argsort(-gain, kind='stable'):
+                a, b = int(i[k]), int(j[k])
+                if a in used or b in used or (min(a, b), max(a, b)) in exclude:
+                    continue
+                pairs.append( (a, b) )
+                used.update([a, b])
+                if len(pairs)>=num_pairs:
+                    return pairs
+
+            if window>=n-1:
+                return pairs
+            # Nearby pairs have (mostly) been compared already; look further afield
+            window *= 2
+
+
+    def converged(self, target_width, coverage=0.95, quantile=0.9):
+        '''Whether the ranks are known to within target_width positions (for
+        the given quantile of items; the ranks of near-equal items can remain
+        uncertain indefinitely).'''
+
+        if self.num_items==0:
+            return True
+
+        low, high = self.rank_intervals(coverage=coverage)
+
+        return np.quantile(high-low, quantile)<=target_width
+
+
+
+def csr_adjacency(sources, targets, num_items):
+    '''Compressed sparse row adjacency: the targets of item i are
+    indices[indptr[i]:indptr[i+1]]. Returns (indptr, indices).'''
+
+    sources = np.asarray(sources, dtype=int)
+    order = np.argsort(sources, kind='stable')
+    indptr = np.zeros(num_items+1, dtype=int)
+    np.cumsum(np.bincount(sources, minlength=num_items), out=indptr[1:])
+
+    return indptr, np.asarray(targets, dtype=int)[order]
+
+
+
+class FeedbackArcSolver(Base):
+    '''Orders items so that as few comparisons as possible disagree with the
+    order (a minimum feedback arc set, for a possibly-intransitive set of
+    comparison outcomes). Each edge (winner, loser) is 'bad' if the winner
+    is placed after the loser.
+    The order is initialized with KwikSort (randomized, pivot-based), then
+    improved by local search: each item is moved to its best insertion
+    point, where the change in the number of bad edges is evaluated from
+    the item's own edges alone.'''
+
+    def __init__(self, winners, losers, num_items, seed=0, name='FeedbackArcSolver', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+        self.num_items = num_items
+        self.winners = np.asarray(winners, dtype=int)
+        self.losers = np.asarray(losers, dtype=int)
+        self.rng = np.random.default_rng(seed)
+
+        # Items each item beat (outward) and was beaten by (inward)
+        self.out_ptr, self.out_idx = csr_adjacency(self.winners, self.losers, num_items)
+        self.in_ptr, self.in_idx = csr_adjacency(self.losers, self.winners, num_items)
+
+
+    def beats(self, i):
+        return self.out_idx[self.out_ptr[i]:self.out_ptr[i+1]]
+
+    def beaten_by(self, i):
+        return self.in_idx[self.in_ptr[i]:self.in_ptr[i+1]]
+
+
+    # Objective
+    ##################################################
+    def count_bad(self, order):
+        '''Number of edges that point the wrong way, for an order (array of items).'''
+
+        pos = np.empty(self.num_items, dtype=int)
+        pos[order] = np.arange(len(order))
+
+        return int(np.sum(pos[self.winners]>pos[self.losers]))
+
+
+    # Initialization
+    ##################################################
+    def kwik_sort(self, initial=None):
+        '''Randomized pivot sort: items that (net) beat the pivot go before
+        it, those it beats after; unrelated items keep their initial
+        relative order.'''
+
+        initial = np.arange(self.num_items) if initial is None else np.asarray(initial)
+        initial_pos = np.empty(self.num_items, dtype=int)
+        initial_pos[initial] = np.arange(len(initial))
+
+        order = []
+        stack = [list(initial)]
+        while stack:
+            segment = stack.pop()
+            if not isinstance(segment, list):
+                order.append(segment)
+                continue
+            if len(segment)<=1:
+                order.extend(segment)
+                continue
+
+            pivot = segment[self.rng.integers(len(segment))]
+            net = {}
+            for u in self.beats(pivot):
+                net[u] = net.get(u, 0) - 1
+            for u in self.beaten_by(pivot):
+                net[u] = net.get(u, 0) + 1
+
+            left, right = [], []
+            for u in segment:
+                if u==pivot:
+                    continue
+                w = net.get(u, 0)
+                if w>0 or (w==0 and initial_pos[u]<initial_pos[pivot]):
+                    left.append(u)
+                else:
+                    right.append(u)
+
+            # (Processed last-in, first-out)
+            stack.extend([right, pivot, left])
+
+        return np.asarray(order, dtype=int)
+
+
+    # Local search
+    ##################################################
+    def best_insertion(self, v, pos):
+        '''The best place to move item v to. Returns (gain, gap), where gap is
+        the position v would have (counted without v).'''
+
+        p = pos[v]
+        x_out = pos[self.beats(v)]
+        x_in = pos[self.beaten_by(v)]
+
+        current = np.sum(x_out<p) + np.sum(x_in>p)
+        if current==0:
+            return 0, p
+
+        # Positions of v's neighbors once v is removed
+        x_out = np.sort(x_out - (x_out>p))
+        x_in = np.sort(x_in - (x_in>p))
+
+        gaps = np.unique(np.concatenate( ([p], x_out, x_out+1, x_in, x_in+1) ))
+        gaps = gaps[(gaps>=0) & (gaps<self.num_items)]
+
+        # Bad edges if inserted at each gap: out-neighbors before v, in-neighbors after v
+        cost = np.searchsorted(x_out, gaps, side='left') + len(x_in) - np.searchsorted(x_in, gaps, side='left')
+        best = np.argmin(cost)
+
+        return int(current - cost[best]), int(gaps[best])
+
+
+    def move(self, order, pos, v, gap):
+        '''Move item v to position gap (updating order and pos in place).'''
+
+        p = pos[v]
+        if gap>p:
+            order[p:gap] = order[p+1:gap+1].copy()
+        elif gap<p:
+            order[gap+1:p+1] = order[gap:p].copy()
+        order[gap] = v
+
+        lo, hi = min(p, gap), max(p, gap)
+        pos[order[lo:hi+1]] = np.arange(lo, hi+1)
+
+
+    def local_search(self, order, max_sweeps=50):
+        '''Move items to their best insertion points, until no move helps.'''
+
+        order = np.array(order, dtype=int)
+        pos = np.empty(self.num_items, dtype=int)
+        pos[order] = np.arange(len(order))
+
+        for sweep in range(max_sweeps):
+            total_gain = 0
+            for v in self.rng.permutation(self.num_items):
+                gain, gap = self.best_insertion(v, pos)
+                if gain>0:
+                    self.move(order, pos, v, gap)
+                    total_gain += gain
+
+            self.msg(f'Sweep {sweep+1}: removed {total_gain:,d} bad edges', 5, 2)
+            if total_gain==0:
+                break
+
+        return order
+
+
+    def solve(self, initial=None, restarts=5, max_sweeps=50):
+        '''The best order found (starting from the initial order, and from
+        several KwikSort orders). Returns (order, num_bad).'''
+
+        initial = np.arange(self.num_items) if initial is None else np.asarray(initial, dtype=int)
+
+        best, best_bad = None, None
+        starts = [initial] + [ self.kwik_sort(initial) for i in range(restarts) ]
+        for i, start in enumerate(starts):
+            order = self.local_search(start, max_sweeps=max_sweeps)
+            num_bad = self.count_bad(order)
+            self.msg(f'Start {i+1}/{len(starts)}: {self.count_bad(start):,d} → {num_bad:,d} bad edges', 4, 1)
+            if best is None or num_bad<best_bad:
+                best, best_bad = order, num_bad
+
+        return best, best_bad
+
+
+
+class ScoreGraph():
+    '''The pairwise comparison outcomes (scores_pairwise rows), as arrays
+    over dense document indices: for each comparison, the indices of the
+    two documents (a, b) and of the winner (-1 if there was no clear
+    winner). Per-document counts and wins are kept up to date as
+    comparisons are added; the CSR adjacency is rebuilt when needed.
+    The outcome of each pair of doc_ids (in either order) can be looked up
+    in the pair index.'''
+
+    def __init__(self, doc_ids=None, capacity=1024):
+
+        self.doc_ids = []
+        self.index = {} # doc_id : dense index
+        for doc_id in (doc_ids or []):
+            self.doc_index(doc_id)
+
+        self.num_scores = 0
+        self.a = np.zeros(capacity, dtype=int)
+        self.b = np.zeros(capacity, dtype=int)
+        self.winner = np.zeros(capacity, dtype=int)
+
+        self._counts = np.zeros(len(self.doc_ids), dtype=int)
+        self._wins = np.zeros(len(self.doc_ids), dtype=int)
+        self._adjacency = None
+
+        self.pairs = {} # pair_key : winner (as recorded; the first comparison of a pair)
+
+
+    @classmethod
+    def from_rows(cls, rows, doc_ids=None):
+        '''Build the graph from scores_pairwise rows (doc_ids, if given,
+        fixes the first dense indices).'''
+
+        graph = cls(doc_ids=doc_ids, capacity=max(1024, 2*len(rows)))
+        graph.add_rows(rows)
+
+        return graph
+
+
+    def doc_index(self, doc_id):
+        '''The dense index of a document (added if new).'''
+
+        idx = self.index.get(doc_id)
+        if idx is None:
+            idx = len(self.doc_ids)
+            self.index[doc_id] = idx
+            self.doc_ids.append(doc_id)
+        return idx
+
+
+    # Pair index
+    ##################################################
+    @staticmethod
+    def pair_key(doc_id_A, doc_id_B):
+        '''Order-independent key for a pair of doc_ids (packed into an int64);
+        works elementwise on arrays.'''
+
+        low, high = np.minimum(doc_id_A, doc_id_B), np.maximum(doc_id_A, doc_id_B)
+
+        return (np.asarray(low, dtype=np.int64) << 32) | np.asarray(high, dtype=np.int64)
+
+
+    def lookup(self, doc_id_A, doc_id_B):
+        '''The recorded winner of a comparison of the two docs (or None).'''
+        return self.pairs.get(int(self.pair_key(doc_id_A, doc_id_B)))
+
+
+    def contains(self, doc_id_A, doc_id_B):
+        return int(self.pair_key(doc_id_A, doc_id_B)) in self.pairs
+
+
+    # Updates
+    ##################################################
+    def add_rows(self, rows):
+
+        a = np.asarray([ self.doc_index(row['doc_id_A']) for row in rows ], dtype=int)
+        b = np.asarray([ self.doc_index(row['doc_id_B']) for row in rows ], dtype=int)
+        winner = np.asarray([ self.index[row['winner']] if row['winner'] in self.index and row['winner'] in (row['doc_id_A'], row['doc_id_B']) else -1 for row in rows ], dtype=int)
+        self.append(a, b, winner)
+
+        # (Reversed, so that the first comparison of a pair is kept)
+        doc_ids = np.asarray(self.doc_ids, dtype=np.int64)
+        keys = self.pair_key(doc_ids[a], doc_ids[b]).tolist()
+        winners = [ row['winner'] for row in rows ]
+        pairs = dict(zip(reversed(keys), reversed(winners)))
+        pairs.update(self.pairs)
+        self.pairs = pairs
+
+
+    def add(self, doc_id_A, doc_id_B, winner):
+        '''Add one comparison (winner is a doc_id, or a value <=0 if there was
+        no clear winner).'''
+
+        a, b = self.doc_index(doc_id_A), self.doc_index(doc_id_B)
+        w = self.index[winner] if winner in (doc_id_A, doc_id_B) else -1
+        self.append(np.asarray([a]), np.asarray([b]), np.asarray([w]))
+        self.pairs.setdefault(int(self.pair_key(doc_id_A, doc_id_B)), winner)
+
+
+    def append(self, a, b, winner):
+
+        n = self.num_scores + len(a)
+        if n>len(self.a):
+            capacity = max(n, 2*len(self.a))
+            for name in ['a', 'b', 'winner']:
+                array = np.zeros(capacity, dtype=int)
+                array[:self.num_scores] = getattr(self, name)[:self.num_scores]
+                setattr(self, name, array)
+
+        self.a[self.num_scores:n] = a
+        self.b[self.num_scores:n] = b
+        self.winner[self.num_scores:n] = winner
+        self.num_scores = n
+
+        num_docs = len(self.doc_ids)
+        self._counts = np.pad(self._counts, (0, num_docs-len(self._counts)))
+        self._wins = np.pad(self._wins, (0, num_docs-len(self._wins)))
+        self._counts += np.bincount(a, minlength=num_docs) + np.bincount(b, minlength=num_docs)
+        winner = np.asarray(winner)
+        self._wins += np.bincount(winner[winner>=0], minlength=num_docs)
+
+        self._adjacency = None
+
+
+    # Statistics
+    ##################################################
+    def counts(self):
+        '''Number of comparisons of each document.'''
+        return self._counts
+
+    def wins(self):
+        '''Number of comparisons won by each document.'''
+        return self._wins
+
+    def win_ratios(self, default=0.5):
+        '''Fraction of comparisons won (default, for documents never compared).'''
+
+        counts = self._counts
+        ratios = np.full(len(counts), default, dtype=float)
+        compared = counts>0
+        ratios[compared] = self._wins[compared]/counts[compared]
+
+        return ratios
+
+
+    # Adjacency
+    ##################################################
+    def edges(self):
+        '''The decisive comparisons, as (winners, losers) arrays of dense indices.'''
+
+        a, b, winner = self.a[:self.num_scores], self.b[:self.num_scores], self.winner[:self.num_scores]
+        decisive = winner>=0
+        winners = winner[decisive]
+        losers = np.where(winners==a[decisive], b[decisive], a[decisive])
+
+        return winners, losers
+
+
+    def adjacency(self):
+        '''CSR adjacency, as (out_ptr, out_idx, in_ptr, in_idx): the documents
+        beaten by i are out_idx[out_ptr[i]:out_ptr[i+1]], and those that beat
+        i are in_idx[in_ptr[i]:in_ptr[i+1]].'''
+
+        if self._adjacency is None:
+            winners, losers = self.edges()
+            num_docs = len(self.doc_ids)
+            self._adjacency = csr_adjacency(winners, losers, num_docs) + csr_adjacency(losers, winners, num_docs)
+
+        return self._adjacency
+
+
+    def beats(self, doc_id):
+        '''The doc_ids that doc_id beat.'''
+
+        out_ptr, out_idx, _, _ = self.adjacency()
+        i = self.index.get(doc_id)
+        if i is None:
+            return []
+
+        return [ self.doc_ids[j] for j in out_idx[out_ptr[i]:out_ptr[i+1]] ]
+
+
+    def beaten_by(self, doc_id):
+        '''The doc_ids that beat doc_id.'''
+
+        _, _, in_ptr, in_idx = self.adjacency()
+        i = self.index.get(doc_id)
+        if i is None:
+            return []
+
+        return [ self.doc_ids[j] for j in in_idx[in_ptr[i]:in_ptr[i+1]] ]
+
+
+    def subset(self, doc_ids):
+        '''The comparisons between the given documents, as (a, b, winner)
+        arrays of positions in doc_ids (winner is -1 if there was no clear
+        winner).'''
+
+        positions = np.full(len(self.doc_ids)+1, -1, dtype=int) # (The last entry maps winner=-1 to -1)
+        for i, doc_id in enumerate(doc_ids):
+            if doc_id in self.index:
+                positions[self.index[doc_id]] = i
+
+        a = positions[self.a[:self.num_scores]]
+        b = positions[self.b[:self.num_scores]]
+        winner = positions[self.winner[:self.num_scores]]
+        keep = (a>=0) & (b>=0)
+
+        return a[keep], b[keep], winner[keep]
+
+
+    def subset_edges(self, doc_ids):
+        '''The decisive comparisons between the given documents, as (winners,
+        losers) arrays of positions in doc_ids.'''
+
+        a, b, winner = self.subset(doc_ids)
+        decisive = winner>=0
+        winners = winner[decisive]
+        losers = np.where(winners==a[decisive], b[decisive], a[decisive])
+
+        return winners, losers
+
+
+
+class PairwiseSurrogate(Base):
+    '''Predicts pairwise outcomes from item feature vectors (e.g. the mean
+    chunk embedding of each document), using logistic regression on the
+    difference of the vectors:
+        P(i>j) = 1/(1+exp(-w.(x_i-x_j)))
+    so that each item has a score s_i = w.x_i (and the predicted ordering is
+    by score). The vectors are first projected onto their leading principal
+    components, and w is fit by Newton's method (with an L2 penalty).'''
+
+    def __init__(self, num_components=64, l2=1.0, name='surrogate', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+        self.num_components = num_components
+        self.l2 = l2
+
+        self.features = None
+        self.weights = None
+
+
+    def set_vectors(self, vectors):
+        '''The feature vector of each item (rows).'''
+
+        vectors = np.asarray(vectors, dtype=float)
+        centered = vectors - vectors.mean(axis=0)
+        k = min(self.num_components, *centered.shape)
+        if k>0:
+            _, _, components = np.linalg.svd(centered, full_matrices=False)
+            features = centered @ components[:k].T
+            # (Unit variance per component, so that one penalty suits all)
+            features /= np.maximum(features.std(axis=0), 1e-12)
+        else:
+            features = np.zeros( (len(vectors), 0) )
+
+        self.features = features
+        self.weights = np.zeros(features.shape[1])
+
+
+    def fit(self, winners, losers, max_iterations=50, tolerance=1e-6):
+        '''Fit to the outcomes (item indices, as two arrays).'''
+
+        differences = self.features[np.asarray(winners, dtype=int)] - self.features[np.asarray(losers, dtype=int)]
+        k = differences.shape[1]
+
+        w = self.weights
+        for iteration in range(max_iterations):
+            p = 1/(1 + np.exp(-differences @ w)) # Probability of the observed outcome
+            gradient = differences.T @ (1-p) - self.l2*w
+            hessian = (differences.T * (p*(1-p))) @ differences + self.l2*np.eye(k)
+            step = np.linalg.solve(hessian, gradient)
+            w = w + step
+            if np.max(np.abs(step), initial=0)<tolerance:
+                break
+
+        self.weights = w
+        self.iterations = iteration+1
+
+        return w
+
+
+    def scores(self):
+        return self.features @ self.weights
+
+
+    def probability(self, i, j):
+        '''Predicted probability that item i beats item j.'''
+
+        # (Only the two feature rows are needed, not the scores of all items)
+        return 1/(1 + np.exp(-(self.features[i] - self.features[j]) @ self.weights))
+
+
+    def order(self):
+        '''Items, from predicted best to worst.'''
+        return np.argsort(-self.scores(), kind='stable')
+
+
+    def evaluate(self, winners, losers):
+        '''Accuracy and mean log-loss of the predictions for the given outcomes.'''
+
+        p = np.clip(self.probability(np.asarray(winners, dtype=int), np.asarray(losers, dtype=int)), 1e-12, 1)
+        if len(p)==0:
+            return {'accuracy': None, 'log_loss': None, 'count': 0}
+
+        return {'accuracy': float(np.mean(p>0.5)), 'log_loss': float(-np.mean(np.log(p))), 'count': len(p)}
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Filename: summarize.py
+Author: Kevin G. Yager, Brookhaven National Laboratory
+Email: kyager@bnl.gov
+Date created: 2026-10-19
+Description:
+ Concurrent (map-reduce) summarization of many documents. Chunk summaries
+for all the documents are submitted to the LLM in parallel (with a bounded
+number of requests in flight), reassembled in order for each document, and
+optionally condensed with a second (reduce) pass.
+"""
+
+from .Base import Base
+
+import hashlib
+import json
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class SummaryEngine(Base):
+    '''Summarizes the chunks of many documents concurrently.
+    Completed summaries are cached (keyed by model and a hash of the
+    request), so that a re-run only pays for the missing pieces.'''
+
+    def __init__(self, configuration, bot=None, max_in_flight=8, cache_file=None, name='summarize', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+        self.configuration = configuration
+
+        if bot is None:
+            from .bots import SummarizeBot
+            bot = SummarizeBot(configuration=self.configuration, name='sum_bot', verbosity=self.verbosity)
+        self.bot = bot
+
+        self.max_in_flight = max_in_flight
+
+        self._lock = threading.Lock()
+        self.cache = {}
+        self.cache_file = None
+        if cache_file is not None:
+            self.load_cache(cache_file)
+
+        self.stats = {'requests': 0, 'cached': 0, 'failed': 0}
+
+
+    # Cache of completed summaries
+    ##################################################
+    def cache_key(self, request):
+        '''Summaries are keyed by (model, hash of the exact request text).'''
+
+        chunk_hash = hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+        return '{}:{}'.format(self.bot.model, chunk_hash)
+
+
+    def load_cache(self, cache_file):
+        '''Load previously-completed summaries. The cache is a JSON-lines
+        file, which we append to as each summary completes (so that a crash
+        loses at most the requests that were in flight).'''
+
+        self.cache_file = Path(cache_file)
+
+        if self.cache_file.is_file():
+            with open(self.cache_file) as fin:
+                for line in fin:
+                    try:
+                        item = json.loads(line)
+                        self.cache[item['key']] = item['summary']
+                    except (ValueError, KeyError):
+                        # Partially-written final line (e.g. from a crash)
+                        pass
+
+            self.msg(f"Loaded {len(self.cache):,d} cached summaries from: {self.cache_file}", 3, 1)
+
+
+    def cache_get(self, key):
+        with self._lock:
+            return self.cache.get(key)
+
+
+    def cache_put(self, key, summary):
+        with self._lock:
+            self.cache[key] = summary
+            if self.cache_file is not None:
+                with open(self.cache_file, 'a') as fout:
+                    fout.write(json.dumps({'key': key, 'summary': summary}) + '\n')
+
+
+    # Individual requests
+    ##################################################
+    def summarize(self, text, doc_name, request_template=None):
+        '''Summarize a single block of text (using the cache if possible).
+        This is thread-safe; it is the unit of work handed to the pool.'''
+
+        request_template = request_template or self.bot.request_template
+        request = request_template.format(doc_name, text)
+        key = self.cache_key(request)
+
+        summary = self.cache_get(key)
+        if summary is not None:
+            with self._lock:
+                self.stats['cached'] += 1
+            return summary
+
+        summary = self.bot.summarize(text, doc_name, request_template=request_template)
+
+        with self._lock:
+            self.stats['requests'] += 1
+        self.cache_put(key, summary)
+
+        return summary
+
+
+    def reduce_windows(self, summaries):
+        '''Group the chunk summaries into blocks that fit within the request window.'''
+
+        window = self.bot.get_request_window()
+
+        blocks = []
+        current = ''
+        for summary in summaries:
+            if current and len(current) + len(summary) + 2 > window:
+                blocks.append(current)
+                current = ''
+            current = summary if not current else current + '\n\n' + summary
+        if current:
+            blocks.append(current)
+
+        return blocks
+
+
+    # Map-reduce over documents
+    ##################################################
+    def run(self, documents, on_complete=None, reduce=False):
+        '''Summarize a collection of documents.
+
+        documents is an iterable of (key, doc_name, chunks); it is consumed
+        lazily, so documents are only loaded as there is room for their
+        requests. on_complete(key, summaries) is called (in this thread) as
+        each document finishes; summaries are in chunk order. Returns a dict
+        of key: summaries for all documents that succeeded.'''
+
+        documents = iter(documents)
+        results = {}
+
+        pending = {} # future -> (key, stage, index)
+        state = {} # key -> { 'doc_name', 'summaries', 'remaining', 'stage', 'failed' }
+
+        def finish(key):
+            info = state.pop(key)
+            if info['failed']:
+                self.msg_error(f"Summarization of {key} failed; it will be retried on the next run.")
+                return
+            summaries = info['summaries']
+            self.msg(f"Completed {key} ({len(summaries):,d} summaries)", 3, 1)
+            results[key] = summaries
+            if on_complete is not None:
+                on_complete(key, summaries)
+
+        def submit_stage(pool, key, stage, blocks, request_template=None):
+            info = state[key]
+            info['stage'] = stage
+            info['summaries'] = [None]*len(blocks)
+            info['remaining'] = len(blocks)
+            if len(blocks)==0:
+                finish(key)
+            for i, block in enumerate(blocks):
+                future = pool.submit(self.summarize, block, info['doc_name'], request_template)
+                pending[future] = (key, stage, i)
+
+        self.timing_start()
+        num_docs = 0
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+
+            exhausted = False
+            while not exhausted or pending:
+
+                # Keep the pool full (but not over-full)
+                while not exhausted and len(pending)<self.max_in_flight:
+                    try:
+                        key, doc_name, chunks = next(documents)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    num_docs += 1
+                    state[key] = {'doc_name': doc_name, 'failed': False}
+                    submit_stage(pool, key, 'map', chunks)
+
+                if not pending:
+                    continue
+
+                done, _ = wait(list(pending.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, stage, i = pending.pop(future)
+                    info = state[key]
+
+                    try:
+                        info['summaries'][i] = future.result()
+                    except Exception as e:
+                        self.msg_error(f'Python exception ({key} {stage} #{i}): ' + type(e).__name__)
+                        with self._lock:
+                            self.stats['failed'] += 1
+                        info['failed'] = True
+
+                    info['remaining'] -= 1
+                    if info['remaining']>0:
+                        continue
+
+                    if reduce and stage=='map' and not info['failed']:
+                        blocks = self.reduce_windows(info['summaries'])
+                        submit_stage(pool, key, 'reduce', blocks, request_template=self.bot.reduce_template)
+                    else:
+                        finish(key)
+
+        self.timing_end_msg(f"Summarized {len(results):,d}/{num_docs:,d} documents ({self.stats['requests']:,d} requests, {self.stats['cached']:,d} cached, {self.stats['failed']:,d} failed);", threshold=3)
+
+        return results
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Filename: tokens.py
+Author: Kevin G. Yager, Brookhaven National Laboratory
+Email: kyager@bnl.gov
+Date created: 2026-10-19
+Description:
+ Token accounting. Counts tokens using a fast local tokenizer (tiktoken),
+so that prompts can be packed up to an exact token budget (rather than
+estimating 4 chars per token). If tiktoken is not installed, we fall back
+to the character-based estimate.
+"""
+
+from .Base import Base
+
+import functools
+import threading
+
+
+class TokenCounter(Base):
+    '''Counts tokens for a given model. Counts are memoized (LRU), since the
+    same chunks, doc_names and conversation messages are counted repeatedly.'''
+
+    # Approximate overhead of the chat format
+    tokens_per_message = 4
+    tokens_reply_priming = 3
+
+    def __init__(self, model='gpt-4o', cache_size=8192, name='tokens', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+        self.model = model
+
+        try:
+            import tiktoken
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                # Non-OpenAI (or unknown) models; this is an approximation
+                self.encoding = tiktoken.get_encoding('cl100k_base')
+        except ImportError:
+            self.msg_warning('tiktoken not available; token counts will be estimated from character counts.', threshold=4)
+            self.encoding = None
+
+        # Cached, for the strings that recur between queries (chunks, context
+        # sections); whole prompts and documents should use count_uncached
+        self.count = functools.lru_cache(maxsize=cache_size)(self.count_uncached)
+
+
+    def count_uncached(self, text):
+
+        if self.encoding is None:
+            return (len(text)+3)//4
+
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+    def count_batch(self, texts):
+        '''Count tokens for many texts (e.g. at ingest), bypassing the cache.'''
+
+        if self.encoding is None:
+            return [ (len(text)+3)//4 for text in texts ]
+
+        return [ len(tokens) for tokens in self.encoding.encode_ordinary_batch(list(texts)) ]
+
+
+    def count_messages(self, messages):
+        '''Tokens consumed by a list of chat messages.'''
+
+        total = self.tokens_reply_priming
+        for message in messages:
+            total += self.tokens_per_message + self.count(message['content'])
+
+        return total
+
+
+    def truncate(self, text, max_tokens):
+        '''Trim text so that it fits within max_tokens.'''
+
+        if self.count_uncached(text)<=max_tokens:
+            return text
+
+        if self.encoding is None:
+            return text[:max_tokens*4]
+
+        return self.encoding.decode(self.encoding.encode(text, disallowed_special=())[:max_tokens])
+
+
+
+_counters = {}
+_counters_lock = threading.Lock()
+
+def get_token_counter(model, **kwargs):
+    '''Token counters (and their caches) are shared by all the bots using a model.'''
+
+    with _counters_lock:
+        if model not in _counters:
+            _counters[model] = TokenCounter(model=model, **kwargs)
+
+        return _counters[model]
@@ -12,6 +12,8 @@ Description:
 
 from .Base import Base
 from .LLMs import *
+from .transport import get_transport
+import json
 import re
 
 
@@ -29,7 +31,7 @@ class CompareBot(Base):
         # For LLM responses
         self.model = self.configuration['openai']['model']
         self.token_limit = self.configuration['openai']['model_token_limit']
-        self.LLM_chat = OpenAI_LLM(api_key=api_key, model=self.model, token_limit=self.token_limit, name='OpenAI')
+        self.LLM_chat = OpenAI_LLM(api_key=api_key, model=self.model, token_limit=self.token_limit, transport=get_transport(self.configuration), base_url=self.configuration['openai'].get('base_url'), client_settings=self.configuration['openai'], name='OpenAI')
         
         instruction = """Analyze the two extracts given below, which were taken from PUBLICATION_A and PUBLICATION_B (scientific publications). I want you to decide which one is more likely to be "high impact", meaning that it becomes influential in terms of creating community excitement, driving follow-on work, and changin perspectives in the field. Please compose a reply that provides a very brief impact analysis of PUBLICATION_A and PUBLICATION_B, then compares the two, and finishes off with a clear statement that strictly follows this format: "The higher-impact publication is: PUBLICATION_X" (where X is A or B)."""
 
@@ -97,7 +99,7 @@ class ClassifyBot(Base):
         # For LLM responses
         self.model = self.configuration['openai']['model']
         self.token_limit = self.configuration['openai']['model_token_limit']
-        self.LLM_chat = OpenAI_LLM(api_key=api_key, model=self.model, token_limit=self.token_limit, name='OpenAI')
+        self.LLM_chat = OpenAI_LLM(api_key=api_key, model=self.model, token_limit=self.token_limit, transport=get_transport(self.configuration), base_url=self.configuration['openai'].get('base_url'), client_settings=self.configuration['openai'], name='OpenAI')
         
         instruction = f"""Analyze the two text provided below, which is taken from a scientific publication. Identify the most appropriate category for this publication (list provided below). Provide a brief response that analyzes the content of the publication, and then finish off your reply with a clear classification statement that strictly follows this format: "The publication should be in category: CATEGORY" (where CATEGORY is one of the ones listed below).\n\nThe valid categories for consideration are:\n{categories}"""
 
@@ -117,6 +119,16 @@ class ClassifyBot(Base):
         self.answer_re = re.compile('should be in category:? ([a-zA-Z-]+)', re.IGNORECASE)
         
         
+        # For classifying several publications per request
+        self.categories = categories
+        self.category_labels = self.parse_categories(categories)
+        
+        self.batch_instruction = f"""Analyze each of the scientific publications provided below (each is an excerpt, introduced by its PUBLICATION_ID). Identify the most appropriate category for each publication (list provided below). Reply with only a JSON object, with one entry per publication, where the key is the PUBLICATION_ID and the value is an object with a "category" (exactly one of the category names listed below) and a very brief "reason". For example: {{"123": {{"category": "CATEGORY", "reason": "..."}}}}\n\nThe valid categories for consideration are:\n{categories}"""
+        
+        self.tokens = self.LLM_chat.tokens
+        self.batch_header_tokens = self.tokens.count(self.batch_instruction)
+        
+        
         
     # Call the LLM
     ##################################################
@@ -141,13 +153,102 @@ class ClassifyBot(Base):
         
         m = self.answer_re.search(response)
         if m:
-            result = m.groups()[0]
+            # (Recorded as in the categories list, like the batch results)
+            result = self.category_label(m.groups()[0]) or m.groups()[0]
             
         else:
             result = '?'
         
         
         return response, result
+
+    
+    
+    # Batched classification
+    ##################################################
+    def parse_categories(self, categories):
+        '''The labels recorded in the database (the leading word of each
+        category name, i.e. the text before the colon on each line of the
+        categories description, as matched by answer_re), keyed by their
+        lowercase form.'''
+        
+        labels = {}
+        for line in categories.splitlines():
+            if ':' in line:
+                name = line.split(':')[0].strip()
+                m = re.match('[a-zA-Z-]+', name)
+                if m:
+                    labels[m.group(0).lower()] = m.group(0)
+                    
+        return labels
+    
+    
+    def category_label(self, value):
+        '''The label for a category name returned by the LLM, as written in the
+        categories list, whatever the case of the reply (or None, if it is
+        not a valid category).'''
+        
+        if not isinstance(value, str):
+            return None
+        m = re.match('[a-zA-Z-]+', value.strip())
+        if not m:
+            return None
+        
+        return self.category_labels.get(m.group(0).lower())
+    
+    
+    def batch_tokens(self, excerpt_tokens, reply_tokens=100):
+        '''Tokens that a document occupies in a batched request (its excerpt,
+        plus its share of the reply).'''
+        return excerpt_tokens + 20 + reply_tokens
     
     
+    def query_batch(self, items, excerpt_tokens=2000, msg_cutoff=35):
+        '''Classify several publications in one request; items are (doc_id, txt).
+        Returns (response, results), where results maps doc_id to
+        (category label, reason) for the publications whose result was valid.'''
+        
+        messages = [ {"role": "system", "content" : self.batch_instruction} ]
+        
+        question = "".join( """PUBLICATION_ID: {}\n\n{}\n\n""".format(doc_id, self.tokens.truncate(txt, excerpt_tokens)) for doc_id, txt in items )
+        
+        messages.append({"role": "user", "content" : question})
+        
+        
+        self.msg(f'''Asking question ({len(items)} publications, {len(question):,d} chars)''', 3, 2)
+        
+        response = self.LLM_chat.chat_completion(messages)
+        
+        self.msg(f'''Received response ({len(response):,d} chars): "{response[:msg_cutoff]}"...''', 3, 2)
+        
+        return response, self.parse_batch(response, [ doc_id for doc_id, txt in items ])
+    
     
+    def parse_batch(self, response, doc_ids):
+        '''Extract the per-publication results from a JSON reply; entries that
+        are missing, or that do not name a valid category, are omitted.'''
+        
+        start, end = response.find('{'), response.rfind('}')
+        if start<0 or end<start:
+            return {}
+        try:
+            data = json.loads(response[start:end+1])
+        except ValueError:
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        
+        keys = { str(doc_id): doc_id for doc_id in doc_ids }
+        results = {}
+        for key, value in data.items():
+            doc_id = keys.get(str(key).strip())
+            if doc_id is None:
+                continue
+            if isinstance(value, dict):
+                label, reason = self.category_label(value.get('category')), value.get('reason', '')
+            else:
+                label, reason = self.category_label(value), ''
+            if label is not None:
+                results[doc_id] = (label, str(reason))
+                
+        return results
@@ -16,6 +16,75 @@ from .tool_bots import *
 import numpy as np
 import time
 
+
+class NearestNeighborClassifier(Base):
+    '''k-nearest-neighbour classifier over document vectors (unit-normalized,
+    e.g. mean chunk embeddings). Each of the k most similar labelled docs
+    votes for its label, weighted by cosine similarity; the margin is the
+    fraction of the vote by which the winning label leads the runner-up.'''
+    
+    def __init__(self, k=10, name='kNN', **kwargs):
+        super().__init__(name=name, **kwargs)
+        
+        self.k = k
+        
+        
+    def fit(self, vectors, labels):
+        
+        self.vectors = np.asarray(vectors, dtype=float)
+        self.classes, self.label_index = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+        
+        
+    def predict(self, vectors, exclude=None, block_size=1024):
+        '''Labels and margins for the vectors (rows). exclude optionally gives,
+        for each row, a training item to leave out (or -1).'''
+        
+        vectors = np.asarray(vectors, dtype=float)
+        k = min(self.k, len(self.vectors) - (0 if exclude is None else 1))
+        labels = np.empty(len(vectors), dtype=object)
+        margins = np.zeros(len(vectors))
+        if k<1:
+            labels[:] = None
+            return labels, margins
+        
+        for start in range(0, len(vectors), block_size):
+            block = slice(start, start+block_size)
+            similarities = vectors[block] @ self.vectors.T
+            rows = np.arange(len(similarities))
+            if exclude is not None:
+                left_out = np.asarray(exclude[block])
+                similarities[rows[left_out>=0], left_out[left_out>=0]] = -np.inf
+            
+            neighbors = np.argpartition(-similarities, k-1, axis=1)[:,:k]
+            weights = np.maximum(similarities[rows[:,np.newaxis], neighbors], 0)
+            votes = np.zeros( (len(similarities), len(self.classes)) )
+            np.add.at(votes, (np.repeat(rows, k), self.label_index[neighbors].ravel()), weights.ravel())
+            
+            ranked = np.sort(votes, axis=1)
+            runner_up = ranked[:,-2] if len(self.classes)>1 else 0
+            labels[block] = self.classes[np.argmax(votes, axis=1)]
+            margins[block] = (ranked[:,-1] - runner_up)/np.maximum(votes.sum(axis=1), 1e-12)
+            
+        return labels, margins
+    
+    
+    def cross_validate(self):
+        '''Leave-one-out predictions for the training docs.'''
+        return self.predict(self.vectors, exclude=np.arange(len(self.vectors)))
+    
+    
+    def agreement(self, predicted, margins, labels, min_margin=0.0):
+        '''How often the predictions with at least min_margin agree with the
+        given labels; coverage is the fraction of docs that are that confident.'''
+        
+        confident = margins>=min_margin
+        count = int(np.sum(confident))
+        agree = np.asarray(predicted)[confident]==np.asarray(labels)[confident]
+        
+        return {'count': count, 'coverage': count/max(len(margins), 1), 'agreement': float(np.mean(agree)) if count>0 else None}
+
+
+
 class Classifier(Base):
     
     def __init__(self, configuration, name='Classifier', **kwargs):
@@ -23,6 +92,9 @@ class Classifier(Base):
         
         self.configuration = configuration
         self.db = None
+        self.preclassifier = None # NearestNeighborClassifier (see fit_preclassifier)
+        self.preclassifier_index = {} # doc_id : row of the vectors
+        self.excerpts = None # ExcerptStore (created on first use)
         
         
     # Database interaction
@@ -37,6 +109,16 @@ class Classifier(Base):
         self.db.close()
         
         
+    def excerpt_store(self):
+        
+        if self.excerpts is None:
+            from .excerpts import ExcerptStore
+            self.start_database()
+            self.excerpts = ExcerptStore(self.configuration, self.db, verbosity=self.verbosity)
+            
+        return self.excerpts
+        
+        
         
     # Protocols/workflows
     ##################################################
@@ -52,12 +134,9 @@ class Classifier(Base):
         else:
             self.msg("{}: Doing classification.".format(doc['doc_id']), 4, 2)
             
-            m = self.path_re.match(doc['file_path'])
+            txt = self.document_text(doc)
             
-            if m:
-                p = m.groups()[0] + '/txt/' + m.groups()[2] + '.tei.txt'
-                
-                txt = open(p).read()
+            if txt is not None:
 
                 try:
                     response, result = self.bot.query(txt)
@@ -70,22 +149,145 @@ class Classifier(Base):
 
 
             else:
-                self.msg_error("RE failure for {} and/or {}.".format(selected[0], selected[1]))
+                self.msg_error("No text for {}.".format(doc['doc_id']))
                 result = -3
                 
             self.msg(f"result: {result}", 4, 3)
             time.sleep(5)
                 
             return result
+        
+        
+    def document_text(self, doc, budget=None):
+        '''The text of a doc: a stored excerpt of at most budget tokens (by
+        default, sized to the bot's context). Returns None if the doc has no text.'''
+        
+        store = self.excerpt_store()
+        if budget is None:
+            budget = min( int(self.bot.max_context_len/4), store.budgets[-1] ) # ~4 chars/token
+        
+        return store.get(doc, budget)
+    
+    
+    def classify_batch(self, docs, excerpt_tokens=2000):
+        '''Classify several docs with one request (using an excerpt of each).
+        Docs whose result is missing or invalid are classified individually
+        (classify_document). Returns the results, as a dict keyed by doc_id.'''
+        
+        self.excerpt_store().prefetch(docs)
+        items = []
+        for doc in docs:
+            txt = self.document_text(doc, excerpt_tokens)
+            if txt is not None:
+                items.append( (doc['doc_id'], txt) )
+        
+        results = {}
+        if len(items)>0:
+            try:
+                response, parsed = self.bot.query_batch(items, excerpt_tokens=excerpt_tokens)
+                for doc in docs:
+                    if doc['doc_id'] in parsed:
+                        result, reason = parsed[doc['doc_id']]
+                        self.db.add_tool_classify(doc['doc_id'], result, reason, title=doc['title'])
+                        results[doc['doc_id']] = result
+            
+            except Exception as e:
+                self.msg_error('Python exception (batch): ' + type(e).__name__)
+        
+        self.msg(f"Batch of {len(docs)}: {len(results)} classified", 4, 2)
+        
+        # Fall back to single-document requests
+        for doc in docs:
+            if doc['doc_id'] not in results:
+                results[doc['doc_id']] = self.classify_document(doc)
+                
+        return results
+    
+    
+    # Local pre-classification
+    ##################################################
+    def fit_preclassifier(self, lookup_file='./chunk_lookup.npy', k=10, min_margin=0.5):
+        '''Fit a kNN classifier to the LLM classification results (the
+        tool_classify table), using the mean chunk embedding of each doc
+        (from the lookup file). Reports the leave-one-out agreement with the
+        LLM labels (for all docs, and for those with at least min_margin).'''
+        
+        self.start_database()
+        if self.db.embeddings is None:
+            self.db.load_embedding_lookup_file(infile=lookup_file)
+        
+        doc_ids, vectors = self.db.doc_vectors()
+        self.preclassifier_index = { doc_id: i for i, doc_id in enumerate(doc_ids.tolist()) }
+        
+        # Train only on LLM results (not on earlier kNN labels, nor failures)
+        labelled = {}
+        for row in self.db.get_tool_classify(source=''):
+            if row['doc_id'] in self.preclassifier_index and row['result'] not in ('?', '-2', '-3'):
+                labelled[row['doc_id']] = str(row['result'])
+        rows = [ self.preclassifier_index[doc_id] for doc_id in labelled ]
+        labels = list(labelled.values())
+        
+        model = NearestNeighborClassifier(k=k, verbosity=self.verbosity)
+        model.fit(vectors[rows], labels)
+        model.doc_vectors = vectors
+        
+        predicted, margins = model.cross_validate()
+        overall = model.agreement(predicted, margins, labels)
+        confident = model.agreement(predicted, margins, labels, min_margin=min_margin)
+        model.validation = confident
+        if overall['count']>0:
+            self.msg('kNN leave-one-out agreement with LLM labels: {:.1f}% overall ({:,d} docs)'.format(100*overall['agreement'], overall['count']), 3, 1)
+        if confident['count']>0:
+            self.msg('    {:.1f}% for margin>={} ({:.1f}% of docs)'.format(100*confident['agreement'], min_margin, 100*confident['coverage']), 3, 1)
+        
+        self.preclassifier = model
+        
+        return model
+    
+    
+    def preclassify(self, docs, min_margin=0.5):
+        '''kNN labels for the docs. Returns (confident, escalate): confident
+        maps doc_id to (label, margin) for the docs with at least min_margin;
+        the other docs (including those without an embedding) are escalated.'''
+        
+        model = self.preclassifier
+        known = [ doc for doc in docs if doc['doc_id'] in self.preclassifier_index ]
+        rows = [ self.preclassifier_index[doc['doc_id']] for doc in known ]
+        labels, margins = model.predict(model.doc_vectors[rows]) if len(rows)>0 else ([], [])
+        
+        confident = {}
+        for doc, label, margin in zip(known, labels, margins):
+            if label is not None and margin>=min_margin:
+                confident[doc['doc_id']] = (label, float(margin))
+        escalate = [ doc for doc in docs if doc['doc_id'] not in confident ]
+        
+        return confident, escalate
+    
+    
+    def pack_batches(self, docs, excerpt_tokens=2000, max_batch_size=10):
+        '''Group the docs into batches that fit within the model's context window.'''
+        
+        budget = self.bot.token_limit - self.bot.batch_header_tokens - 200 # (Reserve for the reply framing)
+        per_doc = self.bot.batch_tokens(excerpt_tokens)
+        size = max(1, min(max_batch_size, budget//per_doc))
+        
+        return [ docs[i:i+size] for i in range(0, len(docs), size) ]
 
 
        
 
 
-    def classify_documents(self, wait=5):
-        
-        import re
-        self.path_re = re.compile('(^\/.+)(\/xml\/)(.+)(\.tei\.xml)$')
+    def classify_documents(self, wait=5, batch_size=10, excerpt_tokens=2000, preclassify=False, k=10, min_margin=0.5, min_agreement=0.9, audit_fraction=0.05, seed=0):
+        '''Classify all the docs (that have not already been classified).
+        With batch_size>1, several docs (an excerpt of up to excerpt_tokens
+        of each) are classified per request; otherwise each doc is sent
+        individually.
+        With preclassify, a kNN classifier over the doc embeddings (trained on
+        the existing LLM results) labels the docs it is confident about
+        (margin>=min_margin), and only the others go to the LLM. This is only
+        done if the leave-one-out agreement of confident kNN labels with the
+        LLM labels is at least min_agreement; a random audit_fraction of the
+        confident docs is also sent to the LLM, and the agreement reported.'''
         
         categories = """self-assembly: This category is for publications related to self-assembling materials, especially block copolymer thin films (which form nanoscale morphologies due to phase separation), nanoparticle superlattices, and DNA self-assembly (particle assembly, DNA origami, etc.).\n\n
         machine-learning: This category is for papers related to artificial intelligence (AI), machine-learning (ML), data analytics, and associated concepts such as autonomous experimenation (AE).\n\n
@@ -102,9 +304,43 @@ class Classifier(Base):
         docs = self.db.get_docs()
         
         start_time = time.time()
-        for i, doc in enumerate(docs):
-            self.classify_document(doc)
-            #print('Completed {} classifications in {} seconds ({} s/call)'.format(i+1, time.time()-start_time, (time.time()-start_time)/(i+1)))
+        batched = batch_size is not None and batch_size>1
+        if preclassify or batched:
+            docs = [ doc for doc in docs if not self.db.tool_classify_exists(doc['doc_id']) ]
+        
+        audit = {}
+        if preclassify:
+            by_id = { doc['doc_id']: doc for doc in docs }
+            model = self.fit_preclassifier(k=k, min_margin=min_margin)
+            if model.validation['agreement'] is None or model.validation['agreement']<min_agreement:
+                self.msg_warning(f'kNN pre-classification not used (agreement with LLM labels below {100*min_agreement:.0f}%).')
+            else:
+                confident, docs = self.preclassify(docs, min_margin=min_margin)
+                rng = np.random.default_rng(seed)
+                for doc_id, (label, margin) in confident.items():
+                    if rng.random()<audit_fraction:
+                        audit[doc_id] = label
+                    else:
+                        self.db.add_tool_classify(doc_id, label, f'kNN: k={k}, margin={margin:.3f}', title=by_id[doc_id]['title'])
+                docs += [ by_id[doc_id] for doc_id in audit ]
+                self.msg(f'kNN labelled {len(confident)-len(audit):,d} docs; {len(docs):,d} sent to the LLM ({len(audit):,d} as audit)', 3, 1)
+        
+        results = {}
+        if batched:
+            batches = self.pack_batches(docs, excerpt_tokens=excerpt_tokens, max_batch_size=batch_size)
+            for i, batch in enumerate(batches):
+                self.msg(f"Batch {i+1}/{len(batches)} ({len(batch)} docs)", 3, 1)
+                results.update(self.classify_batch(batch, excerpt_tokens=excerpt_tokens))
+                time.sleep(wait)
+            
+        else:
+            for i, doc in enumerate(docs):
+                results[doc['doc_id']] = self.classify_document(doc)
+                #print('Completed {} classifications in {} seconds ({} s/call)'.format(i+1, time.time()-start_time, (time.time()-start_time)/(i+1)))
+        
+        if len(audit)>0:
+            agree = [ str(results.get(doc_id)).lower()==label.lower() for doc_id, label in audit.items() if doc_id in results ]
+            self.msg('kNN audit: agreement with LLM labels {:.1f}% ({:,d} docs)'.format(100*np.mean(agree) if agree else 0, len(agree)), 3, 1)
             
             
         
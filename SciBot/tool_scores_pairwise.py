@@ -14,14 +14,52 @@ from .Base import Base
 from .tool_bots import *
 
 import numpy as np
+import threading
 import time
 
+
+class RateBudget():
+    '''Limits the LLM calls made by concurrent workers: calls are started at
+    most max_per_minute per minute, and at most max_calls in total.'''
+    
+    def __init__(self, max_per_minute=None, max_calls=None):
+        self.interval = 0.0 if not max_per_minute else 60.0/max_per_minute
+        self.max_calls = max_calls
+        self.calls = 0
+        self.next_start = 0.0
+        self._lock = threading.Lock()
+        
+    def acquire(self):
+        '''Wait for the next call slot; returns False if the budget is used up.'''
+        
+        with self._lock:
+            if self.max_calls is not None and self.calls>=self.max_calls:
+                return False
+            self.calls += 1
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+            
+        if start>now:
+            time.sleep(start-now)
+            
+        return True
+    
+    def exhausted(self):
+        return self.max_calls is not None and self.calls>=self.max_calls
+
+
+
 class RankSorter(Base):
     def __init__(self, configuration, name='Ranker', **kwargs):
         super().__init__(name=name, **kwargs)
         
         self.configuration = configuration
         self.db = None
+        self.graph = None # ScoreGraph of the pairwise scores (loaded on first use)
+        self.surrogate = None # PairwiseSurrogate (see fit_surrogate)
+        self.surrogate_index = {} # doc_id : item in the surrogate
+        self.excerpts = None # ExcerptStore (created on first use)
         
         
     # Database interaction
@@ -36,42 +74,49 @@ class RankSorter(Base):
         self.db.close()
         
         
+    def score_graph(self, reload=False):
+        '''The pairwise scores (as a ScoreGraph), loaded from the database once;
+        comparisons made by this RankSorter are added as they are stored.'''
+        
+        if reload or self.graph is None:
+            from .rank_models import ScoreGraph
+            self.start_database()
+            self.graph = ScoreGraph.from_rows(self.db.get_scores_pairwise(text=False))
+            
+        return self.graph
+        
+        
+    def excerpt_store(self):
+        
+        if self.excerpts is None:
+            from .excerpts import ExcerptStore
+            self.start_database()
+            self.excerpts = ExcerptStore(self.configuration, self.db, verbosity=self.verbosity)
+            
+        return self.excerpts
+        
+        
         
     # Protocols/workflows
     ##################################################
     
     def compare_documents(self, doc_A, doc_B):
         
-        exists, row = self.db.scores_pairwise_exists(doc_A['doc_id'], doc_B['doc_id'], retrows=True)
-        if exists:
-            self.msg("{} vs. {}: Comparison already exists ({} won).".format(doc_A['doc_id'], doc_B['doc_id'], row['winner']), 4, 2)
+        winner = self.existing_comparison(doc_A, doc_B)
+        if winner is not None:
+            self.msg("{} vs. {}: Comparison already exists ({} won).".format(doc_A['doc_id'], doc_B['doc_id'], winner), 4, 2)
             
-            return row['winner']
+            return winner
             
         else:
             self.msg("{} vs. {}: Doing comparison.".format(doc_A['doc_id'], doc_B['doc_id']), 4, 2)
             
-            mA = self.path_re.match(doc_A['file_path'])
-            mB = self.path_re.match(doc_B['file_path'])
-            
-            if mA and mB:
-                pA = mA.groups()[0] + '/txt/' + mA.groups()[2] + '.tei.txt'
-                pB = mB.groups()[0] + '/txt/' + mB.groups()[2] + '.tei.txt'
-                
-                txtA = open(pA).read()
-                txtB = open(pB).read()
+            txtA, txtB = self.document_text(doc_A), self.document_text(doc_B)
+            if txtA is not None and txtB is not None:
 
                 try:
-                    response, winner = self.bot.query(txtA, txtB)
-                
-                    if winner=='A':
-                        winner = doc_A['doc_id']
-                    elif winner=='B':
-                        winner = doc_B['doc_id']
-                    else:
-                        winner = -1
-                    
-                    self.db.add_scores_pairwise(doc_A['doc_id'], doc_B['doc_id'], winner, response)
+                    response, winner = self.run_comparison(doc_A, doc_B, txtA, txtB)
+                    self.record_comparison(doc_A, doc_B, winner, response)
                 
                 except Exception as e:
                     self.msg_error('Python exception: ' + type(e).__name__)
@@ -79,12 +124,122 @@ class RankSorter(Base):
 
 
             else:
-                self.msg_error("RE failure for {} and/or {}.".format(selected[0], selected[1]))
+                self.msg_error("No text for {} and/or {}.".format(doc_A['doc_id'], doc_B['doc_id']))
                 winner = -3
                 
             self.msg(f"winner: {winner}", 4, 3)
                 
             return winner
+        
+        
+    def existing_comparison(self, doc_A, doc_B):
+        '''The winner of an already-recorded comparison of the two docs (or None).
+        This uses the in-memory pair index (of the ScoreGraph), which is
+        loaded once and kept in sync as comparisons are recorded.'''
+        
+        return self.score_graph().lookup(doc_A['doc_id'], doc_B['doc_id'])
+        
+        
+    def document_text(self, doc):
+        '''The text of a doc to show CompareBot: a stored excerpt, sized to half
+        of the bot's context (or None, if the doc has no text).'''
+        
+        store = self.excerpt_store()
+        budget = min( int(self.bot.max_context_len/2/4), store.budgets[-1] ) # ~4 chars/token
+        
+        return store.get(doc, budget)
+        
+        
+    def run_comparison(self, doc_A, doc_B, txtA, txtB):
+        '''Ask the LLM to compare two docs (given their texts); returns
+        (response, winner), where winner is a doc_id (or -1 if the response
+        was unclear). This does no database work, so it can run in a worker
+        thread.'''
+        
+        response, winner = self.bot.query(txtA, txtB)
+        
+        if winner=='A':
+            winner = doc_A['doc_id']
+        elif winner=='B':
+            winner = doc_B['doc_id']
+        else:
+            winner = -1
+            
+        return response, winner
+    
+    
+    def record_comparison(self, doc_A, doc_B, winner, response):
+        
+        self.db.add_scores_pairwise(doc_A['doc_id'], doc_B['doc_id'], winner, response)
+        if self.graph is not None:
+            self.graph.add(doc_A['doc_id'], doc_B['doc_id'], winner)
+        
+        
+    def compare_batch(self, pairs, max_workers=4, budget=None, skip_confidence=None):
+        '''Compare many (independent) pairs of docs concurrently. The LLM calls
+        run in a pool of max_workers threads (paced by the RateBudget, if
+        any); each result is written to the database (from this thread) as
+        soon as it arrives, so an interrupted run loses only the calls that
+        were in flight. Pairs already compared are answered from the database.
+        With skip_confidence (and a fitted surrogate), pairs whose outcome the
+        surrogate predicts with at least that probability are not compared;
+        the predicted winner is returned (but not stored).
+        Returns the winners, as for compare_documents (or -4 for the pairs
+        skipped because the budget was used up).'''
+        
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        
+        def call(doc_A, doc_B, txtA, txtB):
+            if budget is not None and not budget.acquire():
+                return None
+            return self.run_comparison(doc_A, doc_B, txtA, txtB)
+        
+        # The texts are fetched here (the workers do no database work)
+        docs = { doc['doc_id']: doc for pair in pairs for doc in pair }
+        self.excerpt_store().prefetch(list(docs.values()))
+        
+        winners = [None]*len(pairs)
+        predicted = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            
+            pending = {}
+            for i, (doc_A, doc_B) in enumerate(pairs):
+                winner = self.existing_comparison(doc_A, doc_B)
+                p = None if skip_confidence is None else self.surrogate_probability(doc_A, doc_B)
+                if winner is not None:
+                    winners[i] = winner
+                elif p is not None and max(p, 1-p)>=skip_confidence:
+                    winners[i] = doc_A['doc_id'] if p>0.5 else doc_B['doc_id']
+                    predicted += 1
+                else:
+                    txtA, txtB = self.document_text(doc_A), self.document_text(doc_B)
+                    if txtA is None or txtB is None:
+                        self.msg_error("No text for {} and/or {}.".format(doc_A['doc_id'], doc_B['doc_id']))
+                        winners[i] = -3
+                    else:
+                        pending[pool.submit(call, doc_A, doc_B, txtA, txtB)] = i
+                    
+            self.msg(f'Comparing {len(pending):,d} pairs ({len(pairs)-len(pending)-predicted:,d} already done, {predicted:,d} predicted)', 4, 1)
+            
+            while pending:
+                done, _ = wait(list(pending.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = pending.pop(future)
+                    doc_A, doc_B = pairs[i]
+                    try:
+                        result = future.result()
+                        if result is None:
+                            winners[i] = -4
+                        else:
+                            response, winners[i] = result
+                            self.record_comparison(doc_A, doc_B, winners[i], response)
+                    except Exception as e:
+                        self.msg_error('Python exception: ' + type(e).__name__)
+                        winners[i] = -2
+                        
+                    self.msg("{} vs. {}: winner: {}".format(doc_A['doc_id'], doc_B['doc_id'], winners[i]), 4, 2)
+                    
+        return winners
 
 
     def try_sort(self, docs, max_rounds=None, wait=10):
@@ -131,13 +286,16 @@ class RankSorter(Base):
    
         
         
-    def score_sort(self, docs, num_iterations=5):
-        '''Use the available scores to guess at ordering of docs.'''
+    def score_sort(self, docs, num_iterations=5, method='mfas', seed=0):
+        '''Use the available scores to guess at ordering of docs.
+        The default method ('mfas') minimizes the number of bad connections
+        using FeedbackArcSolver (with num_iterations KwikSort restarts); the
+        'swaps' method uses the (slow) random and connection-wise swaps.'''
         
         # First, compute some stats based on the scores.
-        scores = self.db.get_scores_pairwise()
+        graph = self.score_graph()
         
-        docs = self.score_stats(docs, scores)
+        docs = self.score_stats(docs)
         
         # We can brutely sort by "win ratio".
         #docs = sorted(docs, key=lambda item: item['scoring_win_ratio'], reverse=True)
@@ -149,7 +307,10 @@ class RankSorter(Base):
             
         
         
-        outward, inward = self.determine_connections(docs, scores)
+        if method=='mfas':
+            return self.solve_connections(docs, graph, restarts=num_iterations, seed=seed)
+        
+        outward, inward = self.determine_connections(docs)
         
         # We can go through docs, and for each one try swapping with a neighbor
         # to decrease the number of bad/wrong connections.
@@ -170,6 +331,25 @@ class RankSorter(Base):
 
     
     
+    def solve_connections(self, docs, graph=None, restarts=5, max_sweeps=50, seed=0):
+        '''Order the docs to minimize the number of bad/wrong connections,
+        working on integer positions (rather than lists of dicts).'''
+        
+        from .rank_models import FeedbackArcSolver
+        
+        graph = graph or self.score_graph()
+        winners, losers = graph.subset_edges([ doc['doc_id'] for doc in docs ])
+        
+        solver = FeedbackArcSolver(winners, losers, len(docs), seed=seed, verbosity=self.verbosity)
+        before = solver.count_bad(np.arange(len(docs)))
+        order, num_bad = solver.solve(restarts=restarts, max_sweeps=max_sweeps)
+        
+        # (Each bad edge counts as a bad outward and a bad inward connection)
+        self.msg('Bad connections: {} → {} ({:,d} connections)'.format(2*before, 2*num_bad, 2*len(winners)), 3, 1)
+        
+        return [ docs[i] for i in order ]
+    
+    
     def consider_swaps_connection_wise(self, docs, outward, inward, rounds=10):
         '''We go through the doc list, and for each pair consider whether swapping
         will improve things (decrease the number of bad/wrong connections that point
@@ -375,35 +555,47 @@ class RankSorter(Base):
     
     
     
-    def determine_connections(self, docs, scores):
+    def determine_connections(self, docs, scores=None):
         '''Get a list of all the pairwise connections between docs.
         outward connections point from doc A to B, where A "wins" over B.
         inward connections point from various docs towards A; i.e. those
-        docs all beat A.'''
+        docs all beat A.
+        (The ScoreGraph is used, unless a list of scores is given.)'''
         
         from collections import defaultdict
+        from .rank_models import ScoreGraph
+        
+        graph = self.score_graph() if scores is None else ScoreGraph.from_rows(scores)
 
-        # Convert the data into an adjacency list
+        # Convert the CSR adjacency into adjacency lists
+        out_ptr, out_idx, in_ptr, in_idx = graph.adjacency()
+        doc_ids = np.asarray(graph.doc_ids)
         outward = defaultdict(list)
         inward = defaultdict(list)
-        for score in scores:
-            if score['winner']>0:
-                if score['winner']==score['doc_id_A']:
-                    outward[ score['doc_id_A'] ].append( score['doc_id_B'] )
-                    inward[ score['doc_id_B'] ].append( score['doc_id_A'] )
-                    
-                elif score['winner']==score['doc_id_B']:
-                    outward[ score['doc_id_B'] ].append( score['doc_id_A'] )
-                    inward[ score['doc_id_A'] ].append( score['doc_id_B'] )
-                
-                else:
-                    # This is not possible
-                    self.msg_error('winner recorded in db is impossible')
+        for i, doc_id in enumerate(graph.doc_ids):
+            if out_ptr[i+1]>out_ptr[i]:
+                outward[doc_id] = doc_ids[out_idx[out_ptr[i]:out_ptr[i+1]]].tolist()
+            if in_ptr[i+1]>in_ptr[i]:
+                inward[doc_id] = doc_ids[in_idx[in_ptr[i]:in_ptr[i+1]]].tolist()
                 
         return outward, inward
     
     
-    def score_stats(self, docs, scores):
+    def score_stats(self, docs, scores=None):
+        '''Add the number of comparisons, wins, and win ratio to each doc.
+        (The ScoreGraph is used, unless a list of scores is given.)'''
+        
+        from .rank_models import ScoreGraph
+        
+        graph = self.score_graph() if scores is None else ScoreGraph.from_rows(scores)
+        
+        # Per-document tallies (as positions in the docs list)
+        indices = np.asarray([ graph.index.get(doc['doc_id'], -1) for doc in docs ], dtype=int)
+        known = indices>=0
+        counts = np.zeros(len(docs), dtype=int)
+        wins = np.zeros(len(docs), dtype=int)
+        counts[known] = graph.counts()[indices[known]]
+        wins[known] = graph.wins()[indices[known]]
         
         unpaired = 0
         for i, doc in enumerate(docs):
@@ -414,10 +606,10 @@ class RankSorter(Base):
             doc['index'] = i
             
             # How many times was this doc analyzed?
-            doc['scoring_count'] = np.sum([ 1 for score in scores if score['doc_id_A']==doc['doc_id'] or score['doc_id_B']==doc['doc_id'] ])
+            doc['scoring_count'] = counts[i]
             
             # How many times did it win?
-            doc['scoring_wins'] = np.sum([ 1 for score in scores if score['winner']==doc['doc_id'] ])
+            doc['scoring_wins'] = wins[i]
             
             if doc['scoring_count']>0:
                 doc['scoring_win_ratio'] = doc['scoring_wins'] / doc['scoring_count']
@@ -440,33 +632,28 @@ class RankSorter(Base):
         Since this pairwise scores are not necessarily exhaustive, this operation
         is not guaranteed to result in a perfect sort.'''
         
-        scores = self.db.get_scores_pairwise()
+        graph = self.score_graph()
+        num_scores = graph.num_scores
         
-        self.msg('Applying {:,d} scores for {:,d} docs ({:.1f}%)'.format(len(scores), len(docs), 100.*len(scores)/len(docs)), 3, 0)
+        self.msg('Applying {:,d} scores for {:,d} docs ({:.1f}%)'.format(num_scores, len(docs), 100.*num_scores/len(docs)), 3, 0)
+        
+        # Current position of each doc (updated as docs are swapped)
+        position = { doc['doc_id']: i for i, doc in enumerate(docs) }
         
         num_swaps = 0
-        for score in scores:
-            if score['winner']>0:
-                doc_ids = [ doc['doc_id'] for doc in docs ]
-                idx_A = doc_ids.index( score['doc_id_A'] )
-                idx_B = doc_ids.index( score['doc_id_B'] )
-                
-                if score['winner']==score['doc_id_A']:
-                    if idx_A>idx_B: # A should be lower idx but isn't
-                        docs[idx_B], docs[idx_A] = docs[idx_A], docs[idx_B] # Swap
-                        num_swaps += 1
-                
-                elif score['winner']==score['doc_id_B']:
-                    if idx_B>idx_A: # B should be lower idx
-                        docs[idx_A], docs[idx_B] = docs[idx_B], docs[idx_A] # Swap
-                        num_swaps += 1
+        winners, losers = graph.edges()
+        for w, l in zip(winners.tolist(), losers.tolist()):
+            doc_id_W, doc_id_L = graph.doc_ids[w], graph.doc_ids[l]
+            if doc_id_W in position and doc_id_L in position:
+                idx_W, idx_L = position[doc_id_W], position[doc_id_L]
                 
-                else:
-                    # This is not possible
-                    self.msg_error('winner recorded in db is impossible')
+                if idx_W>idx_L: # The winner should be at lower idx but isn't
+                    docs[idx_L], docs[idx_W] = docs[idx_W], docs[idx_L] # Swap
+                    position[doc_id_W], position[doc_id_L] = idx_L, idx_W
+                    num_swaps += 1
                     
                     
-        self.msg('swapped {}/{} = {:.1f}%'.format(num_swaps, len(scores), 100.*num_swaps/len(scores)), 4, 1)
+        self.msg('swapped {}/{} = {:.1f}%'.format(num_swaps, num_scores, 100.*num_swaps/max(num_scores, 1)), 4, 1)
             
         return docs
                 
@@ -480,9 +667,6 @@ class RankSorter(Base):
         '''Pick two docs at random, and compare them to each other.'''
         
         import random
-        import re
-        
-        self.path_re = re.compile('(^\/.+)(\/xml\/)(.+)(\.tei\.xml)$')
         
         self.bot = CompareBot(self.configuration)
         
@@ -509,9 +693,6 @@ class RankSorter(Base):
     def semi_random_comparisons(self, rounds=10, wait=10):
         
         import random
-        import re
-        
-        self.path_re = re.compile('(^\/.+)(\/xml\/)(.+)(\.tei\.xml)$')
         
         self.bot = CompareBot(self.configuration)
         
@@ -537,13 +718,455 @@ class RankSorter(Base):
                     time.sleep(wait) # Don't overload API                
 
 
+    def active_sort(self, docs=None, max_comparisons=None, target_width=None, batch_size=10, wait=10, max_workers=1, budget=None, skip_confidence=None):
+        '''Rank docs by fitting a Bradley-Terry model to the pairwise scores,
+        and only doing the comparisons that are most informative (between
+        documents that are close in strength, and uncertain). Stops once the
+        rank confidence intervals are narrower than target_width positions
+        (default: 10% of the documents), or after max_comparisons new
+        comparisons (default: n*log2(n)).
+        Each batch of comparisons is run concurrently (with max_workers), and
+        paced by the budget (by default, one call every wait seconds).
+        Each doc (dict) gets 'bt_score', 'bt_std', 'rank_low' and 'rank_high'.'''
+        
+        from .rank_models import BradleyTerry
+        
+        self.bot = CompareBot(self.configuration)
+        
+        self.start_database()
+        
+        if docs is None:
+            docs = self.db.get_docs()
+        n = len(docs)
+        if max_comparisons is None:
+            max_comparisons = int(n*np.log2(max(n, 2)))
+        if target_width is None:
+            target_width = max(1, int(0.1*n))
+        if budget is None:
+            budget = RateBudget(max_per_minute=60.0/wait if wait else None)
+        
+        # Existing comparisons
+        doc_ids = [ doc['doc_id'] for doc in docs ]
+        a, b, _ = self.score_graph().subset(doc_ids)
+        compared = set(zip(np.minimum(a, b).tolist(), np.maximum(a, b).tolist()))
+        winners, losers = self.score_graph().subset_edges(doc_ids)
+        
+        model = BradleyTerry(n, verbosity=self.verbosity)
+        model.set_outcomes(winners, losers)
+        self.msg(f'Active sort of {n:,d} docs ({len(winners):,d} existing comparisons)', 3, 0)
+        
+        count = 0
+        while True:
+            model.fit()
+            if model.converged(target_width):
+                self.msg(f'Ranks converged (to within {target_width} positions) after {count:,d} new comparisons', 3, 1)
+                break
+            if count>=max_comparisons:
+                self.msg(f'Stopping after {count:,d} new comparisons (ranks not yet converged)', 3, 1)
+                break
+            
+            pairs = model.select_pairs(num_pairs=min(batch_size, max_comparisons-count), exclude=compared)
+            if len(pairs)==0:
+                self.msg('No comparisons left to do', 3, 1)
+                break
+            
+            count += len(pairs)
+            self.msg(f'Comparisons {count}/{max_comparisons}', 4, 1)
+            winners = self.compare_batch([ (docs[a], docs[b]) for a, b in pairs ], max_workers=max_workers, budget=budget, skip_confidence=skip_confidence)
+            for (a, b), winner in zip(pairs, winners):
+                compared.add( (min(a, b), max(a, b)) )
+                if winner==docs[a]['doc_id']:
+                    model.add_outcome(a, b)
+                elif winner==docs[b]['doc_id']:
+                    model.add_outcome(b, a)
+                else:
+                    # The comparison failed (or was inconclusive)
+                    pass
+                
+            if budget.exhausted():
+                self.msg(f'Stopping after {count:,d} new comparisons (budget used up)', 3, 1)
+                break
+        
+        low, high = model.rank_intervals()
+        for i, doc in enumerate(docs):
+            doc['bt_score'], doc['bt_std'] = model.theta[i], model.std[i]
+            doc['rank_low'], doc['rank_high'] = low[i], high[i]
+        
+        return [ docs[i] for i in model.order() ]
+    
+    
+    def tournament_sort(self, docs=None, mode='merge', rounds=None, batch_size=None, max_workers=4, max_per_minute=None, max_calls=None, surrogate=False, skip_confidence=0.95):
+        '''Rank docs by running each round's (independent) comparisons
+        concurrently, using compare_batch. The modes are:
+            merge: merge sort, with all the merges of a level advancing together
+                (a round is the next comparison of each merge);
+            swiss: Swiss-system tournament (rounds, default log2(n)+2), where
+                each round pairs docs that have similar standings;
+            active: Bradley-Terry active learning (active_sort), with
+                batch_size comparisons per round (default 4*max_workers).
+        The calls are paced by max_per_minute, and at most max_calls new
+        comparisons are made. Since every result is stored as it arrives, and
+        existing comparisons are reused, an interrupted ranking can be resumed
+        by running it again.
+        With surrogate=True, an embedding-based surrogate (fit_surrogate)
+        provides the starting order, and comparisons that it predicts with
+        probability >=skip_confidence are not sent to the LLM.'''
+        
+        
+        self.bot = CompareBot(self.configuration, verbosity=self.verbosity)
+        
+        self.start_database()
+        
+        if docs is None:
+            docs = self.db.get_docs()
+        docs = list(docs)
+        
+        budget = RateBudget(max_per_minute=max_per_minute, max_calls=max_calls)
+        self.msg(f'Tournament ({mode}) of {len(docs):,d} docs, with {max_workers} workers', 3, 0)
+        
+        if surrogate:
+            self.fit_surrogate()
+            docs = self.surrogate_sort(docs)
+        else:
+            skip_confidence = None
+        
+        if mode=='merge':
+            docs = self.merge_tournament(docs, max_workers=max_workers, budget=budget, skip_confidence=skip_confidence)
+        elif mode=='swiss':
+            docs = self.swiss_tournament(docs, rounds=rounds, max_workers=max_workers, budget=budget, skip_confidence=skip_confidence)
+        elif mode=='active':
+            docs = self.active_sort(docs, batch_size=batch_size or 4*max_workers, max_workers=max_workers, budget=budget, skip_confidence=skip_confidence)
+        else:
+            self.msg_error(f"Tournament mode '{mode}' not recognized.")
+            
+        if budget.exhausted():
+            self.msg_warning(f'The budget of {max_calls:,d} comparisons was used up; the ranking is incomplete.')
+        
+        return docs
+    
+    
+    def merge_tournament(self, docs, max_workers=4, budget=None, skip_confidence=None):
+        '''Bottom-up merge sort (best first). The merges at each level are
+        independent, so their comparisons are done in concurrent batches.
+        Failed comparisons leave the earlier doc first.'''
+        
+        def merge(left, right):
+            merged = []
+            i, j = 0, 0
+            while i<len(left) and j<len(right):
+                winner = yield (left[i], right[j])
+                if winner==right[j]['doc_id']:
+                    merged.append(right[j])
+                    j += 1
+                else:
+                    merged.append(left[i])
+                    i += 1
+            return merged + left[i:] + right[j:]
+        
+        runs = [ [doc] for doc in docs ]
+        level = 0
+        while len(runs)>1:
+            level += 1
+            merges = [ merge(runs[k], runs[k+1]) for k in range(0, len(runs)-1, 2) ]
+            merged = [None]*len(merges)
+            pending = { k: next(m) for k, m in enumerate(merges) }
+            
+            rounds = 0
+            while pending:
+                rounds += 1
+                keys = list(pending.keys())
+                winners = self.compare_batch([ pending[k] for k in keys ], max_workers=max_workers, budget=budget, skip_confidence=skip_confidence)
+                for k, winner in zip(keys, winners):
+                    try:
+                        pending[k] = merges[k].send(winner)
+                    except StopIteration as e:
+                        merged[k] = e.value
+                        del pending[k]
+            
+            if len(runs)%2==1:
+                merged.append(runs[-1])
+            runs = merged
+            self.msg(f'Merge level {level}: {len(runs):,d} runs ({rounds} rounds)', 3, 1)
+            
+        return runs[0] if runs else []
+    
+    
+    def swiss_tournament(self, docs, rounds=None, max_workers=4, budget=None, skip_confidence=None):
+        '''Swiss-system tournament. Standings are the points (1 per win, 0.5
+        per inconclusive comparison) from all the recorded comparisons between
+        the docs; each round pairs neighbors in the standings that have not
+        yet been compared, and runs those comparisons concurrently. (Running
+        it again continues the tournament.) Outcomes predicted by the
+        surrogate (skip_confidence) are not stored, so they are kept here and
+        counted like comparisons.'''
+        
+        n = len(docs)
+        if rounds is None:
+            rounds = int(np.ceil(np.log2(max(n, 2)))) + 2
+        doc_ids = [ doc['doc_id'] for doc in docs ]
+        predicted = {} # (i, j) : winner (position), for the pairs decided by the surrogate
+        
+        def standings():
+            a, b, winner = self.score_graph().subset(doc_ids)
+            if predicted:
+                extra = np.asarray(list(predicted.keys()), dtype=a.dtype).reshape(-1, 2)
+                a = np.concatenate( (a, extra[:,0]) )
+                b = np.concatenate( (b, extra[:,1]) )
+                winner = np.concatenate( (winner, np.asarray(list(predicted.values()), dtype=winner.dtype)) )
+            draws = winner<0
+            points = np.bincount(winner[~draws], minlength=n) + 0.5*(np.bincount(a[draws], minlength=n) + np.bincount(b[draws], minlength=n))
+            counts = np.bincount(a, minlength=n) + np.bincount(b, minlength=n)
+            ratios = np.where(counts>0, points/np.maximum(counts, 1), 0.5)
+            order = np.lexsort( (np.arange(n), -ratios, -points) )
+            compared = set(zip(np.minimum(a, b).tolist(), np.maximum(a, b).tolist()))
+            return order, points, compared
+        
+        for r in range(rounds):
+            order, points, compared = standings()
+            
+            # Pair each doc with the next unpaired doc (in standings order) that it has not met
+            paired = set()
+            pairs = []
+            for k, i in enumerate(order):
+                if i in paired:
+                    continue
+                for j in order[k+1:]:
+                    if j not in paired and (min(i, j), max(i, j)) not in compared:
+                        pairs.append( (i, j) )
+                        paired.update( (i, j) )
+                        break
+            
+            if len(pairs)==0:
+                self.msg('No pairs left to compare', 3, 1)
+                break
+            
+            winners = self.compare_batch([ (docs[i], docs[j]) for i, j in pairs ], max_workers=max_workers, budget=budget, skip_confidence=skip_confidence)
+            for (i, j), winner in zip(pairs, winners):
+                if winner>0 and not self.score_graph().contains(docs[i]['doc_id'], docs[j]['doc_id']):
+                    predicted[(min(i, j), max(i, j))] = i if winner==docs[i]['doc_id'] else j
+            self.msg(f'Swiss round {r+1}/{rounds}: {len(pairs):,d} comparisons ({sum(1 for w in winners if w>0):,d} decisive)', 3, 1)
+            
+            if budget is not None and budget.exhausted():
+                break
+            
+        order, points, _ = standings()
+        for i, doc in enumerate(docs):
+            doc['swiss_points'] = points[i]
+        
+        return [ docs[i] for i in order ]
+    
+    
+    # Surrogate model
+    ##################################################
+    def fit_surrogate(self, lookup_file='./chunk_lookup.npy', num_components=64, l2=1.0, holdout=0.2, seed=0):
+        '''Fit a PairwiseSurrogate to the existing pairwise scores, using the
+        mean chunk embedding of each doc (from the lookup file). A fraction
+        (holdout) of the comparisons is first held out, to report how well the
+        surrogate predicts unseen outcomes; the final fit uses them all.'''
+        
+        from .rank_models import PairwiseSurrogate
+        
+        self.start_database()
+        if self.db.embeddings is None:
+            self.db.load_embedding_lookup_file(infile=lookup_file)
+        
+        doc_ids, vectors = self.db.doc_vectors()
+        model = PairwiseSurrogate(num_components=num_components, l2=l2, verbosity=self.verbosity)
+        model.set_vectors(vectors)
+        
+        winners, losers = self.score_graph().subset_edges(doc_ids.tolist())
+        if holdout and len(winners)>=10:
+            test = np.random.default_rng(seed).random(len(winners))<holdout
+            model.fit(winners[~test], losers[~test])
+            stats = model.evaluate(winners[test], losers[test])
+            self.msg('Surrogate held-out accuracy: {:.1f}% ({:,d} comparisons; log-loss {:.3f})'.format(100*stats['accuracy'], stats['count'], stats['log_loss']), 3, 1)
+        model.fit(winners, losers)
+        self.msg(f'Surrogate fit to {len(winners):,d} comparisons of {len(doc_ids):,d} docs', 3, 1)
+        
+        self.surrogate = model
+        self.surrogate_index = { doc_id: i for i, doc_id in enumerate(doc_ids.tolist()) }
+        
+        return model
+    
+    
+    def surrogate_probability(self, doc_A, doc_B):
+        '''Predicted probability that doc_A beats doc_B (or None, if there is
+        no surrogate, or a doc has no embedding).'''
+        
+        if self.surrogate is None:
+            return None
+        i, j = self.surrogate_index.get(doc_A['doc_id']), self.surrogate_index.get(doc_B['doc_id'])
+        if i is None or j is None:
+            return None
+        
+        return float(self.surrogate.probability(i, j))
+    
+    
+    def surrogate_sort(self, docs):
+        '''Order docs by their surrogate score (docs without an embedding go
+        last, in their current order). Each doc gets 'surrogate_score'.'''
+        
+        if self.surrogate is None:
+            self.fit_surrogate()
+        
+        scores = self.surrogate.scores()
+        known, unknown = [], []
+        for doc in docs:
+            i = self.surrogate_index.get(doc['doc_id'])
+            if i is None:
+                doc['surrogate_score'] = None
+                unknown.append(doc)
+            else:
+                doc['surrogate_score'] = float(scores[i])
+                known.append(doc)
+        
+        return sorted(known, key=lambda doc: doc['surrogate_score'], reverse=True) + unknown
+        
+        
+    # Stored rankings
+    ##################################################
+    def save_ranking(self, docs, run_id=None, method='rank'):
+        '''Store the order of docs as a ranking run (in the rankings table).
+        The score and uncertainty of each doc are taken from the ranking
+        method's outputs (if any). Returns the run_id.'''
+        
+        self.start_database()
+        self.db.create_table_rankings()
+        
+        if run_id is None:
+            # (Timestamped to the microsecond, so that runs sort in order; the
+            # random suffix keeps run_ids unique across processes)
+            import datetime, uuid
+            run_id = '{}-{}-{}'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'), method, uuid.uuid4().hex[:6])
+        
+        def value(doc, keys):
+            for key in keys:
+                if doc.get(key) is not None:
+                    return float(doc[key])
+            return None
+        
+        rows = []
+        for i, doc in enumerate(docs):
+            score = value(doc, ['bt_score', 'swiss_points', 'scoring_win_ratio', 'rank_score'])
+            uncertainty = value(doc, ['bt_std', 'rank_uncertainty'])
+            rows.append( (doc['doc_id'], i+1, score, uncertainty) )
+        
+        self.db.add_ranking(run_id, rows)
+        self.msg(f'Saved ranking {run_id} ({len(rows):,d} docs)', 3, 1)
+        
+        return run_id
+    
+    
+    def load_ranking(self, run_id=None):
+        '''The docs of a stored ranking run (by default, the most recent), in
+        rank order. Each doc gets 'rank', 'rank_score', 'rank_uncertainty'
+        and 'rank_run'.'''
+        
+        self.start_database()
+        self.db.create_table_rankings()
+        
+        rows = self.db.get_ranking(run_id)
+        docs = { doc['doc_id']: doc for doc in self.db.get_docs() }
+        
+        ranked = []
+        for row in rows:
+            doc = docs.get(row['doc_id'])
+            if doc is None:
+                # The doc has since been removed
+                continue
+            doc['rank'], doc['rank_score'], doc['rank_uncertainty'], doc['rank_run'] = row['rank'], row['score'], row['uncertainty'], row['run_id']
+            ranked.append(doc)
+        
+        if len(rows)>0:
+            self.msg(f"Loaded ranking {rows[0]['run_id']} ({len(ranked):,d} docs)", 3, 1)
+        
+        return ranked
+    
+    
+    def insert_documents(self, docs=None, run_id=None, max_workers=4, max_per_minute=None, skip_confidence=None):
+        '''Place new docs into a stored ranking (by default, the most recent),
+        by binary search: each doc is compared to the anchor at the middle of
+        its remaining range, so it needs only O(log n) comparisons. The
+        searches of the different docs advance together, with each step's
+        comparisons done concurrently (compare_batch). An inconclusive or
+        failed comparison places the doc next to that anchor (new docs that
+        end up in the same place are then compared among themselves).
+        By default, the docs missing from the ranking are inserted. The
+        result is stored as a new ranking run, and returned.
+        With skip_confidence, comparisons that the embedding surrogate predicts
+        with at least that probability are not sent to the LLM.'''
+        
+        
+        self.bot = CompareBot(self.configuration, verbosity=self.verbosity)
+        
+        ranked = self.load_ranking(run_id)
+        if len(ranked)==0:
+            self.msg_error('No stored ranking to insert into (rank the documents first).')
+            return None
+        
+        if docs is None:
+            ranked_ids = set(doc['doc_id'] for doc in ranked)
+            docs = [ doc for doc in self.db.get_docs() if doc['doc_id'] not in ranked_ids ]
+        
+        self.msg(f'Inserting {len(docs):,d} docs into a ranking of {len(ranked):,d}', 3, 0)
+        
+        if skip_confidence is not None and self.surrogate is None:
+            self.fit_surrogate()
+        
+        budget = RateBudget(max_per_minute=max_per_minute)
+        bounds = [ [0, len(ranked)] for doc in docs ]
+        step = 0
+        while True:
+            searching = [ k for k, (low, high) in enumerate(bounds) if low<high ]
+            if len(searching)==0:
+                break
+            step += 1
+            
+            mids = { k: (bounds[k][0]+bounds[k][1])//2 for k in searching }
+            winners = self.compare_batch([ (docs[k], ranked[mids[k]]) for k in searching ], max_workers=max_workers, budget=budget, skip_confidence=skip_confidence)
+            for k, winner in zip(searching, winners):
+                mid = mids[k]
+                if winner==docs[k]['doc_id']:
+                    bounds[k][1] = mid
+                elif winner==ranked[mid]['doc_id']:
+                    bounds[k][0] = mid+1
+                else:
+                    bounds[k] = [mid, mid]
+            
+            self.msg(f'Step {step}: {len(searching):,d} comparisons', 4, 1)
+        
+        # Each new doc goes just before the anchor at its position
+        inserted = {}
+        for k, (position, _) in enumerate(bounds):
+            inserted.setdefault(position, []).append(docs[k])
+        
+        # (New docs that landed in the same place are sorted among themselves)
+        for position, group in inserted.items():
+            if len(group)>1:
+                inserted[position] = self.merge_tournament(group, max_workers=max_workers, budget=budget, skip_confidence=skip_confidence)
+        
+        result = []
+        for position in range(len(ranked)+1):
+            for doc in inserted.get(position, []):
+                # Score interpolated between the neighbors
+                neighbors = [ ranked[i]['rank_score'] for i in [position-1, position] if 0<=i<len(ranked) and ranked[i]['rank_score'] is not None ]
+                doc['rank_score'] = np.mean(neighbors) if len(neighbors)>0 else None
+                doc['rank_uncertainty'] = None
+                for key in ['bt_score', 'swiss_points', 'scoring_win_ratio', 'bt_std']:
+                    doc.pop(key, None)
+                result.append(doc)
+            if position<len(ranked):
+                result.append(ranked[position])
+        
+        self.save_ranking(result, method='insert')
+        
+        return result
+    
+    
     def rank_documents(self, wait=5):
         
         #import random
-        import re
-        
         
-        self.path_re = re.compile('(^\/.+)(\/xml\/)(.+)(\.tei\.xml)$')
         
         self.bot = CompareBot(self.configuration)
         
@@ -552,16 +1175,20 @@ class RankSorter(Base):
         #self.random_comparisons(rounds=50)
         #self.semi_random_comparisons(rounds=1, wait=wait)
         
-        #docs = self.db.get_docs()
-        docs = np.load('documents_sorted.npy', allow_pickle=True)
+        # Start from the most recent stored ranking (with any new docs at the end)
+        docs = self.load_ranking()
+        ranked_ids = set(doc['doc_id'] for doc in docs)
+        docs += [ doc for doc in self.db.get_docs() if doc['doc_id'] not in ranked_ids ]
         
         #docs = self.try_sort(docs, max_rounds=20, wait=wait)
+        #docs = self.active_sort(docs, wait=wait)
+        #docs = self.tournament_sort(docs, mode='merge', max_workers=4, max_per_minute=60)
         docs = self.score_sort(docs, num_iterations=20)
         
         
         
         
-        np.save('documents_sorted.npy', docs, allow_pickle=True)
+        self.save_ranking(docs, method='score_sort')
         
         if True:
             for i, doc in enumerate(docs):
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Filename: tracing.py
+Author: Kevin G. Yager, Brookhaven National Laboratory
+Email: kyager@bnl.gov
+Date created: 2026-10-19
+Description:
+ Lightweight latency tracing. Work is recorded as nested spans (using the
+span() context manager, or the @traced decorator), which can carry
+attributes (rows scanned, tokens, bytes, ...). Finished spans are written
+to a JSON-lines file, and their durations aggregated per span name (so that
+p50/p95/p99 latencies can be reported, and regressions found).
+
+Tracing is off unless enabled in the configuration, e.g.:
+    'tracing': {'path': base_dir / 'traces.jsonl'}
+When off, span() costs little more than a function call.
+"""
+
+from .Base import Base
+
+import functools
+import inspect
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+
+
+class Span():
+    '''A timed unit of work.'''
+
+    def __init__(self, tracer, name, parent=None, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = next(tracer.ids)
+        self.parent_id = None if parent is None else parent.span_id
+        self.trace_id = self.span_id if parent is None else parent.trace_id
+        self.attributes = attributes or {}
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self.start_counter = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key, amount=1):
+        '''Accumulate a count (e.g. rows or bytes) on the span.'''
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def end(self):
+        self.duration = time.perf_counter() - self.start_counter
+
+    def to_dict(self):
+        return {
+            'trace': self.trace_id,
+            'span': self.span_id,
+            'parent': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'thread': self.thread,
+            'attributes': self.attributes,
+            }
+
+
+
+class NullSpan():
+    '''Stands in for a span when tracing is off.'''
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, key, amount=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+null_span = NullSpan()
+
+
+
+class Tracer(Base):
+    '''Records spans (per thread, nested), and aggregates their durations.'''
+
+    def __init__(self, path=None, max_samples=10000, name='tracer', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+        self.path = None if path is None else Path(path)
+        self.max_samples = max_samples
+
+        self.ids = itertools.count(int.from_bytes(os.urandom(4), 'big') << 20)
+        self.samples = {} # name : recent durations (seconds)
+        self.counts = {} # name : number of spans
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._file = None
+
+
+    # Spans
+    ##################################################
+    def stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+
+    def current(self):
+        '''The innermost open span (of this thread), or None.'''
+        stack = self.stack()
+        return stack[-1] if stack else None
+
+
+    def span(self, name, parent=None, **attributes):
+        '''Context manager that records a span (nested inside the current span,
+        unless a parent is given).'''
+        return _SpanContext(self, name, parent, attributes)
+
+
+    def begin(self, name, parent=None, **attributes):
+        span = Span(self, name, parent=parent or self.current(), attributes=attributes)
+        self.stack().append(span)
+        return span
+
+
+    def finish(self, span, error=None):
+        span.end()
+        if error is not None:
+            span.attributes['error'] = type(error).__name__
+
+        # (Spans opened around generators need not close in order)
+        stack = self.stack()
+        if span in stack:
+            stack.remove(span)
+
+        self.record(span)
+
+
+    def record(self, span):
+
+        with self._lock:
+            if span.name not in self.samples:
+                self.samples[span.name] = deque(maxlen=self.max_samples)
+            self.samples[span.name].append(span.duration)
+            self.counts[span.name] = self.counts.get(span.name, 0) + 1
+
+            if self.path is not None:
+                if self._file is None:
+                    self.path.parent.mkdir(parents=True, exist_ok=True)
+                    self._file = open(self.path, 'a', buffering=1)
+                self._file.write(json.dumps(span.to_dict(), default=str) + '\n')
+
+
+    # Aggregation
+    ##################################################
+    def summary(self, percentiles=(50, 95, 99)):
+        '''Latency statistics per span name (over the recent spans).'''
+
+        with self._lock:
+            samples = { name: np.asarray(values) for name, values in self.samples.items() }
+            counts = dict(self.counts)
+
+        return { name: summarize_durations(values, percentiles=percentiles, count=counts[name]) for name, values in samples.items() }
+
+
+    def histogram(self, name, bins=20):
+        '''Histogram of the (recent) durations of a span name, with
+        logarithmically-spaced bins. Returns (counts, bin_edges).'''
+
+        with self._lock:
+            values = np.asarray(self.samples.get(name, []))
+
+        return log_histogram(values, bins=bins)
+
+
+    def report(self, threshold=3, indent=1):
+        '''Print the latency statistics.'''
+
+        summary = self.summary()
+        for name in sorted(summary):
+            self.msg(format_summary(name, summary[name]), threshold, indent)
+
+
+    def reset(self):
+        with self._lock:
+            self.samples = {}
+            self.counts = {}
+
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+
+class _SpanContext():
+
+    __slots__ = ('tracer', 'name', 'parent', 'attributes', 'span')
+
+    def __init__(self, tracer, name, parent, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.span = self.tracer.begin(self.name, parent=self.parent, **self.attributes)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracer.finish(self.span, error=exc)
+        return False
+
+
+
+# Statistics
+##################################################
+def summarize_durations(values, percentiles=(50, 95, 99), count=None):
+
+    values = np.asarray(values, dtype=float)
+    result = {'count': len(values) if count is None else count}
+    if len(values)>0:
+        result['mean'] = float(np.mean(values))
+        result['max'] = float(np.max(values))
+        for p, value in zip(percentiles, np.percentile(values, percentiles)):
+            result[f'p{p}'] = float(value)
+
+    return result
+
+
+def log_histogram(values, bins=20):
+
+    values = np.asarray(values, dtype=float)
+    values = values[values>0]
+    if len(values)==0:
+        return np.zeros(bins, dtype=int), np.zeros(bins+1)
+
+    low, high = np.log10(values.min()), np.log10(values.max())
+    edges = np.logspace(low, max(high, low+1e-3), bins+1)
+
+    return np.histogram(values, bins=edges)
+
+
+def format_summary(name, stats):
+
+    if stats.get('mean') is None:
+        return f"{name}: {stats['count']:,d} spans"
+
+    return f"{name}: {stats['count']:,d} spans, p50 {1e3*stats['p50']:.1f} ms, p95 {1e3*stats['p95']:.1f} ms, p99 {1e3*stats['p99']:.1f} ms (max {1e3*stats['max']:.1f} ms)"
+
+
+def load_trace(path):
+    '''The spans saved in a JSON-lines trace file.'''
+
+    spans = []
+    with open(path) as fin:
+        for line in fin:
+            if line.strip():
+                spans.append(json.loads(line))
+
+    return spans
+
+
+def trace_summary(spans, percentiles=(50, 95, 99)):
+    '''Latency statistics per span name, for spans loaded from a trace file.'''
+
+    durations = {}
+    for span in spans:
+        durations.setdefault(span['name'], []).append(span['duration'])
+
+    return { name: summarize_durations(values, percentiles=percentiles) for name, values in durations.items() }
+
+
+
+# Process-wide tracer
+##################################################
+_tracer = None
+_tracer_lock = threading.Lock()
+
+def get_tracer():
+    '''The process-wide tracer (or None, if tracing is off).'''
+    return _tracer
+
+
+def configure_tracing(configuration=None, **settings):
+    '''Turn on tracing if the configuration has a 'tracing' section, e.g.:
+        {'path': './traces.jsonl', 'max_samples': 10000}
+    (or if settings are given directly). Returns the tracer, or None.'''
+
+    global _tracer
+
+    if configuration is not None:
+        if configuration.get('tracing') is None:
+            return _tracer
+        settings = dict(configuration['tracing'], **settings)
+
+    with _tracer_lock:
+        if settings.get('enabled', True)==False:
+            if _tracer is not None:
+                _tracer.close()
+            _tracer = None
+        elif _tracer is None or (settings.get('path') is not None and _tracer.path!=Path(settings['path'])):
+            if _tracer is not None:
+                _tracer.close()
+            _tracer = Tracer(path=settings.get('path'), max_samples=settings.get('max_samples', 10000), verbosity=settings.get('verbosity', 3))
+
+    return _tracer
+
+
+def span(name, **attributes):
+    '''Context manager that records a span (if tracing is on):
+        with span('db.query', table='chunks') as s:
+            rows = ...
+            s.set(rows=len(rows))
+    '''
+
+    tracer = _tracer
+    if tracer is None:
+        return null_span
+
+    return tracer.span(name, **attributes)
+
+
+def current_span():
+    '''The innermost open span (of this thread); a do-nothing span if there is none.'''
+
+    tracer = _tracer
+    current = None if tracer is None else tracer.current()
+
+    return null_span if current is None else current
+
+
+def traced(name=None, **attributes):
+    '''Decorator that records a span for each call of the function.'''
+
+    def decorator(function):
+        span_name = name or function.__qualname__
+
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with span(span_name, **attributes):
+                    yield from function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with span(span_name, **attributes):
+                    return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def propagate(function):
+    '''Wrap a function (to be run in another thread), so that its spans are
+    nested inside the span that is current now.'''
+
+    tracer = _tracer
+    parent = None if tracer is None else tracer.current()
+    if parent is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        stack = tracer.stack()
+        stack.append(parent)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stack.remove(parent)
+
+    return wrapper
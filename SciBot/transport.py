@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Filename: transport.py
+Author: Kevin G. Yager, Brookhaven National Laboratory
+Email: kyager@bnl.gov
+Date created: 2026-10-19
+Description:
+ Pluggable transports for the LLM wrappers. The wrappers describe each
+request (chat completion, streamed chat completion, embedding, Anthropic
+completion) as a JSON-able dict, and the transport decides how to answer it:
+  live : call the provider API
+  record : call the provider API, and save the request/response pairs
+  replay : answer from the saved pairs (with synthetic latency)
+  stub : answer with deterministic fake completions and embeddings
+This allows pipelines (ingestion, query_via_db, ...) to be exercised and
+benchmarked without network access. StubLLMServer provides the same fake
+responses over HTTP, using the OpenAI API format.
+"""
+
+from .Base import Base
+from .tracing import span, get_tracer
+
+import hashlib
+import json
+import re
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+def request_key(kind, request):
+    '''Requests are identified by a hash of their content.'''
+
+    data = json.dumps({'kind': kind, 'request': request}, sort_keys=True, ensure_ascii=True)
+
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+
+class LiveTransport(Base):
+    '''Sends requests to the provider (using the wrapper-supplied function).'''
+
+    mode = 'live'
+
+    def __init__(self, name='transport', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+
+    def call(self, kind, request, live):
+        return live(request)
+
+
+    def call_stream(self, kind, request, live):
+        yield from live(request)
+
+
+
+class RecordTransport(LiveTransport):
+    '''Sends requests to the provider, and saves the request/response pairs
+    (JSON-lines, appended as each response completes).'''
+
+    mode = 'record'
+
+    def __init__(self, path, name='transport', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+
+    def save(self, kind, request, response):
+        item = {'key': request_key(kind, request), 'kind': kind, 'request': request, 'response': response}
+        with self._lock:
+            with open(self.path, 'a') as fout:
+                fout.write(json.dumps(item) + '\n')
+
+
+    def call(self, kind, request, live):
+        response = live(request)
+        self.save(kind, request, response)
+        return response
+
+
+    def call_stream(self, kind, request, live):
+        fragments = []
+        for fragment in live(request):
+            fragments.append(fragment)
+            yield fragment
+        self.save(kind, request, fragments)
+
+
+
+class SyntheticLatency():
+    '''Delays that mimic a provider: a fixed latency (time to first token),
+    plus a time per generated token.'''
+
+    def __init__(self, latency=0.0, latency_per_token=0.0):
+        self.latency = latency
+        self.latency_per_token = latency_per_token
+
+    def first(self):
+        if self.latency>0:
+            time.sleep(self.latency)
+
+    def tokens(self, text):
+        if self.latency_per_token>0:
+            # (Estimated, since this need not be exact)
+            time.sleep(self.latency_per_token*len(text)/4)
+
+    def response(self, response):
+        self.first()
+        if isinstance(response, str):
+            self.tokens(response)
+
+
+
+class ReplayTransport(Base):
+    '''Answers requests using responses saved by RecordTransport.'''
+
+    mode = 'replay'
+
+    def __init__(self, path, latency=0.0, latency_per_token=0.0, name='transport', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+        self.path = Path(path)
+        self.delay = SyntheticLatency(latency, latency_per_token)
+
+        self.responses = {}
+        with open(self.path) as fin:
+            for line in fin:
+                try:
+                    item = json.loads(line)
+                    self.responses[item['key']] = item['response']
+                except (ValueError, KeyError):
+                    pass
+
+        self.msg(f"Loaded {len(self.responses):,d} recorded responses from: {self.path}", 3, 1)
+
+
+    def lookup(self, kind, request):
+        key = request_key(kind, request)
+        if key not in self.responses:
+            raise KeyError(f"No recorded response for {kind} request (key {key[:12]}...)")
+
+        return self.responses[key]
+
+
+    def call(self, kind, request, live):
+        response = self.lookup(kind, request)
+        self.delay.response(response)
+        return response
+
+
+    def call_stream(self, kind, request, live):
+        fragments = self.lookup(kind, request)
+        self.delay.first()
+        for fragment in fragments:
+            self.delay.tokens(fragment)
+            yield fragment
+
+
+
+class StubTransport(Base):
+    '''Answers requests with deterministic fake responses. Completions are
+    pseudo-random text (seeded by the request); embeddings use feature hashing
+    of the words, so that similar texts have similar vectors (and retrieval
+    behaves sensibly).'''
+
+    mode = 'stub'
+
+    vocabulary = ('the', 'sample', 'film', 'polymer', 'scattering', 'structure', 'nanoparticle', 'measured', 'data', 'results',
+                  'shows', 'surface', 'ordering', 'temperature', 'beamline', 'of', 'and', 'in', 'with', 'a', 'we', 'model',
+                  'lattice', 'morphology', 'block', 'copolymer', 'annealing', 'X-ray', 'domain', 'spacing', 'thin', 'analysis')
+
+    def __init__(self, latency=0.0, latency_per_token=0.0, embedding_dim=1536, completion_words=120, name='transport', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+        self.delay = SyntheticLatency(latency, latency_per_token)
+        self.embedding_dim = embedding_dim
+        self.completion_words = completion_words
+        self.word_re = re.compile(r'\w+')
+
+
+    def completion(self, request):
+
+        seed = int(request_key('completion', request)[:8], 16)
+        rng = np.random.RandomState(seed)
+        words = rng.choice(self.vocabulary, size=self.completion_words)
+
+        return 'Stub response ({}): {}.'.format(request.get('model', 'stub'), ' '.join(words))
+
+
+    def embedding(self, text):
+
+        vector = np.zeros(self.embedding_dim)
+        for word in self.word_re.findall(text.lower()):
+            h = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+            vector[h % self.embedding_dim] += 1.0 if (h>>32)&1 else -1.0
+
+        norm = np.linalg.norm(vector)
+        if norm==0:
+            vector[0] = 1.0
+            norm = 1.0
+
+        return (vector/norm).tolist()
+
+
+    def respond(self, kind, request):
+
+        if kind=='embedding':
+            return self.embedding(request['input'])
+
+        return self.completion(request)
+
+
+    def call(self, kind, request, live):
+        response = self.respond(kind, request)
+        self.delay.response(response)
+        return response
+
+
+    def call_stream(self, kind, request, live):
+        response = self.respond(kind, request)
+        self.delay.first()
+        for fragment in re.findall(r'\S+\s*', response):
+            self.delay.tokens(fragment)
+            yield fragment
+
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+def get_transport(configuration=None):
+    '''The transport selected by configuration['transport'], e.g.:
+        {'mode': 'replay', 'path': './llm_recording.jsonl', 'latency': 0.5}
+    Transports are shared (per settings) by all the LLM wrappers.'''
+
+    settings = (configuration or {}).get('transport') or {'mode': 'live'}
+    settings = dict(settings)
+    mode = settings.pop('mode', 'live')
+
+    key = json.dumps([mode, settings], sort_keys=True, default=str)
+    with _transports_lock:
+        if key not in _transports:
+            if mode=='live':
+                _transports[key] = LiveTransport(**settings)
+            elif mode=='record':
+                _transports[key] = RecordTransport(**settings)
+            elif mode=='replay':
+                _transports[key] = ReplayTransport(**settings)
+            elif mode=='stub':
+                _transports[key] = StubTransport(**settings)
+            else:
+                raise ValueError(f"Unknown transport mode: {mode}")
+
+        return _transports[key]
+
+
+
+def traced_call(transport, kind, request, live):
+    '''Answer a request with the transport, recording an 'llm.<kind>' span
+    (with the request/response sizes) if tracing is on.'''
+
+    if get_tracer() is None:
+        return transport.call(kind, request, live)
+
+    with span('llm.'+kind, transport=getattr(transport, 'mode', None)) as s:
+        response = transport.call(kind, request, live)
+        s.set(bytes_in=request_size(request), bytes_out=len(json.dumps(response)))
+
+    return response
+
+
+def traced_call_stream(transport, kind, request, live):
+
+    if get_tracer() is None:
+        yield from transport.call_stream(kind, request, live)
+        return
+
+    with span('llm.'+kind, transport=getattr(transport, 'mode', None)) as s:
+        s.set(bytes_in=request_size(request))
+        fragments = 0
+        for fragment in transport.call_stream(kind, request, live):
+            fragments += 1
+            s.add('bytes_out', len(fragment.encode('utf-8')))
+            yield fragment
+        s.set(fragments=fragments)
+
+
+def request_size(request):
+    return len(json.dumps(request, default=str))
+
+
+
+class StubLLMServer(Base):
+    '''A local HTTP server implementing (the relevant parts of) the OpenAI
+    API, using the deterministic responses of StubTransport. Point a client at
+    it using e.g. configuration['openai']['base_url'] = server.base_url.'''
+
+    def __init__(self, host='127.0.0.1', port=0, name='stub_server', verbosity=3, **kwargs):
+        super().__init__(name=name, verbosity=verbosity)
+
+        self.stub = StubTransport(verbosity=self.verbosity, **kwargs)
+
+        from http.server import ThreadingHTTPServer
+        self.server = ThreadingHTTPServer( (host, port), self.make_handler() )
+        self.base_url = 'http://{}:{}/v1'.format(*self.server.server_address[:2])
+        self.thread = None
+
+
+    def make_handler(self):
+
+        from http.server import BaseHTTPRequestHandler
+        stub = self.stub
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, data, status=200):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(length) or b'{}')
+
+                if self.path.endswith('/embeddings'):
+                    texts = payload['input'] if isinstance(payload['input'], list) else [payload['input']]
+                    data = [ {'object': 'embedding', 'index': i, 'embedding': stub.embedding(text)} for i, text in enumerate(texts) ]
+                    stub.delay.first()
+                    self.send_json({'object': 'list', 'data': data, 'model': payload.get('model'), 'usage': {'prompt_tokens': 0, 'total_tokens': 0}})
+
+                elif self.path.endswith('/chat/completions'):
+                    request = {'model': payload.get('model'), 'messages': payload.get('messages')}
+                    if payload.get('stream'):
+                        self.send_response(200)
+                        self.send_header('Content-Type', 'text/event-stream')
+                        self.send_header('Connection', 'close')
+                        self.end_headers()
+                        for fragment in stub.call_stream('chat', request, None):
+                            chunk = {'id': 'stub', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': payload.get('model'),
+                                     'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': fragment}, 'finish_reason': None}]}
+                            self.wfile.write(('data: ' + json.dumps(chunk) + '\n\n').encode('utf-8'))
+                            self.wfile.flush()
+                        self.wfile.write(b'data: [DONE]\n\n')
+                        self.close_connection = True
+                    else:
+                        content = stub.call('chat', request, None)
+                        self.send_json({'id': 'stub', 'object': 'chat.completion', 'created': int(time.time()), 'model': payload.get('model'),
+                                        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                                        'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}})
+
+                else:
+                    self.send_json({'error': {'message': f'Unknown endpoint: {self.path}'}}, status=404)
+
+        return Handler
+
+
+    def start(self):
+        '''Serve (in a background thread).'''
+
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.msg(f"Stub LLM server running at: {self.base_url}", 3, 0)
+
+        return self.base_url
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
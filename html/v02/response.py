@@ -4,6 +4,7 @@
 
 
 import sys, os
+import json
 # If SciBot is not "installed" (pip install SciToolsSciBot), then you can point to the code on your computer here:
 SciBot_PATH = '/home/user/SciBot/'
 SciBot_PATH  in sys.path or sys.path.append(SciBot_PATH)
@@ -26,10 +27,24 @@ import config
 
 if __name__=='__main__':
 
-    thread_id = sys.argv[1]
-
-    bot = AnswerBot(name='bot', configuration=config.SciBot_configuration, verbosity=5)
-    infile = config_PATH + '/chunk_lookup.npy'
-    bot.load_embedding_lookup_file(infile=infile)
-    response = bot.query_via_db(thread_id, use_context=True, doc_name=True)
+    # Usage: response.py [--stream] thread_id
+    stream = '--stream' in sys.argv[1:]
+    thread_id = [arg for arg in sys.argv[1:] if arg!='--stream'][0]
+
+    if stream:
+        # Output (one JSON object per line) is relayed to the browser by stream.php,
+        # so we suppress the usual status messages.
+        bot = AnswerBot(name='bot', configuration=config.SciBot_configuration, verbosity=0)
+        infile = config_PATH + '/chunk_lookup.npy'
+        bot.load_embedding_lookup_file(infile=infile)
+        for fragment in bot.query_via_db_stream(thread_id, use_context=True, doc_name=True):
+            print(json.dumps({'delta': fragment}), flush=True)
+        bot.close_database() # (Waits for any background writes)
+        
+    else:
+        bot = AnswerBot(name='bot', configuration=config.SciBot_configuration, verbosity=5)
+        infile = config_PATH + '/chunk_lookup.npy'
+        bot.load_embedding_lookup_file(infile=infile)
+        response = bot.query_via_db(thread_id, use_context=True, doc_name=True)
+        bot.close_database() # (Waits for any background writes)
 
@@ -24,12 +24,19 @@ function sendMessage() {
     const urlParams = new URLSearchParams(window.location.search);
     const conversation = urlParams.get('c');    
     
+    const body = 'message=' + encodeURIComponent(message) + '&conversation=' + encodeURIComponent(conversation);
+
+    if (window.ReadableStream && window.TextDecoder) {
+        streamResponse(body);
+        return;
+    }
+
     fetch('agent.php', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/x-www-form-urlencoded'
         },
-        body: 'message=' + encodeURIComponent(message) + '&conversation=' + encodeURIComponent(conversation)
+        body: body
     })
     .then(response => response.text())
     .then(agentResponse => {
@@ -37,11 +44,77 @@ function sendMessage() {
     });
 }
 
+function streamResponse(body) {
+    // Render the reply as it is generated (server-sent events from stream.php)
+    const messageElement = addMessageToChatArea('CFNBot', '');
+    const content = messageElement.querySelector('.message-content');
+    let reply = '';
+
+    fetch('stream.php', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/x-www-form-urlencoded'
+        },
+        body: body
+    })
+    .then(response => {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        function handleEvent(event) {
+            let name = 'message';
+            let data = '';
+            event.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) {
+                    name = line.slice(7);
+                } else if (line.startsWith('data: ')) {
+                    data += line.slice(6);
+                }
+            });
+            if (!data) {
+                return;
+            }
+            const item = JSON.parse(data);
+            if (name === 'done') {
+                // Final (formatted) version of the reply
+                content.innerHTML = item.message;
+            } else {
+                reply += item.delta;
+                content.innerHTML = escapeHTML(reply).replace(/\n/g, '<br />');
+            }
+            chatArea.scrollTop = chatArea.scrollHeight;
+        }
+
+        function read() {
+            return reader.read().then(({done, value}) => {
+                if (done) {
+                    return;
+                }
+                buffer += decoder.decode(value, {stream: true});
+                const events = buffer.split('\n\n');
+                buffer = events.pop();
+                events.forEach(handleEvent);
+                return read();
+            });
+        }
+
+        return read();
+    });
+}
+
+function escapeHTML(text) {
+    const element = document.createElement('div');
+    element.textContent = text;
+    return element.innerHTML;
+}
+
 function addMessageToChatArea(sender, message) {
     const messageElement = document.createElement('div');
-    messageElement.innerHTML = `<strong>${sender}:</strong> ${message} <br><br>`;
+    messageElement.innerHTML = `<strong>${sender}:</strong> <span class="message-content">${message}</span> <br><br>`;
     chatArea.appendChild(messageElement);
     chatArea.scrollTop = chatArea.scrollHeight;
+    return messageElement;
 }
 
 function retrieveConversationHistory() {
@@ -0,0 +1,101 @@
+<?php
+// Streaming version of agent.php: the reply is sent to the browser as it is
+// generated, as server-sent events:
+//   data: {"delta": "..."}      (a fragment of the reply)
+//   event: done
+//   data: {"message": "..."}    (the final reply, formatted as HTML)
+
+function doiToLink($text) {
+    $doi_pattern = '/\b(10[.][0-9]{4,}(?:[.][0-9]+)*\/[^ \t\r\n]+)\b/';
+    $replacement = '<a href="https://doi.org/$1">$1</a>';
+    $text = preg_replace($doi_pattern, $replacement, $text);
+    return $text;
+}
+
+function sendEvent($data, $event=null) {
+    if ($event !== null) {
+        echo "event: ".$event."\n";
+    }
+    echo "data: ".$data."\n\n";
+    @ob_flush();
+    flush();
+}
+
+
+if (isset($_POST['conversation']) and isset($_POST['message'])) {
+
+    $conversation = $_POST['conversation'];
+    $message = $_POST['message'];
+
+    // Connect to SciBot database
+    $servername = "localhost";
+    $dbname = "SciBot_DocumentStore";
+    $username = "scibot";
+    $password = "********";
+
+    $conn = new mysqli($servername, $username, $password, $dbname);
+    if ($conn->connect_error) {
+        die("Connection failed: " . $conn->connect_error);
+    }
+
+
+    // Add this message into the database
+    $stmt = $conn->prepare("INSERT INTO messages (thread_id, date_time, who, message_content) VALUES (?, NOW(), 'user', ?)");
+    $stmt->bind_param('ss', $conversation, $message);
+    $stmt->execute();
+    $stmt->close();
+
+
+    // Disable buffering (PHP, and proxies such as nginx)
+    header('Content-Type: text/event-stream');
+    header('Cache-Control: no-cache');
+    header('X-Accel-Buffering: no');
+    while (ob_get_level() > 0) {
+        ob_end_flush();
+    }
+
+
+    // Trigger SciBot, relaying the reply as it is generated
+    $command = escapeshellcmd('python3 response.py --stream '.$conversation);
+    $process = popen($command, 'r');
+    while (($line = fgets($process)) !== false) {
+        $line = trim($line);
+        if (strpos($line, '{"delta"') === 0) {
+            sendEvent($line);
+        }
+    }
+    pclose($process);
+
+
+    // Get reply (as saved to the database)
+    $stmt = $conn->prepare("SELECT * FROM messages WHERE thread_id=? ORDER BY date_time DESC LIMIT 1");
+    $stmt->bind_param('s', $conversation);
+    $stmt->execute();
+
+    $result = $stmt->get_result(); // Store the result
+
+    if($result->num_rows != 1){
+        $response = "[[db error: expected 1 result, got ".$result->num_rows." results.]]";
+    } else {
+        $row = $result->fetch_assoc();
+        if( $row['who']!='assistant' ) {
+            $response = "[[reply error: last message is from ".$row['who'].".]]";
+        } else {
+            $response = nl2br($row['message_content']);
+        }
+    }
+
+    $stmt->close();
+    $conn->close();
+
+    // Check for DOIs
+    $response = doiToLink($response);
+
+    sendEvent(json_encode(array('message' => $response)), 'done');
+
+
+
+} else {
+    http_response_code(400);
+}
+?>
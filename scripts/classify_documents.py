@@ -31,4 +31,5 @@ if __name__ == "__main__":
     
     classifier = Classifier(configuration=config.SciBot_configuration, verbosity=5)
     classifier.classify_documents()
+    #classifier.classify_documents(preclassify=True) # Label confident docs with a kNN over embeddings; only the rest go to the LLM
     
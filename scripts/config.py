@@ -21,6 +21,8 @@ SciBot_configuration = {
     
     'chunk_length': 1400, # chars
     'chunk_overlap_length': 280, # chars
+    #'chunk_storage': 'offsets', # Store document text once, with chunks as offsets (avoids duplicating the overlaps)
+    #'excerpt_budgets': [2000, 8000, 32000], # tokens; sizes of the document excerpts prepared at ingest (for CompareBot/ClassifyBot)
     
     'grobid': {
         'config_file': base_dir / 'Grobid/client/config.json',
@@ -39,6 +41,10 @@ SciBot_configuration = {
         'model_token_limit': 128000, # ~512k chars
         'embedding_model': 'text-embedding-ada-002', # 1,536 length vector
         'embedding_model_token_limit': 8191, # ~32,764 chars
+        #'base_url': 'http://127.0.0.1:8765/v1', # e.g. a local stub server (scripts/stub_llm_server.py)
+        #'timeout': 120.0, # seconds, per request
+        #'max_retries': 3,
+        #'max_connections': 32, # Size of the (shared) connection pool
         },
     
     'azure_openai': {
@@ -57,6 +63,8 @@ SciBot_configuration = {
         'embedding_deployment_name': '********',
         'embedding_model': 'text-embedding-ada-002', # 1,536 length vector
         'embedding_model_token_limit': 8191, # ~32k chars
+        #'timeout': 120.0, # seconds, per request
+        #'max_retries': 3,
         },
         
     
@@ -70,6 +78,27 @@ SciBot_configuration = {
         'max_tokens_to_sample': 1000,
         },    
     
+    # How LLM requests are answered: 'live' (default), 'record' (live, saving request/response pairs),
+    # 'replay' (from the saved pairs), or 'stub' (deterministic fake responses); e.g. for offline benchmarking
+    #'transport': {'mode': 'record', 'path': base_dir / 'llm_recording.jsonl'},
+    #'transport': {'mode': 'replay', 'path': base_dir / 'llm_recording.jsonl', 'latency': 0.5, 'latency_per_token': 0.01},
+    
+    # How chunks are retrieved: 'vector' (default; embedding similarity), 'bm25' (local lexical index,
+    # no embedding API call), or 'hybrid' (reciprocal rank fusion of the two)
+    #'retrieval': 'hybrid',
+    #'bm25': {'path': base_dir / 'bm25_index.npy'}, # Updated during ingestion (if set)
+    
+    # Latency tracing (nested spans, written as JSON-lines; summarize with scripts/trace_report.py)
+    #'tracing': {'path': base_dir / 'traces.jsonl'},
+    
+    # Semantic answer cache (repeated questions are answered without a new LLM completion)
+    #'answer_cache': {
+        #'threshold': 0.97, # minimum cosine similarity between questions
+        #'ttl': 7*24*3600, # seconds
+        #'max_entries': 5000, # least recently used are evicted
+        #'verify_context': True, # also require the same retrieved context
+        #},
+    
     'doc_database': {
         'host': 'localhost',
         'database': 'SciBot_DocumentStore',
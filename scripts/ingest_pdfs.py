@@ -48,4 +48,7 @@ if __name__ == "__main__":
     
     #docs.ingest_pdfs(pdf_dir, step_initial=20, step_final=20, make_summaries=True, force=True) # Generate rapid lookup file
     
+    # Alternately, use the ingestion journal, which only does the work that is still pending
+    #docs.ingest_pdfs_journaled(pdf_dir, make_summaries=True, max_workers=4)
+    
     
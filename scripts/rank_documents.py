@@ -32,4 +32,5 @@ if __name__ == "__main__":
     ranker = RankSorter(configuration=config.SciBot_configuration, verbosity=5)
     #ranker.random_comparisons()
     ranker.rank_documents()
+    #ranker.insert_documents() # Place newly-ingested documents into the latest ranking
     
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Filename: stub_llm_server.py
+Author: Kevin G. Yager, Brookhaven National Laboratory
+Email: kyager@bnl.gov
+Date created: 2026-10-19
+Description:
+ Runs a local stub of the OpenAI API (deterministic fake completions and
+embeddings), so that SciBot pipelines can be load-tested without network
+access. Point SciBot at it using (in config.py):
+    'openai': { ..., 'base_url': 'http://127.0.0.1:8765/v1' }
+Alternatively, use the 'stub' (or 'replay') transport, which avoids HTTP
+altogether:
+    'transport': {'mode': 'stub', 'latency': 0.5, 'latency_per_token': 0.01}
+"""
+
+# Imports
+########################################
+
+import sys, os
+# If SciBot is not "installed" (pip install SciToolsSciBot), then you can point to the code on your computer here:
+SciBot_PATH = '/home/user/SciBot/'
+SciBot_PATH  in sys.path or sys.path.append(SciBot_PATH)
+
+import time
+from SciBot.transport import StubLLMServer
+
+
+# Run
+########################################
+if __name__ == "__main__":
+    
+    # Synthetic latency, to mimic a real provider
+    server = StubLLMServer(port=8765, latency=0.5, latency_per_token=0.01)
+    server.start()
+    
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Filename: trace_report.py
+Author: Kevin G. Yager, Brookhaven National Laboratory
+Email: kyager@bnl.gov
+Date created: 2026-10-19
+Description:
+ Summarize the latency traces (JSON-lines, written when 'tracing' is enabled
+in config.py): count and p50/p95/p99 durations per span name. Given two
+trace files, the second is compared to the first (e.g. to find regressions
+in query_via_db or ingest_pdfs between two runs).
+Usage:
+    python trace_report.py traces.jsonl [traces_new.jsonl]
+"""
+
+# Imports
+########################################
+
+import sys, os
+# If SciBot is not "installed" (pip install SciToolsSciBot), then you can point to the code on your computer here:
+SciBot_PATH = '/home/user/SciBot/'
+SciBot_PATH  in sys.path or sys.path.append(SciBot_PATH)
+
+from SciBot.tracing import load_trace, trace_summary, format_summary
+
+
+# Run
+########################################
+if __name__ == "__main__":
+    
+    summary = trace_summary(load_trace(sys.argv[1]))
+    
+    if len(sys.argv)<3:
+        for name in sorted(summary):
+            print(format_summary(name, summary[name]))
+            
+    else:
+        # Compare two runs
+        summary_new = trace_summary(load_trace(sys.argv[2]))
+        for name in sorted(set(summary) | set(summary_new)):
+            if name not in summary or name not in summary_new:
+                print(f"{name}: only in {'first' if name in summary else 'second'} trace")
+                continue
+            old, new = summary[name], summary_new[name]
+            changes = ", ".join(f"{p} {1e3*old[p]:.1f} → {1e3*new[p]:.1f} ms ({100*(new[p]/old[p]-1):+.0f}%)" for p in ['p50', 'p95', 'p99'] if old[p]>0)
+            print(f"{name}: {changes}")